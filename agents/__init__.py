@@ -1,3 +1,16 @@
+import sys
+
+# civrealm parses sys.argv when it is first imported. The tools of the
+# package run with `python -m agents...`, e.g. agents.retrieval.build_index,
+# have options of their own: import civrealm with them hidden. sys.argv[0]
+# is "-m" while the module to run is being imported.
+if sys.argv[:1] == ['-m']:
+    _argv, sys.argv = sys.argv, sys.argv[:1]
+    try:
+        import civrealm.configs
+    finally:
+        sys.argv = _argv
+
 from .baseline_language_agent import BaselineLanguageAgent
 from .auto_gpt_agent import AutoGPTAgent
 from .baselang_agent import BaseLangAgent
@@ -0,0 +1,219 @@
+# Copyright (C) 2023  The CivRealm project
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Summary of the state of the game for the advisor.
+
+The unit and city dicts of the observations are turned into columns once
+per turn, and the counts of the summary are masks and reductions over the
+columns instead of a Python loop over every unit and city of the map.
+"""
+
+from operator import itemgetter
+from itertools import compress
+from collections import Counter
+
+import numpy as np
+
+# Diplomatic state of players at war with us.
+DS_WAR = 1
+# Map status of the tiles in current view, lower ones are fogged or unknown.
+TILE_KNOWN_SEEN = 2
+
+UNIT_COLUMNS = ('owner', 'type_attack_strength', 'x', 'y')
+CITY_COLUMNS = ('owner', 'x', 'y', 'size', 'granary_size')
+
+
+def entity_columns(entities: dict, columns: tuple) -> dict:
+    """
+    Integer columns of the fields `columns` of the entities of an
+    observation, e.g. obs['unit'].
+    """
+    values = list(entities.values())
+    return {
+        field: np.fromiter(map(itemgetter(field), values),
+                           dtype=np.int64,
+                           count=len(values))
+        for field in columns
+    }
+
+
+def war_table(dipl: dict, owners: np.ndarray) -> np.ndarray:
+    """Whether the players are at war with us, indexed by player id."""
+    size = max(max(dipl, default=-1), owners.max(initial=-1)) + 1
+    at_war = np.zeros(size, dtype=bool)
+    at_war[[
+        player for player, state in dipl.items()
+        if state['diplomatic_state'] == DS_WAR
+    ]] = True
+    return at_war
+
+
+class AdvisorSummary:
+    """
+    Counts of our units and cities and of the visible enemy ones, and the
+    war state derived from them.
+
+    `unit_types` maps the type names of our units to their counts, in the
+    order in which the types first appear in the observations. When built
+    from observations, the columns of the units and cities are kept in
+    `unit_columns` and `city_columns` for other features of the turn.
+    """
+    def __init__(self,
+                 unit_types,
+                 working_units,
+                 military_units,
+                 enemy_units,
+                 cities,
+                 city_size,
+                 enemy_cities,
+                 other_cities,
+                 unit_columns=None,
+                 city_columns=None):
+        self.unit_types = unit_types
+        self.working_units = working_units
+        self.military_units = military_units
+        self.enemy_units = enemy_units
+        self.cities = cities
+        self.city_size = city_size
+        self.enemy_cities = enemy_cities
+        self.other_cities = other_cities
+        self.unit_columns = unit_columns
+        self.city_columns = city_columns
+
+    @classmethod
+    def from_observations(cls, obs: dict, player_id: int):
+        units = entity_columns(obs['unit'], UNIT_COLUMNS)
+        cities = entity_columns(obs['city'], CITY_COLUMNS)
+        at_war = war_table(
+            obs['dipl'], np.concatenate((units['owner'], cities['owner'])))
+
+        own_units = units['owner'] == player_id
+        working_units = own_units & (units['type_attack_strength'] == 0)
+        # Counter keeps the order in which the types first appear.
+        unit_types = dict(
+            Counter(
+                compress(map(itemgetter('type_rule_name'),
+                             obs['unit'].values()), own_units)))
+
+        # Only our cities have a granary in the observations.
+        own_cities = cities['granary_size'] >= 0
+        # Cities in the fog of war are not counted.
+        seen_cities = ~own_cities
+        tiles = (cities['x'][seen_cities], cities['y'][seen_cities])
+        seen_cities[seen_cities] = (obs['map']['status'][tiles] >=
+                                    TILE_KNOWN_SEEN)
+        enemy_cities = seen_cities & at_war[cities['owner']]
+
+        return cls(unit_types=unit_types,
+                   working_units=int(np.count_nonzero(working_units)),
+                   military_units=int(
+                       np.count_nonzero(own_units & ~working_units)),
+                   enemy_units=int(np.count_nonzero(at_war[units['owner']])),
+                   cities=int(np.count_nonzero(own_cities)),
+                   city_size=int(cities['size'][own_cities].sum()),
+                   enemy_cities=int(np.count_nonzero(enemy_cities)),
+                   other_cities=int(
+                       np.count_nonzero(seen_cities & ~enemy_cities)),
+                   unit_columns=units,
+                   city_columns=cities)
+
+    @property
+    def units(self) -> int:
+        return self.working_units + self.military_units
+
+    @property
+    def war_state(self) -> str:
+        # handwritten conditions, change it later.
+        if (self.enemy_units > self.military_units / 5
+                and self.enemy_cities < self.enemy_units):
+            return "We are under attack."
+        if self.enemy_cities >= 3 and self.enemy_units < self.military_units:
+            return "We are attacking other players."
+        if self.enemy_units == 0 and self.enemy_cities < 4:
+            return "We are in peace."
+        return "We are roughly safe."
+
+    def to_dict(self) -> dict:
+        return {
+            'unit_types': dict(self.unit_types),
+            'units': self.units,
+            'working_units': self.working_units,
+            'military_units': self.military_units,
+            'enemy_units': self.enemy_units,
+            'cities': self.cities,
+            'city_size': self.city_size,
+            'enemy_cities': self.enemy_cities,
+            'other_cities': self.other_cities,
+            'war_state': self.war_state
+        }
+
+    def to_prompt(self) -> str:
+        unit_spec_prompt = (f"We have {self.units} units: " + ", ".join(
+            f"{count} {name}" for name, count in self.unit_types.items()))
+        return " ".join([
+            unit_spec_prompt, f"and we can see {self.enemy_units} enemy units.",
+            f"We have {self.cities} cities of total size {self.city_size}.",
+            f"We can see {self.enemy_cities} enemy cities, ",
+            f"and {self.other_cities} other cities.", self.war_state
+        ])
+
+
+def unit_test():
+    status = np.full((4, 4), TILE_KNOWN_SEEN)
+    status[3, 3] = 1
+    obs = {
+        'dipl': {
+            0: {'diplomatic_state': 7},
+            1: {'diplomatic_state': DS_WAR},
+            2: {'diplomatic_state': 2}
+        },
+        'unit': {
+            10: {'owner': 0, 'type_rule_name': 'Workers',
+                 'type_attack_strength': 0, 'x': 0, 'y': 0},
+            11: {'owner': 0, 'type_rule_name': 'Warriors',
+                 'type_attack_strength': 1, 'x': 0, 'y': 1},
+            12: {'owner': 0, 'type_rule_name': 'Workers',
+                 'type_attack_strength': 0, 'x': 1, 'y': 1},
+            13: {'owner': 1, 'type_rule_name': 'Archers',
+                 'type_attack_strength': 3, 'x': 2, 'y': 2}
+        },
+        'city': {
+            20: {'owner': 0, 'x': 0, 'y': 0, 'size': 3, 'granary_size': 20},
+            21: {'owner': 1, 'x': 2, 'y': 3, 'size': 2, 'granary_size': -1},
+            22: {'owner': 1, 'x': 3, 'y': 3, 'size': 1, 'granary_size': -1},
+            23: {'owner': 2, 'x': 1, 'y': 2, 'size': 4, 'granary_size': -1}
+        },
+        'map': {'status': status}
+    }
+    summary = AdvisorSummary.from_observations(obs, 0)
+    assert summary.unit_types == {'Workers': 2, 'Warriors': 1}
+    assert (summary.enemy_units, summary.enemy_cities,
+            summary.other_cities) == (1, 1, 1)
+    assert summary.to_prompt() == (
+        "We have 3 units: 2 Workers, 1 Warriors and we can see 1 enemy "
+        "units. We have 1 cities of total size 3. We can see 1 enemy "
+        "cities,  and 1 other cities. We are roughly safe.")
+
+    empty = AdvisorSummary.from_observations(
+        {'dipl': {}, 'unit': {}, 'city': {}, 'map': {'status': status}}, 0)
+    assert empty.to_prompt() == (
+        "We have 0 units:  and we can see 0 enemy units. We have 0 cities "
+        "of total size 0. We can see 0 enemy cities,  and 0 other cities. "
+        "We are in peace.")
+
+
+if __name__ == '__main__':
+    unit_test()
@@ -0,0 +1,43 @@
+import os
+import threading
+
+from config import (LLM_BACKEND, LLM_RECORD_PATH, MOCK_LLM_LATENCY,
+                    MOCK_LLM_ERROR_RATE, MOCK_LLM_REPLAY_PATH, MOCK_LLM_SEED)
+from .base_backend import LLMBackend
+from .mock_backend import MockBackend
+
+_backends = {}
+_backends_lock = threading.Lock()
+
+
+def create_backend(name: str) -> LLMBackend:
+    if name == 'azure':
+        # Imported here, so that the mock runs without pinecone installed.
+        from .azure_backend import AzureBackend
+        return AzureBackend(record_path=LLM_RECORD_PATH)
+    if name == 'mock':
+        return MockBackend(latency=MOCK_LLM_LATENCY,
+                           error_rate=MOCK_LLM_ERROR_RATE,
+                           replay_path=MOCK_LLM_REPLAY_PATH,
+                           seed=MOCK_LLM_SEED,
+                           record_path=LLM_RECORD_PATH)
+    raise ValueError(f'Unknown LLM backend: {name}')
+
+
+def get_backend(name: str = None) -> LLMBackend:
+    """
+    Return the process-wide backend called `name`, by default the
+    LLM_BACKEND of config.py, overridden by the LLM_BACKEND environment
+    variable.
+    """
+    name = name or os.environ.get('LLM_BACKEND', LLM_BACKEND)
+    with _backends_lock:
+        if name not in _backends:
+            _backends[name] = create_backend(name)
+    return _backends[name]
+
+
+def set_backend(backend: LLMBackend):
+    """Serve `backend` for its name, e.g. a mock with custom settings."""
+    with _backends_lock:
+        _backends[backend.name] = backend
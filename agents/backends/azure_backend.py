@@ -0,0 +1,196 @@
+# Copyright (C) 2023  The CivRealm project
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import threading
+import contextlib
+import contextvars
+
+import openai
+import aiohttp
+import pinecone
+import requests
+
+from langchain.chat_models import AzureChatOpenAI
+from langchain.embeddings.openai import OpenAIEmbeddings
+from langchain.vectorstores import Pinecone
+from langchain.llms import AzureOpenAI
+
+from .base_backend import LLMBackend
+
+
+class AzureBackend(LLMBackend):
+    """
+    Azure OpenAI deployments and the Pinecone index, configured by the
+    environment variables OPENAI_API_TYPE, OPENAI_API_VERSION,
+    OPENAI_API_BASE, OPENAI_API_KEY, DEPLOYMENT_NAME, MY_PINECONE_API_KEY and
+    MY_PINECONE_ENV.
+    """
+    name = 'azure'
+
+    def __init__(self, record_path: str = None):
+        super().__init__(record_path)
+        assert os.environ['OPENAI_API_TYPE'] == 'azure'
+        openai.api_type = os.environ["OPENAI_API_TYPE"]
+        openai.api_version = os.environ["OPENAI_API_VERSION"]
+        openai.api_base = os.environ["OPENAI_API_BASE"]
+        openai.api_key = os.environ["OPENAI_API_KEY"]
+        self.deployment_name = os.environ['DEPLOYMENT_NAME']
+
+        self._pinecone_ready = False
+        self._pinecone_lock = threading.Lock()
+
+        # The HTTP response of the last request of each thread, to close
+        # the streams that are not read to the end.
+        self._last_response = threading.local()
+        openai.requestssession = self.requests_session
+        # Same for the asynchronous streams, in the context of each request.
+        self._last_aresponse = contextvars.ContextVar('last_aresponse',
+                                                      default=None)
+
+    def requests_session(self) -> requests.Session:
+        """The session of openai in a thread, as openai makes it."""
+        session = requests.Session()
+        if openai.proxy:
+            session.proxies = (openai.proxy if isinstance(openai.proxy, dict)
+                               else {
+                                   'http': openai.proxy,
+                                   'https': openai.proxy
+                               })
+        session.mount(
+            "https://",
+            requests.adapters.HTTPAdapter(
+                max_retries=openai.api_requestor.MAX_CONNECTION_RETRIES))
+        session.hooks['response'].append(self.keep_response)
+        return session
+
+    def keep_response(self, response, *args, **kwargs):
+        self._last_response.response = response
+
+    def aiohttp_session(self) -> aiohttp.ClientSession:
+        """A session of openai in an event loop."""
+        trace_config = aiohttp.TraceConfig()
+        trace_config.on_request_end.append(self.keep_aresponse)
+        return aiohttp.ClientSession(trace_configs=[trace_config])
+
+    async def keep_aresponse(self, session, trace_config_ctx, params):
+        responses = self._last_aresponse.get()
+        if responses is not None:
+            responses.append(params.response)
+
+    @contextlib.asynccontextmanager
+    async def llm_session(self):
+        """
+        Share one aiohttp session, and its connections, between the
+        asynchronous requests made inside, instead of the new session
+        openai opens for each of them.
+        """
+        session = self.aiohttp_session()
+        token = openai.aiosession.set(session)
+        try:
+            yield
+        finally:
+            openai.aiosession.reset(token)
+            await session.close()
+
+    def create(self, request, stream=False, **kwargs):
+        assert openai.api_type == 'azure'
+        if not stream:
+            return openai.ChatCompletion.create(**request, **kwargs)
+        chunks = openai.ChatCompletion.create(**request, stream=True, **kwargs)
+        return self.stream(chunks, self._last_response.response)
+
+    async def acreate(self, request, stream=False, **kwargs):
+        assert openai.api_type == 'azure'
+        if not stream:
+            return await openai.ChatCompletion.acreate(**request, **kwargs)
+        # Outside of llm_session, open a session for the stream alone, and
+        # close it with the stream.
+        own_session = None
+        if openai.aiosession.get() is None:
+            own_session = self.aiohttp_session()
+        session_token = (openai.aiosession.set(own_session)
+                         if own_session is not None else None)
+        responses = []
+        responses_token = self._last_aresponse.set(responses)
+        try:
+            chunks = await openai.ChatCompletion.acreate(**request,
+                                                         stream=True,
+                                                         **kwargs)
+        except BaseException:
+            if own_session is not None:
+                await own_session.close()
+            raise
+        finally:
+            self._last_aresponse.reset(responses_token)
+            if session_token is not None:
+                openai.aiosession.reset(session_token)
+        return self.astream(chunks, responses[-1], own_session)
+
+    @staticmethod
+    def stream(chunks, response):
+        """
+        The chunks of a streamed completion. Closing the stream before its
+        end closes the HTTP response, which openai leaves open.
+        """
+        try:
+            yield from chunks
+        finally:
+            chunks.close()
+            response.close()
+
+    @staticmethod
+    async def astream(chunks, response, session=None):
+        """
+        Asynchronous version of `stream`, also closing `session` if the
+        stream has one of its own.
+        """
+        try:
+            async for chunk in chunks:
+                yield chunk
+        finally:
+            await chunks.aclose()
+            response.close()
+            if session is not None:
+                await session.close()
+
+    def chat_model(self, callbacks=None, temperature=0.7):
+        return AzureChatOpenAI(openai_api_base=openai.api_base,
+                               openai_api_version=openai.api_version,
+                               openai_api_key=openai.api_key,
+                               openai_api_type=openai.api_type,
+                               deployment_name=self.deployment_name,
+                               temperature=temperature,
+                               callbacks=callbacks)
+
+    def completion_model(self, model, callbacks=None):
+        return AzureOpenAI(deployment_name=self.deployment_name,
+                           model_name=model,
+                           callbacks=callbacks)
+
+    def embedding_model(self):
+        # Azure deployments embed at most 16 inputs per request.
+        return OpenAIEmbeddings(model="text-embedding-ada-002",
+                                chunk_size=16)
+
+    def vector_index(self, index_name, embedding=None):
+        with self._pinecone_lock:
+            if not self._pinecone_ready:
+                pinecone.init(api_key=os.environ["MY_PINECONE_API_KEY"],
+                              environment=os.environ["MY_PINECONE_ENV"])
+                self._pinecone_ready = True
+        return Pinecone.from_existing_index(
+            index_name=index_name,
+            embedding=embedding or self.embedding_model())
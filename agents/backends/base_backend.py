@@ -0,0 +1,133 @@
+# Copyright (C) 2023  The CivRealm project
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import threading
+import contextlib
+from abc import ABC, abstractmethod
+
+from langchain.chains.question_answering import load_qa_chain
+
+from ..civ_autogpt.utils import ResponseCache
+
+
+class LLMBackend(ABC):
+    """
+    Everything a worker needs from the outside world: chat completions,
+    the langchain models used for memory and question answering, and the
+    vector index of the manual. The QA chain does not depend on the actor,
+    and is shared by all the workers of the backend, as is the index,
+    through the retrieval service (see agents/retrieval).
+
+    If `record_path` is given, every chat completion that is not streamed
+    is appended to that JSONL file, so that a game can be replayed offline
+    by the mock backend.
+    """
+    name = 'base'
+
+    def __init__(self, record_path: str = None):
+        self.record_path = record_path
+        self.deployment_name = None
+        self._record_lock = threading.Lock()
+        self._shared = {}
+        self._shared_lock = threading.Lock()
+
+    @staticmethod
+    def replay_key(request) -> str:
+        """Key of a recorded request, independent of the deployment."""
+        return ResponseCache.make_key(model=request['model'],
+                                      messages=request['messages'])
+
+    def record(self, request, response):
+        if self.record_path is None:
+            return
+        line = json.dumps({
+            'key': self.replay_key(request),
+            'response': response
+        },
+                          ensure_ascii=False,
+                          default=str)
+        with self._record_lock:
+            with open(self.record_path, 'a', encoding='utf-8') as f:
+                f.write(line + '\n')
+
+    def chat_completion(self, request, stream=False, **kwargs):
+        """
+        Chat completion of `request`, the keyword arguments of
+        `openai.ChatCompletion.create`. With `stream`, a generator of chunks,
+        to close when no more chunks are needed.
+        """
+        response = self.create(request, stream=stream, **kwargs)
+        if not stream:
+            self.record(request, response)
+        return response
+
+    async def achat_completion(self, request, stream=False, **kwargs):
+        """ Asynchronous version of `chat_completion`. """
+        response = await self.acreate(request, stream=stream, **kwargs)
+        if not stream:
+            self.record(request, response)
+        return response
+
+    def _shared_client(self, key, factory):
+        with self._shared_lock:
+            if key not in self._shared:
+                self._shared[key] = factory()
+            return self._shared[key]
+
+    def shared_qa_chain(self, model):
+        """
+        The QA chain on the manual for `model`, shared by the workers, which
+        pass their own callbacks when they run it.
+        """
+        return self._shared_client(
+            ('qa_chain', model), lambda: load_qa_chain(
+                self.completion_model(model), chain_type="stuff"))
+
+    @contextlib.asynccontextmanager
+    async def llm_session(self):
+        """
+        Clients shared by the asynchronous requests made inside, in one
+        event loop, e.g. the HTTP connections to the LLM.
+        """
+        yield
+
+    @abstractmethod
+    def create(self, request, stream=False, **kwargs):
+        pass
+
+    @abstractmethod
+    async def acreate(self, request, stream=False, **kwargs):
+        pass
+
+    @abstractmethod
+    def chat_model(self, callbacks=None, temperature=0.7):
+        """The langchain chat model summarizing the memory of workers."""
+        pass
+
+    @abstractmethod
+    def completion_model(self, model, callbacks=None):
+        """The langchain model answering questions on the manual."""
+        pass
+
+    @abstractmethod
+    def embedding_model(self):
+        """The langchain embeddings of the queries on the manual."""
+        pass
+
+    @abstractmethod
+    def vector_index(self, index_name, embedding=None):
+        """The vector store holding the manual, queried with `embedding`."""
+        pass
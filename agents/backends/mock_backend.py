@@ -0,0 +1,322 @@
+# Copyright (C) 2023  The CivRealm project
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import re
+import ast
+import copy
+import hashlib
+import json
+import time
+import random
+import asyncio
+import threading
+
+import openai
+from langchain.chat_models.fake import FakeListChatModel
+from langchain.embeddings.base import Embeddings
+from langchain.llms.fake import FakeListLLM
+from langchain.schema import Document
+
+from civrealm.freeciv.utils.freeciv_logging import fc_logger
+
+from .base_backend import LLMBackend
+
+AVAILABLE_ACTIONS_PATTERN = re.compile(
+    r"available action(?:s are| list is)\s*(\[[^\]]*\])", re.IGNORECASE)
+ACTOR_KEY_PATTERN = re.compile(r"^\[([^\]\n]+)\]", re.MULTILINE)
+
+MOCK_SUGGESTION = ("Keep exploring with the units, build new cities with " +
+                   "the Settlers and protect the cities with military units.")
+MOCK_SUMMARY = "The entity has been following the advice of the advisor."
+MOCK_ANSWER = "The manual has no more information about it"
+
+
+def parse_action_list(text):
+    """Parse the action list of a prompt, quoted or not."""
+    try:
+        actions = ast.literal_eval(text)
+    except (ValueError, SyntaxError):
+        actions = [x.strip().strip('\'"') for x in text[1:-1].split(',')]
+    return [str(action) for action in actions if str(action)]
+
+
+def count_words(text):
+    return len(text.split())
+
+
+class MockChatModel(FakeListChatModel):
+    """Chat model summarizing nothing, which counts tokens as words."""
+    def get_token_ids(self, text):
+        return list(range(count_words(text)))
+
+
+class MockLLM(FakeListLLM):
+    """Completion model answering nothing, which counts tokens as words."""
+    def get_token_ids(self, text):
+        return list(range(count_words(text)))
+
+
+class MockEmbeddings(Embeddings):
+    """Deterministic embeddings of a hash of the text."""
+    size = 8
+
+    def embed_query(self, text):
+        digest = hashlib.md5(text.encode('utf-8')).digest()
+        return [byte / 255 for byte in digest[:self.size]]
+
+    def embed_documents(self, texts):
+        return [self.embed_query(text) for text in texts]
+
+
+class MockIndex:
+    """Vector store returning the same placeholder documents for any query."""
+    def __init__(self, embedding=None):
+        self.embedding = embedding or MockEmbeddings()
+
+    def similarity_search_by_vector(self, embedding, k=4, **kwargs):
+        return [
+            Document(page_content=f'Manual entry {i} related to: ' +
+                     ' '.join(f'{x:.2f}' for x in embedding[:2]))
+            for i in range(k)
+        ]
+
+    def similarity_search_by_vector_with_score(self, embedding, k=4,
+                                               **kwargs):
+        return [(document, 1.0)
+                for document in self.similarity_search_by_vector(
+                    embedding, k)]
+
+    def similarity_search(self, query, k=4, **kwargs):
+        return self.similarity_search_by_vector(
+            self.embedding.embed_query(query), k)
+
+    def similarity_search_with_score(self, query, k=4, **kwargs):
+        return self.similarity_search_by_vector_with_score(
+            self.embedding.embed_query(query), k)
+
+
+class MockBackend(LLMBackend):
+    """
+    In-process backend answering without the network, for benchmarks.
+
+    A completion takes a random time drawn from `latency`, a tuple of a
+    distribution name and its parameters in seconds: ('constant', t),
+    ('uniform', a, b), ('normal', mu, sigma) truncated at 0, or
+    ('lognormal', mu, sigma) of the logarithm. A request fails with
+    probability `error_rate`.
+
+    Requests recorded in the JSONL file `replay_path` (see `record_path` of
+    `LLMBackend`) are answered with the recorded response. Others get a
+    valid command: a `batchDecision` when the prompt lists actor keys, a
+    `finalDecision` on a random available action when it lists available
+    actions, and a `suggestion` otherwise.
+    """
+    name = 'mock'
+
+    def __init__(self,
+                 latency=('constant', 0.0),
+                 error_rate: float = 0.0,
+                 replay_path: str = None,
+                 seed: int = None,
+                 record_path: str = None):
+        super().__init__(record_path)
+        self.latency = tuple(latency)
+        self.error_rate = error_rate
+        self.deployment_name = 'mock'
+        self.replay_path = replay_path
+        self.replayed = 0
+        self.requests = 0
+
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self._recorded = {}
+        if replay_path is not None:
+            self.load_replay(replay_path)
+
+    def load_replay(self, replay_path):
+        with open(replay_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                if line.strip():
+                    entry = json.loads(line)
+                    self._recorded[entry['key']] = entry['response']
+        fc_logger.info(
+            f'Mock backend loaded {len(self._recorded)} recorded responses.')
+
+    def sample_latency(self) -> float:
+        name, *params = self.latency
+        with self._lock:
+            if name == 'constant':
+                return params[0]
+            if name == 'uniform':
+                return self._rng.uniform(*params)
+            if name == 'normal':
+                return max(0.0, self._rng.gauss(*params))
+            if name == 'lognormal':
+                return self._rng.lognormvariate(*params)
+        raise ValueError(f'Unknown latency distribution: {name}')
+
+    def sample_error(self) -> bool:
+        with self._lock:
+            return self._rng.random() < self.error_rate
+
+    def choose(self, actions):
+        with self._lock:
+            return self._rng.choice(actions)
+
+    def command_content(self, prompt):
+        """A reply in the json format of the prompts to `prompt`."""
+        thoughts = {
+            'thought': 'This is a reply of the mock backend.',
+            'reasoning': 'No model was queried.',
+            'plan': 'Choose at random among the available actions.'
+        }
+        sections = ACTOR_KEY_PATTERN.split(prompt)
+        decisions = []
+        for actor_key, section in zip(sections[1::2], sections[2::2]):
+            match = AVAILABLE_ACTIONS_PATTERN.search(section)
+            actions = parse_action_list(match.group(1)) if match else []
+            if actions:
+                decisions.append({
+                    'actor': actor_key,
+                    'action': self.choose(actions)
+                })
+
+        match = AVAILABLE_ACTIONS_PATTERN.search(prompt)
+        actions = parse_action_list(match.group(1)) if match else []
+        if decisions:
+            command = {
+                'name': 'batchDecision',
+                'input': {
+                    'decisions': decisions
+                }
+            }
+        elif actions:
+            command = {
+                'name': 'finalDecision',
+                'input': {
+                    'action': self.choose(actions)
+                }
+            }
+        else:
+            command = {
+                'name': 'suggestion',
+                'input': {
+                    'action': MOCK_SUGGESTION,
+                    'suggestion': MOCK_SUGGESTION
+                }
+            }
+        return json.dumps({'thoughts': thoughts, 'command': command})
+
+    def respond(self, request):
+        """The response of `request`, without latency."""
+        key = self.replay_key(request) if self._recorded else None
+        with self._lock:
+            self.requests += 1
+            recorded = self._recorded.get(key)
+            if recorded is not None:
+                self.replayed += 1
+        if recorded is not None:
+            return copy.deepcopy(recorded)
+
+        prompt = next((message['content']
+                       for message in reversed(request['messages'])
+                       if message['role'] == 'user'), '')
+        content = self.command_content(prompt)
+        prompt_tokens = sum(
+            count_words(message['content'])
+            for message in request['messages'])
+        completion_tokens = count_words(content)
+        return {
+            'object': 'chat.completion',
+            'model': request['model'],
+            'choices': [{
+                'index': 0,
+                'finish_reason': 'stop',
+                'message': {
+                    'role': 'assistant',
+                    'content': content
+                }
+            }],
+            'usage': {
+                'prompt_tokens': prompt_tokens,
+                'completion_tokens': completion_tokens,
+                'total_tokens': prompt_tokens + completion_tokens
+            }
+        }
+
+    @staticmethod
+    def stream_chunks(response, chunk_size=16):
+        content = response['choices'][0]['message']['content']
+        for index in range(0, len(content), chunk_size):
+            yield {
+                'choices': [{
+                    'index': 0,
+                    'delta': {
+                        'content': content[index:index + chunk_size]
+                    }
+                }]
+            }
+
+    def create(self, request, stream=False, **kwargs):
+        latency = self.sample_latency()
+        if self.sample_error():
+            time.sleep(latency)
+            raise openai.error.ServiceUnavailableError(
+                'Mock backend error.')
+        response = self.respond(request)
+        if not stream:
+            time.sleep(latency)
+            return response
+        return self._stream(response, latency)
+
+    def _stream(self, response, latency):
+        chunks = list(self.stream_chunks(response))
+        for chunk in chunks:
+            time.sleep(latency / len(chunks))
+            yield chunk
+
+    async def acreate(self, request, stream=False, **kwargs):
+        latency = self.sample_latency()
+        if self.sample_error():
+            await asyncio.sleep(latency)
+            raise openai.error.ServiceUnavailableError(
+                'Mock backend error.')
+        response = self.respond(request)
+        if not stream:
+            await asyncio.sleep(latency)
+            return response
+        return self._astream(response, latency)
+
+    async def _astream(self, response, latency):
+        chunks = list(self.stream_chunks(response))
+        for chunk in chunks:
+            await asyncio.sleep(latency / len(chunks))
+            yield chunk
+
+    def chat_model(self, callbacks=None, temperature=0.7):
+        return MockChatModel(responses=[MOCK_SUMMARY], callbacks=callbacks)
+
+    def completion_model(self, model, callbacks=None):
+        return MockLLM(responses=[MOCK_ANSWER], callbacks=callbacks)
+
+    def embedding_model(self):
+        return MockEmbeddings()
+
+    def vector_index(self, index_name, embedding=None):
+        return MockIndex(embedding)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {'requests': self.requests, 'replayed': self.replayed}
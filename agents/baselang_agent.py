@@ -15,42 +15,95 @@
 
 import os
 import time
-import threading
+import asyncio
 
+from civrealm.freeciv.utils.freeciv_logging import fc_logger
 from civrealm.freeciv.utils.language_agent_utility import make_action_list_readable, get_action_from_readable_name
 
 from .language_agent import LanguageAgent
-from .workers import AzureGPTWorker
+from .workers import AzureGPTWorker, BatchWorker, WorkerPool
+from .backends import get_backend
+from .civ_autogpt.utils import get_response_cache, get_request_scheduler, get_tracer
+from .retrieval import get_answer_cache
+from .obs_encoders import make_obs_encoder
 from .utils import print_current, print_action
+from config import LLM_CONCURRENCY_LIMIT, BATCH_DECISIONS_DEFAULT, BATCH_MAX_SIZE, OBS_DELTA_ENCODING
 
 # Wrong Interpretation of action names. Goto Yexin to fix it.
 
 
 class BaseLangAgent(LanguageAgent):
-    def __init__(self, **kwargs):
+    # Templates of the instruction and task prompts of the batch worker.
+    batch_instruction_prompt = "batch_instruction_prompt"
+    batch_task_prompt = "batch_task_prompt"
+
+    def __init__(self,
+                 max_concurrency: int = LLM_CONCURRENCY_LIMIT,
+                 batch_decisions: bool = BATCH_DECISIONS_DEFAULT,
+                 obs_encoder: str = None,
+                 obs_delta_encoding: bool = OBS_DELTA_ENCODING,
+                 **kwargs):
         super().__init__(**kwargs)
+        self.max_concurrency = max_concurrency
+        self.batch_decisions = batch_decisions
+        self.obs_encoder = make_obs_encoder(obs_encoder)
+        self.obs_delta_encoding = obs_delta_encoding
+        # Actions rejected by the game, by actor, while their actors are
+        # decided again.
+        self.rejected_actions = {}
+        self.batch_worker = None
         self.dialogue_dir = os.path.join(os.getcwd(), 'saved_dialogues/')
         if not os.path.exists(self.dialogue_dir):
             os.makedirs(self.dialogue_dir)
 
     def initialize_workers(self):
         self.workers = {}
+        self.worker_pool = WorkerPool()
 
     def add_entity(self, entity_type, entity_id):
-        self.workers[(entity_type,
-                      entity_id)] = AzureGPTWorker(ctrl_type=entity_type,
-                                                   actor_id=entity_id)
+        self.workers[(entity_type, entity_id)] = self.worker_pool.acquire(
+            AzureGPTWorker, ctrl_type=entity_type, actor_id=entity_id)
 
     def remove_entity(self, entity_type, entity_id):
-        del self.workers[(entity_type, entity_id)]
+        self.worker_pool.release(self.workers.pop((entity_type, entity_id)))
+        self.decision_cache.forget((entity_type, entity_id))
 
     def process_observations_and_info(self, observations, info):
         self.observations = observations
         self.info = info
 
-    def get_obs_input_prompt(self, ctrl_type, actor_name, actor_dict,
-                             available_actions):
-        current_unit_obs = actor_dict['observations']['minimap']
+    def encode_observations(self, actor_dict, keys, worker=None):
+        """
+        Encode the observations `keys` of an actor. With the worker of the
+        actor, each observation is encoded as its changes since the one last
+        sent to the worker when that is shorter, and the observations are
+        kept until the worker sends them.
+        """
+        observations = {key: actor_dict['observations'][key] for key in keys}
+        previous = None
+        if worker is not None and self.obs_delta_encoding:
+            previous = worker.last_observation
+            worker.pending_observation = observations
+
+        encoded = []
+        for key, observation in observations.items():
+            full = self.obs_encoder.encode(observation)
+            delta = None
+            if previous is not None and key in previous:
+                delta = self.obs_encoder.encode_delta(previous[key],
+                                                      observation)
+            encoded.append(full if delta is None or len(delta) >= len(full)
+                           else delta)
+        return encoded
+
+    def get_obs_input_prompt(self,
+                             ctrl_type,
+                             actor_name,
+                             actor_dict,
+                             available_actions,
+                             worker=None):
+        current_unit_obs, = self.encode_observations(actor_dict,
+                                                     ['minimap'], worker)
         # if ctrl_type == "city":
         #     available_actions += ["'keep activity'"]
         if ctrl_type == "city":
@@ -64,12 +117,8 @@ class BaseLangAgent(LanguageAgent):
                           if system_message else "") + system_message
         return system_message + prompt
 
-    def make_single_decision(self, ctrl_type, actor_id, actor_dict):
-        worker = self.workers[(ctrl_type, actor_id)]
-        actor_name = actor_dict['name']
-
+    def get_available_actions(self, actor_dict):
         available_actions = actor_dict['available_actions']
-        producing = actor_dict['observations'].get('producing', 'NOTHING')
 
         if 'keep activity' in available_actions:
             available_actions.remove("keep activity")
@@ -77,33 +126,300 @@ class BaseLangAgent(LanguageAgent):
         if 'cancel order' in available_actions:
             available_actions.remove("cancel order")
 
-        obs_input_prompt = self.get_obs_input_prompt(ctrl_type, actor_name,
+        return available_actions
+
+    def add_rejection_note(self, prompt, ctrl_type, actor_id,
+                           prompt_handler):
+        """Tell an actor decided again which of its actions was rejected."""
+        rejected_action = self.rejected_actions.get((ctrl_type, actor_id))
+        if rejected_action is None:
+            return prompt
+        return prompt.rstrip() + ' ' + prompt_handler.action_rejected(
+            rejected_action=rejected_action)
+
+    def prepare_single_decision(self, ctrl_type, actor_id, actor_dict):
+        """
+        Prepare the worker, the input prompt and the available actions for
+        deciding on one actor.
+        """
+        worker = self.workers[(ctrl_type, actor_id)]
+        actor_name = actor_dict['name']
+
+        available_actions = self.get_available_actions(actor_dict)
+
+        full_prompt = None
+        if self.obs_delta_encoding and worker.last_observation is not None:
+            # Sent instead if the dialogue is summarized before the prompt.
+            full_prompt = self.get_obs_input_prompt(ctrl_type, actor_name,
+                                                    actor_dict,
+                                                    list(available_actions))
+        obs_input_prompt = self.get_obs_input_prompt(ctrl_type,
+                                                     actor_name,
                                                      actor_dict,
-                                                     available_actions)
+                                                     available_actions,
+                                                     worker=worker)
+        worker.full_prompt = None
+        if full_prompt is not None and full_prompt != obs_input_prompt:
+            worker.full_prompt = (obs_input_prompt, full_prompt)
+        obs_input_prompt = self.add_rejection_note(obs_input_prompt,
+                                                   ctrl_type, actor_id,
+                                                   worker.prompt_handler)
         print_current(f'Current {ctrl_type}: {actor_name}')
-        exec_action_name = worker.choose_action(obs_input_prompt,
-                                                available_actions)
+        return worker, obs_input_prompt, available_actions
+
+    def queue_action(self, ctrl_type, actor_id, actor_dict, exec_action_name):
+        actor_name = actor_dict['name']
+        producing = actor_dict['observations'].get('producing', 'NOTHING')
+
         print_action(f'Action chosen for {actor_name}:', exec_action_name)
         # exec_action_name = get_action_from_readable_name(exec_action_name)
         if (exec_action_name and exec_action_name != "produce " + producing):
             self.chosen_actions.put((ctrl_type, actor_id, exec_action_name))
 
+    def commit_single_decision(self, ctrl_type, actor_id, actor_dict,
+                               exec_action_name):
+        """Queue the chosen action and save the dialogue of the worker."""
+        worker = self.workers[(ctrl_type, actor_id)]
+        self.queue_action(ctrl_type, actor_id, actor_dict, exec_action_name)
+        # A random fallback is not a decision worth reusing.
+        if not worker.fell_back:
+            self.decision_cache.record((ctrl_type, actor_id), self.turn)
         worker.save_dialogue_to_file(
             os.path.join(
                 self.dialogue_dir,
                 f"dialogue_T{self.info['turn'] + 1:03d}_{actor_id}_at_{time.strftime('%Y.%m.%d_%H:%M:%S')}.txt"
             ))
 
-    def make_decisions(self):
-        threads = []
+    def make_single_decision(self, ctrl_type, actor_id, actor_dict):
+        with get_tracer().span('make_single_decision',
+                               actor=f'{ctrl_type} {actor_id}'):
+            worker, obs_input_prompt, available_actions = self.prepare_single_decision(
+                ctrl_type, actor_id, actor_dict)
+            exec_action_name = worker.choose_action(obs_input_prompt,
+                                                    available_actions)
+            self.commit_single_decision(ctrl_type, actor_id, actor_dict,
+                                        exec_action_name)
+
+    async def amake_single_decision(self, ctrl_type, actor_id, actor_dict,
+                                    semaphore):
+        async with semaphore:
+            with get_tracer().span('make_single_decision',
+                                   actor=f'{ctrl_type} {actor_id}'):
+                worker, obs_input_prompt, available_actions = self.prepare_single_decision(
+                    ctrl_type, actor_id, actor_dict)
+                exec_action_name = await worker.achoose_action(
+                    obs_input_prompt, available_actions)
+                self.commit_single_decision(ctrl_type, actor_id, actor_dict,
+                                            exec_action_name)
+
+    def get_batch_worker(self):
+        if self.batch_worker is None:
+            self.batch_worker = BatchWorker(
+                max_batch_size=BATCH_MAX_SIZE,
+                instruction_prompt=self.batch_instruction_prompt,
+                task_prompt=self.batch_task_prompt,
+                ctrl_type="batch")
+        return self.batch_worker
+
+    def get_batch_actor_prompt(self, ctrl_type, actor_key, actor_dict,
+                               available_actions):
+        """
+        Observation prompt of one actor inside a batch.
+
+        Returns the prompt and the actions the actor can choose from.
+        """
+        actor_name = actor_dict['name']
+        current_unit_obs = self.obs_encoder.encode(
+            actor_dict['observations']['minimap'])
+        if ctrl_type == "city":
+            producing = actor_dict['observations'].get('producing', "NOTHING")
+            prompt = f'[{actor_key}] The {ctrl_type} is {actor_name}, observation is {current_unit_obs}. The city is producing {producing}. Its available action list is {available_actions}.'
+        else:
+            prompt = f'[{actor_key}] The {ctrl_type} is {actor_name}, observation is {current_unit_obs}. Its available action list is {available_actions}.'
+        return prompt, available_actions
+
+    def get_batch_input_prompt(self, actor_prompts):
+        system_message = self.info['llm_info'].get("message", "")
+        system_message = ("Game scenario message is: "
+                          if system_message else "") + system_message
+        return (system_message +
+                f'You are controlling the following {len(actor_prompts)} ' +
+                'entities, choose one action for each of them.\n' +
+                "\n".join(actor_prompts))
+
+    async def amake_batch_decisions(self, targets, semaphore):
+        """
+        Decide on `targets` with batched LLM requests.
+
+        Returns the targets left without a valid decision.
+        """
+        batch_worker = self.get_batch_worker()
+        actor_keys, actor_prompts, avail_actions_dict = [], [], {}
+        for ctrl_type, actor_id, actor_dict in targets:
+            actor_key = f"{ctrl_type} {actor_id}"
+            prompt, available_actions = self.get_batch_actor_prompt(
+                ctrl_type, actor_key, actor_dict,
+                self.get_available_actions(actor_dict))
+            prompt = self.add_rejection_note(prompt, ctrl_type, actor_id,
+                                             batch_worker.prompt_handler)
+            actor_keys.append(actor_key)
+            actor_prompts.append(prompt)
+            avail_actions_dict[actor_key] = available_actions
+
+        batches = batch_worker.plan_batches(actor_prompts,
+                                            self.get_batch_input_prompt([]))
+
+        async def decide_batch(batch):
+            async with semaphore:
+                with get_tracer().span('make_batch_decision',
+                                       actors=len(batch)):
+                    return await batch_worker.achoose_batch_actions(
+                        self.get_batch_input_prompt(
+                            [actor_prompts[i] for i in batch]),
+                        {actor_keys[i]: avail_actions_dict[actor_keys[i]]
+                         for i in batch})
+
+        decisions = {}
+        for batch_decisions in await asyncio.gather(
+                *[decide_batch(batch) for batch in batches]):
+            decisions.update(batch_decisions)
+
+        remaining_targets = []
+        for target, actor_key in zip(targets, actor_keys):
+            if actor_key in decisions:
+                self.queue_action(*target, decisions[actor_key])
+                self.decision_cache.record(tuple(target[:2]), self.turn)
+            else:
+                remaining_targets.append(target)
+        fc_logger.info(f'Batched decisions for {len(decisions)} of ' +
+                       f'{len(targets)} actors in {len(batches)} requests.')
+        return remaining_targets
+
+    def decision_targets(self):
+        """Yield `(ctrl_type, actor_id, actor_dict)` of actors to decide on."""
         for ctrl_type in self.info['llm_info'].keys():
             for actor_id, actor_dict in self.info['llm_info'][ctrl_type].items(
             ):
-                thread = threading.Thread(target=self.make_single_decision,
-                                          args=(ctrl_type, actor_id,
-                                                actor_dict))
-                threads.append(thread)
-                thread.start()
-
-        for thread in threads:
-            thread.join()
+                yield ctrl_type, actor_id, actor_dict
+
+    def apply_rules_to_targets(self, targets):
+        """
+        Settle the decisions the rules can take, reuse the decisions of
+        actors whose situation did not change, and return the targets left
+        to the LLM.
+        """
+        remaining_targets = []
+        for ctrl_type, actor_id, actor_dict in targets:
+            available_actions = self.get_available_actions(actor_dict)
+            exec_action_name = self.apply_decision_rules(
+                ctrl_type, actor_id, actor_dict, available_actions)
+            if exec_action_name is None:
+                exec_action_name = self.reuse_decision(
+                    ctrl_type, actor_id, actor_dict, available_actions)
+            if exec_action_name is None:
+                remaining_targets.append((ctrl_type, actor_id, actor_dict))
+            else:
+                self.queue_action(ctrl_type, actor_id, actor_dict,
+                                  exec_action_name)
+        return remaining_targets
+
+    async def amake_decisions(self, targets=None):
+        """
+        Decide on all actors, or on the `(ctrl_type, actor_id, actor_dict)`
+        of `targets`, concurrently, with at most `self.max_concurrency`
+        decisions waiting on the LLM at a time.
+        """
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+        if targets is None:
+            targets = list(self.decision_targets())
+        targets = self.apply_rules_to_targets(targets)
+        if self.batch_decisions and targets:
+            # Actors left undecided by the batches fall back to their own
+            # workers.
+            targets = await self.amake_batch_decisions(targets, semaphore)
+        results = await asyncio.gather(*[
+            self.amake_single_decision(ctrl_type, actor_id, actor_dict,
+                                       semaphore)
+            for ctrl_type, actor_id, actor_dict in targets
+        ],
+                                       return_exceptions=True)
+        for (ctrl_type, actor_id, _), result in zip(targets, results):
+            if isinstance(result, Exception):
+                fc_logger.error(
+                    f'Error when deciding for {ctrl_type} {actor_id}: {repr(result)}'
+                )
+
+    @staticmethod
+    def run_async(coroutine):
+        """
+        Run `coroutine` to completion on a private event loop, with the
+        clients of the LLM backend shared by its requests.
+
+        Unlike `asyncio.run`, the current event loop of the thread is left
+        as it is: civrealm's client keeps its websocket on it, and tornado
+        finds it again through `IOLoop.current()`.
+        """
+        async def run():
+            async with get_backend().llm_session():
+                return await coroutine
+
+        loop = asyncio.new_event_loop()
+        try:
+            return loop.run_until_complete(run())
+        finally:
+            try:
+                pending = asyncio.all_tasks(loop)
+                for task in pending:
+                    task.cancel()
+                if pending:
+                    loop.run_until_complete(
+                        asyncio.gather(*pending, return_exceptions=True))
+                loop.run_until_complete(loop.shutdown_asyncgens())
+                loop.run_until_complete(loop.shutdown_default_executor())
+            finally:
+                loop.close()
+
+    def make_decisions(self):
+        self.run_async(self.amake_decisions())
+        fc_logger.info(f'LLM calls skipped by decision rules in turn ' +
+                       f'{self.turn}: {self.skipped_llm_calls.get(self.turn, 0)}')
+        fc_logger.info(f'Decisions reused in turn {self.turn}: ' +
+                       f'{self.decision_cache.stats(self.turn)}')
+        fc_logger.info(f'LLM response cache: {get_response_cache().stats()}')
+        fc_logger.info(
+            f'LLM request scheduler: {get_request_scheduler().stats()}')
+        fc_logger.info(f'Manual answer cache: {get_answer_cache().stats()}')
+        fc_logger.info(f'Worker pool: {self.worker_pool.stats()}')
+
+
+def unit_test():
+    import pickle
+    from .backends import MockBackend, set_backend
+
+    os.environ['LLM_BACKEND'] = 'mock'
+    set_backend(MockBackend(latency=('constant', 0.0), seed=0))
+    with open('observations_info.txt', 'rb') as f:
+        fixture = pickle.load(f)
+    observations, info = fixture['observations'], fixture['info']
+    info['my_player_id'] = next(iter(observations['unit'].values()))['owner']
+
+    # civrealm's client keeps its websocket on the current event loop of
+    # the thread, deciding must not replace it.
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        agent = BaseLangAgent()
+        agent.process_observations_and_info(observations, info)
+        birth_entities, _ = agent.get_birth_death_entities(info)
+        agent.handle_new_entities(birth_entities)
+        agent.make_decisions()
+        assert not agent.chosen_actions.empty()
+        assert asyncio.get_event_loop() is loop
+        assert not loop.is_closed()
+    finally:
+        asyncio.set_event_loop(None)
+        loop.close()
+
+
+if __name__ == '__main__':
+    unit_test()
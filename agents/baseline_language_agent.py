@@ -22,6 +22,7 @@ from civrealm.freeciv.utils.freeciv_logging import fc_logger
 # from civrealm.freeciv.utils.language_agent_utility import MOVE_NAMES, INVERSE_MOVE_NAMES
 from civrealm.configs import fc_args
 from agents.civ_autogpt import GPTAgent
+from agents.civ_autogpt.utils import CircuitOpenError, get_retry_policy
 
 
 MOVE_NAMES = {'goto_0': 'move_NorthWest', 'goto_1': 'move_North', 'goto_2': 'move_NorthEast',
@@ -67,6 +68,10 @@ class BaselineLanguageAgent(BaseAgent):
                 exec_action_name = self.gpt_agent.process_command(
                     response, input_prompt, current_ctrl_obj_name,
                     avail_action_list)
+            except CircuitOpenError as e:
+                exec_action_name = random.choice(avail_action_list)
+                print('circuit open, randomly choose:', exec_action_name)
+                break
             except Exception as e:
                 fc_logger.error('Error in interact_with_llm_within_time_limit')
                 fc_logger.error(repr(e))
@@ -153,6 +158,7 @@ class BaselineLanguageAgent(BaseAgent):
         if info['turn'] != self.turn:
             self.planned_actor_ids = []
             self.turn = info['turn']
+            get_retry_policy().new_turn()
 
         for actor in actor_dict:
             actor_name = ' '.join(actor.split(' ')[0:-1])
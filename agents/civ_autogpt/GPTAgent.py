@@ -7,7 +7,7 @@ import requests
 import warnings
 
 from civrealm.freeciv.utils.freeciv_logging import fc_logger
-from .utils import num_tokens_from_messages, send_message_to_llama, send_message_to_vicuna, extract_json, send_message_to_llama, TOKEN_LIMIT_TABLE
+from .utils import num_tokens_from_messages, send_message_to_llama, send_message_to_vicuna, extract_json, send_message_to_llama, TOKEN_LIMIT_TABLE, get_response_cache, Dialogue, get_request_scheduler, RateLimitCallbackHandler, get_retry_policy, CircuitOpenError
 from langchain.chat_models import ChatOpenAI, AzureChatOpenAI
 from langchain.chains import ConversationChain
 from langchain.memory import ConversationSummaryBufferMemory
@@ -38,11 +38,14 @@ class GPTAgent:
     """
     def __init__(self, model):
         self.model = model
-        self.dialogue = []
+        self.dialogue = Dialogue(model)
         self.taken_actions_list = []
         self.message = ''
 
         self.openai_api_keys = self.load_openai_keys()
+        self.response_cache = get_response_cache()
+        self.scheduler = get_request_scheduler()
+        self.retry_policy = get_retry_policy()
         self.prompt_handler = BasePromptHandler()
         self.state_prompt = self._load_state_prompt()
         self.task_prompt = self._load_task_prompt()
@@ -50,6 +53,7 @@ class GPTAgent:
         # For Azure OpenAI API only
         self.deployment_name = os.environ['DEPLOYMENT_NAME']
 
+        callbacks = [RateLimitCallbackHandler(self.scheduler, self.model)]
         if os.environ['OPENAI_API_TYPE'] == 'azure':
             self.change_api_base('azure')
             llm = AzureChatOpenAI(openai_api_base=openai.api_base,
@@ -57,14 +61,20 @@ class GPTAgent:
                                   openai_api_key=openai.api_key,
                                   openai_api_type=openai.api_type,
                                   deployment_name=self.deployment_name,
-                                  temperature=0.7)
+                                  temperature=0.7,
+                                  callbacks=callbacks)
             self.chain = load_qa_chain(AzureOpenAI(
-                deployment_name=self.deployment_name, model_name=self.model),
+                deployment_name=self.deployment_name,
+                model_name=self.model,
+                callbacks=callbacks),
                                        chain_type="stuff")
         else:
             self.change_api_base('openai')
-            llm = ChatOpenAI(temperature=0.7, openai_api_key=openai.api_key)
-            self.chain = load_qa_chain(OpenAI(model_name=GPT_MODEL_NAME),
+            llm = ChatOpenAI(temperature=0.7,
+                             openai_api_key=openai.api_key,
+                             callbacks=callbacks)
+            self.chain = load_qa_chain(OpenAI(model_name=GPT_MODEL_NAME,
+                                              callbacks=callbacks),
                                        chain_type="stuff")
 
         self.memory = ConversationSummaryBufferMemory(llm=llm,
@@ -90,17 +100,10 @@ class GPTAgent:
 
     def get_answer(self, query):
         similar_docs = self.get_similiar_docs(query)
-        while True:
-            try:
-                answer = self.chain.run(input_documents=similar_docs,
-                                        question=query)
-                break
-            except Exception as e:
-                print('similiar_docs:', similar_docs)
-                print('query:', query)
-                print(e)
-                self.update_openai_api_key()
-        return answer
+        return self.retry_policy.call(self.chain.run,
+                                      input_documents=similar_docs,
+                                      question=query,
+                                      on_retry=self.update_openai_api_key)
 
     def change_api_base(self, to_type):
         openai.api_type = to_type
@@ -133,7 +136,7 @@ class GPTAgent:
     def load_saved_dialogue(self, load_path=SAVED_DIALOGUE_FILE):
         # print("reading task prompt from {}".format(task_prompt_file))
         with open(load_path, "r") as f:
-            self.dialogue = eval(f.read())
+            self.dialogue = Dialogue(self.model, eval(f.read()))
 
     def save_dialogue_to_file(self, save_path=SAVED_DIALOGUE_FILE):
         with open(save_path, "w", encoding='utf-8') as f:
@@ -288,6 +291,19 @@ class GPTAgent:
 
         fc_logger.debug(f'Querying with dialogue: {self.dialogue}')
 
+        cache_key = self.response_cache.make_key(
+            model=self.model,
+            deployment_id=self.deployment_name,
+            messages=self.dialogue,
+            stop=stop,
+            temperature=temperature,
+            top_p=top_p)
+        response = self.response_cache.get(cache_key)
+        if response is not None:
+            return response
+
+        prompt_tokens = self.dialogue.num_tokens
+        self.scheduler.acquire(prompt_tokens)
         if self.model in ['gpt-3.5-turbo-0301', 'gpt-3.5-turbo']:
             assert openai.api_type == 'openai'
             response = openai.ChatCompletion.create(model=self.model,
@@ -326,6 +342,10 @@ class GPTAgent:
                                                 n=1,
                                                 top_p=top_p)
 
+        if isinstance(response, dict):
+            self.scheduler.settle(prompt_tokens,
+                                  response.get('usage', {}).get('total_tokens'))
+        self.response_cache.put(cache_key, response)
         return response
 
     def update_dialogue(self, chat_content, pop_num=0):
@@ -368,7 +388,7 @@ class GPTAgent:
         If token length exceeds the limit, we will remove the oldest messages.
         """
         # TODO validate that the messages removed are obs and actions
-        while num_tokens_from_messages(self.dialogue, self.model) >= limit:
+        while self.dialogue.num_tokens >= limit:
             temp_message = {}
             user_tag = 0
             if self.dialogue[-1]['role'] == 'user':
@@ -378,15 +398,11 @@ class GPTAgent:
             while len(self.dialogue) >= 3:
                 self.dialogue.pop(-1)
 
-            while True:
-                try:
-                    self.add_user_message_to_dialogue(
-                        'The former chat history can be summarized as: \n' +
-                        self.memory.load_memory_variables({})['history'])
-                    break
-                except Exception as e:
-                    print(e)
-                    self.update_openai_api_key()
+            history = self.retry_policy.call(
+                self.memory.load_memory_variables, {},
+                on_retry=self.update_openai_api_key)['history']
+            self.add_user_message_to_dialogue(
+                'The former chat history can be summarized as: \n' + history)
 
             if user_tag == 1:
                 self.dialogue.append(temp_message)
@@ -394,9 +410,15 @@ class GPTAgent:
 
     def communicate(self, content, parse_choice_tag=False):
         self.add_user_message_to_dialogue(content)
+        attempt = 0
         while True:
+            if not self.retry_policy.allow_request():
+                raise CircuitOpenError('Circuit open, LLM not queried.')
+            queried = False
             try:
                 raw_response = self.query()
+                queried = True
+                self.retry_policy.record_success()
                 self.message = self.parse_response(raw_response)
                 self.dialogue.append(self.message)
 
@@ -417,13 +439,23 @@ class GPTAgent:
                 fc_logger.debug('Error in communicate: ' + str(e))
                 fc_logger.debug('content: ' + content)
                 print(e)
+                # Only errors of the query count as failures of the LLM
+                # endpoint, not replies that cannot be parsed.
+                if queried:
+                    can_retry = self.retry_policy.can_retry(attempt)
+                else:
+                    can_retry = self.retry_policy.should_retry(attempt)
+                if not can_retry:
+                    raise
                 print("retrying...")
+                time.sleep(self.retry_policy.backoff(attempt))
+                attempt += 1
                 continue
         return response
 
     def reset(self):
 
-        self.dialogue = []
+        self.dialogue = Dialogue(self.model)
         self.message = ''
         self.taken_actions_list = []
 
@@ -1,4 +1,10 @@
 from .const import *
-from .num_tokens_from_messages import num_tokens_from_messages
-from .interact_with_llm import send_message_to_llama, send_message_to_vicuna
-from .extract_json import extract_json
\ No newline at end of file
+from .num_tokens_from_messages import num_tokens_from_messages, num_tokens_from_message, num_tokens_from_string, get_encoding
+from .dialogue import Dialogue
+from .interact_with_llm import send_message_to_llama, send_message_to_vicuna, LocalLLMClient, get_local_llm_client
+from .extract_json import extract_json, JsonStreamParser
+from .response_cache import ResponseCache, get_response_cache
+from .rate_limiter import RequestScheduler, RateLimitCallbackHandler, get_request_scheduler
+from .retry_policy import RetryPolicy, CircuitBreaker, CircuitOpenError, get_retry_policy
+from .tracing import Tracer, get_tracer, traced
+from .usage_ledger import UsageLedger, UsageCallbackHandler, get_usage_ledger
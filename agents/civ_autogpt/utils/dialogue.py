@@ -0,0 +1,86 @@
+from .num_tokens_from_messages import num_tokens_from_message, num_tokens_from_messages
+
+
+class Dialogue(list):
+    """
+    A list of chat messages that keeps count of its tokens.
+
+    The tokens of a message are counted once, when it enters the dialogue,
+    and a running total is kept. `num_tokens` is then O(1), and removing
+    messages costs O(removed messages). It behaves as a plain list of
+    messages otherwise, and can be sent as is to the chat API.
+    """
+    def __init__(self, model, messages=()):
+        super().__init__()
+        self.model = model
+        # Token counting is only implemented for gpt models, as in
+        # `num_tokens_from_messages`.
+        self._counted = model.startswith('gpt')
+        self._message_tokens = []
+        self._total_tokens = 0
+        self.extend(messages)
+
+    @property
+    def num_tokens(self):
+        """Same as `num_tokens_from_messages(self, self.model)`."""
+        if not self._counted:
+            return num_tokens_from_messages(self, self.model)
+        return self._total_tokens + 2  # every reply is primed with <im_start>assistant
+
+    def _count(self, message):
+        if not self._counted:
+            return 0
+        return num_tokens_from_message(message, self.model)
+
+    def _recount(self):
+        self._message_tokens = [self._count(message) for message in self]
+        self._total_tokens = sum(self._message_tokens)
+
+    def append(self, message):
+        tokens = self._count(message)
+        super().append(message)
+        self._message_tokens.append(tokens)
+        self._total_tokens += tokens
+
+    def extend(self, messages):
+        for message in messages:
+            self.append(message)
+
+    def __iadd__(self, messages):
+        self.extend(messages)
+        return self
+
+    def insert(self, index, message):
+        tokens = self._count(message)
+        super().insert(index, message)
+        self._message_tokens.insert(index, tokens)
+        self._total_tokens += tokens
+
+    def pop(self, index=-1):
+        message = super().pop(index)
+        self._total_tokens -= self._message_tokens.pop(index)
+        return message
+
+    def remove(self, message):
+        self.pop(self.index(message))
+
+    def clear(self):
+        super().clear()
+        self._message_tokens = []
+        self._total_tokens = 0
+
+    def __setitem__(self, index, value):
+        super().__setitem__(index, value)
+        self._recount()
+
+    def __delitem__(self, index):
+        super().__delitem__(index)
+        self._recount()
+
+    def sort(self, *args, **kwargs):
+        super().sort(*args, **kwargs)
+        self._recount()
+
+    def reverse(self):
+        super().reverse()
+        self._recount()
@@ -14,6 +14,78 @@ def extract_json(text):
     return json.dumps(json_data)
 
 
+class JsonStreamParser:
+    """
+    Follows the braces of a streamed reply, chunk by chunk.
+
+    Text before the first `{` is kept apart in `preamble`. The reply is
+    complete once the object under the top-level "command" key is closed, or
+    once the top-level object itself is closed, whichever comes first. `text` is then
+    the top-level object, closed, without what the model writes after it.
+    """
+    def __init__(self, key: str = "command"):
+        self.key = key
+        self.preamble = ''
+        self.chunks = []
+        self.depth = 0
+        self.in_string = False
+        self.escaped = False
+        self.string_chars = []
+        self.last_string = None
+        self.key_depth = None
+        self.complete = False
+        self._started = False
+
+    def feed(self, chunk: str) -> bool:
+        """Add a chunk of the reply, and tell whether the reply is complete."""
+        if self.complete or not chunk:
+            return self.complete
+        if not self._started:
+            start_index = chunk.find('{')
+            if start_index < 0:
+                self.preamble += chunk
+                return False
+            self.preamble += chunk[:start_index]
+            chunk = chunk[start_index:]
+            self._started = True
+
+        for index, char in enumerate(chunk):
+            if self.in_string:
+                if self.escaped:
+                    self.escaped = False
+                elif char == '\\':
+                    self.escaped = True
+                elif char == '"':
+                    self.in_string = False
+                    self.last_string = ''.join(self.string_chars)
+                else:
+                    self.string_chars.append(char)
+                continue
+
+            if char == '"':
+                self.in_string = True
+                self.string_chars = []
+            elif char == '{':
+                self.depth += 1
+                if self.depth == 2 and self.last_string == self.key:
+                    self.key_depth = self.depth
+            elif char == '}':
+                self.depth -= 1
+                if self.depth == 0 or (self.key_depth is not None
+                                       and self.depth < self.key_depth):
+                    self.chunks.append(chunk[:index + 1])
+                    self.complete = True
+                    return True
+            elif char == ',':
+                self.last_string = None
+        self.chunks.append(chunk)
+        return False
+
+    @property
+    def text(self) -> str:
+        return ''.join(self.chunks) + '}' * max(self.depth, 0)
+
+
 def deprecated_extract_json(text):
     # find json
     start_index = text.find("{")
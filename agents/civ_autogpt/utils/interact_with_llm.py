@@ -1,19 +1,130 @@
 import json
-import requests
 import os
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from config import LLM_CONCURRENCY_LIMIT, LOCAL_LLM_CONNECT_TIMEOUT, LOCAL_LLM_READ_TIMEOUT, LLM_STREAM_RESPONSES
+from .extract_json import JsonStreamParser
 
 headers = {'Content-Type': 'application/json'}
-url = os.environ["LOCAL_LLM_URL"]
 tmp_dia = [{'role': 'user', 'content':'Hello, Who are you?'}, {'role': 'assistant', 'content':'I am LLM.'}, {'role': 'user', 'content':'Good, Give me an example about how to use you.'}]
 tmp_config = {'temperature':0.7, 'top_p': 0.95, 'repetition_penalty': 1.1}
 
-def send_message_to_vicuna(dialogue: list = tmp_dia, config = tmp_config):
-    content = {'message': dialogue, 'config': config}
-    response = requests.post(
-                url=url, 
-                headers = headers, 
-                data = json.dumps(content)
-                ).text
+
+class LocalLLMClient:
+    """
+    Client of a local LLM inference server.
+
+    Requests share one session with a pool of keep-alive connections, sized
+    to the number of concurrent workers, so that a message does not pay for
+    a new connection. The server URL is read from `LOCAL_LLM_URL` when the
+    first message is sent, not at import.
+    """
+    def __init__(self,
+                 url: str = None,
+                 pool_size: int = LLM_CONCURRENCY_LIMIT,
+                 connect_timeout: float = LOCAL_LLM_CONNECT_TIMEOUT,
+                 read_timeout: float = LOCAL_LLM_READ_TIMEOUT):
+        self._url = url
+        self.pool_size = pool_size
+        self.timeout = (connect_timeout, read_timeout)
+        self._session = None
+        self._lock = threading.Lock()
+
+    @property
+    def url(self):
+        if self._url is None:
+            self._url = os.environ["LOCAL_LLM_URL"]
+        return self._url
+
+    @property
+    def session(self):
+        with self._lock:
+            if self._session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1,
+                                      pool_maxsize=self.pool_size)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                session.headers.update(headers)
+                self._session = session
+        return self._session
+
+    def post(self, dialogue, config) -> str:
+        """Send the dialogue to the server and return the raw reply."""
+        content = {'message': list(dialogue), 'config': config}
+        response = self.session.post(url=self.url,
+                                     data=json.dumps(content),
+                                     timeout=self.timeout)
+        return response.text
+
+    def stream(self, dialogue, config, marker, num_markers=1) -> str:
+        """
+        Send the dialogue to the server and read the raw reply until the
+        command json is complete.
+
+        The server echoes the prompt before its answer, so the reply is only
+        parsed after the `num_markers`-th occurrence of `marker`. What the
+        model writes after the command json is not read.
+        """
+        content = {'message': list(dialogue), 'config': config}
+        parser = JsonStreamParser()
+        head = ''
+        with self.session.post(url=self.url,
+                               data=json.dumps(content),
+                               timeout=self.timeout,
+                               stream=True) as response:
+            response.encoding = response.encoding or 'utf-8'
+            for chunk in response.iter_content(chunk_size=None,
+                                               decode_unicode=True):
+                if num_markers > 0:
+                    head += chunk
+                    while num_markers > 0 and marker in head:
+                        index = head.index(marker) + len(marker)
+                        body, head = head[:index], head[index:]
+                        parser.preamble += body
+                        num_markers -= 1
+                    if num_markers > 0:
+                        continue
+                    chunk, head = head, ''
+                if parser.feed(chunk):
+                    break
+        return parser.preamble + parser.text
+
+    def close(self):
+        with self._lock:
+            if self._session is not None:
+                self._session.close()
+                self._session = None
+
+
+_local_llm_client = None
+_local_llm_client_lock = threading.Lock()
+
+
+def get_local_llm_client() -> LocalLLMClient:
+    """Return the process-wide local LLM client."""
+    global _local_llm_client
+    with _local_llm_client_lock:
+        if _local_llm_client is None:
+            _local_llm_client = LocalLLMClient()
+    return _local_llm_client
+
+
+def num_user_messages(dialogue):
+    return sum(1 for message in dialogue if message['role'] == 'user')
+
+
+def send_message_to_vicuna(dialogue: list = tmp_dia, config = tmp_config, client: LocalLLMClient = None, stream: bool = LLM_STREAM_RESPONSES):
+    client = client or get_local_llm_client()
+    if stream:
+        # The echoed prompt holds one response marker per user message.
+        response = client.stream(dialogue, config, '### Response:',
+                                 num_user_messages(dialogue))
+    else:
+        response = client.post(dialogue, config)
     # matches = re.findall(pattern, response.split('### Response:')[-1])
     # ipdb.set_trace()
     matches = response.split('### Response:')[-1]
@@ -23,13 +134,14 @@ def send_message_to_vicuna(dialogue: list = tmp_dia, config = tmp_config):
     # ipdb.set_trace()
     return response
 
-def send_message_to_llama(dialogue: list = tmp_dia, config = tmp_config):
-    content = {'message': dialogue, 'config': config}
-    response = requests.post(
-                url=url, 
-                headers = headers, 
-                data = json.dumps(content)
-                ).text
+def send_message_to_llama(dialogue: list = tmp_dia, config = tmp_config, client: LocalLLMClient = None, stream: bool = LLM_STREAM_RESPONSES):
+    client = client or get_local_llm_client()
+    if stream:
+        # The echoed prompt closes every user message with [/INST].
+        response = client.stream(dialogue, config, '[/INST]',
+                                 num_user_messages(dialogue))
+    else:
+        response = client.post(dialogue, config)
     # print(response)
     response = response.split('[/INST]')[-1].split('</s>')[0]
     response = response.strip().replace('\n', '').replace('\r', '').replace('\'', '')
@@ -40,8 +152,85 @@ def send_message_to_llama(dialogue: list = tmp_dia, config = tmp_config):
     return response
 
 
+def unit_test():
+    """The unit test, against a stub server on localhost."""
+    import time
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    client_ports = set()
+    answer = 'json{"command": {"name": "finalDecision", "input": {}}}</s>'
+
+    class StubHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def write_chunk(self, text):
+            data = text.encode('utf-8')
+            self.wfile.write(f'{len(data):x}\r\n'.encode() + data + b'\r\n')
+            self.wfile.flush()
+
+        def do_POST(self):
+            content = json.loads(
+                self.rfile.read(int(self.headers['Content-Length'])))
+            client_ports.add(self.client_address[1])
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; charset=utf-8')
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+            # Echo the prompt, then answer, then ramble on.
+            for message in content['message']:
+                if message['role'] == 'user':
+                    self.write_chunk(
+                        f'[INST] {message["content"]} [/INST] ### Response:')
+                else:
+                    self.write_chunk(f' {message["content"]}</s>')
+            for index in range(0, len(answer), 7):
+                self.write_chunk(answer[index:index + 7])
+            time.sleep(0.5)
+            try:
+                self.write_chunk(' I hope this helps.')
+                self.wfile.write(b'0\r\n\r\n')
+            except (BrokenPipeError, ConnectionResetError):
+                # The client stopped reading once the json was complete.
+                self.close_connection = True
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    client = LocalLLMClient(url=f'http://127.0.0.1:{server.server_port}/',
+                            pool_size=2)
+    expected = '{"command": {"name": "finalDecision", "input": {}}}'
+    dialogue = tmp_dia[:1] + [{
+        'role': 'assistant',
+        'content': 'json{"command": {"name": "old", "input": {}}}'
+    }] + tmp_dia[2:]
+    try:
+        for _ in range(3):
+            assert send_message_to_vicuna(dialogue, client=client,
+                                          stream=False) == expected
+        assert send_message_to_llama(dialogue, client=client,
+                                     stream=False).endswith(expected)
+        # All messages went through one keep-alive connection.
+        assert len(client_ports) == 1, client_ports
+
+        # Streamed replies are cut once the command json is complete.
+        for send_message in [send_message_to_vicuna, send_message_to_llama]:
+            start_time = time.monotonic()
+            response = send_message(dialogue, client=client, stream=True)
+            assert response.endswith(expected), response
+            assert time.monotonic() - start_time < 0.4
+    finally:
+        client.close()
+        server.shutdown()
+        server.server_close()
+    return 'Local LLM client OK.'
+
+
 # print('test the connection (good if having output):', send_message_to_llama())
 # ipdb.set_trace()
 
 
-
+if __name__ == '__main__':
+    print(unit_test())
@@ -1,23 +1,44 @@
+import functools
+
 import tiktoken
 
 
-def num_tokens_from_messages(messages, model="gpt-3.5-turbo-0301"):
-    """Returns the number of tokens used by a list of messages."""
+@functools.lru_cache(maxsize=None)
+def get_encoding(model):
+    """Returns the (cached) tiktoken encoding of a model."""
     try:
-        encoding = tiktoken.encoding_for_model(model)
+        return tiktoken.encoding_for_model(model)
     except KeyError:
-        encoding = tiktoken.get_encoding("cl100k_base")
+        return tiktoken.get_encoding("cl100k_base")
+
+
+def num_tokens_from_message(message, model="gpt-3.5-turbo-0301"):
+    """Returns the number of tokens used by a single message."""
+    if not model.startswith('gpt'):
+        raise NotImplementedError(f"""num_tokens_from_message() is not presently implemented for model {model}.
+See https://github.com/openai/openai-python/blob/main/chatml.md for information on how messages are converted to tokens.""")
+    encoding = get_encoding(model)
+    num_tokens = 4  # every message follows <im_start>{role/name}\n{content}<im_end>\n
+    for key, value in message.items():
+        num_tokens += len(encoding.encode(value))
+        if key == "name":  # if there's a name, the role is omitted
+            num_tokens += -1  # role is always required and always 1 token
+    return num_tokens
 
+
+def num_tokens_from_messages(messages, model="gpt-3.5-turbo-0301"):
+    """Returns the number of tokens used by a list of messages."""
     if model.startswith('gpt'):  # note: future models may deviate from this
         num_tokens = 0
         for message in messages:
-            num_tokens += 4  # every message follows <im_start>{role/name}\n{content}<im_end>\n
-            for key, value in message.items():
-                num_tokens += len(encoding.encode(value))
-                if key == "name":  # if there's a name, the role is omitted
-                    num_tokens += -1  # role is always required and always 1 token
+            num_tokens += num_tokens_from_message(message, model)
         num_tokens += 2  # every reply is primed with <im_start>assistant
         return num_tokens
     else:
         raise NotImplementedError(f"""num_tokens_from_messages() is not presently implemented for model {model}.
 See https://github.com/openai/openai-python/blob/main/chatml.md for information on how messages are converted to tokens.""")
+
+
+def num_tokens_from_string(text, model="gpt-3.5-turbo-0301"):
+    """Returns the number of tokens of a piece of text."""
+    return len(get_encoding(model).encode(text))
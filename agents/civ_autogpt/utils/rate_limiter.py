@@ -0,0 +1,206 @@
+import time
+import asyncio
+import threading
+from collections import deque
+
+from langchain.callbacks.base import BaseCallbackHandler
+
+from config import LLM_REQUESTS_PER_MINUTE, LLM_TOKENS_PER_MINUTE
+from .num_tokens_from_messages import num_tokens_from_string
+
+
+class TokenBucket:
+    """
+    Token bucket refilled continuously at `per_minute` tokens per minute,
+    holding at most `capacity` tokens. Not thread-safe on its own.
+    """
+    def __init__(self, per_minute: float, capacity: float = None):
+        self.rate = per_minute / 60.0
+        self.capacity = per_minute if capacity is None else capacity
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity,
+                          self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount: float) -> float:
+        """Seconds until `amount` tokens are available."""
+        self._refill()
+        # A request larger than the bucket waits for a full bucket.
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) / self.rate
+
+    def consume(self, amount: float):
+        self._refill()
+        self.tokens -= amount
+
+    def refund(self, amount: float):
+        self._refill()
+        self.tokens = min(self.capacity, self.tokens + amount)
+
+
+class RequestScheduler:
+    """
+    Process-wide scheduler in front of the LLM endpoint.
+
+    A request waits until both the requests-per-minute and the
+    tokens-per-minute buckets can afford it. Waiting requests are served in
+    FIFO order across all workers, so that none of them starves, and the
+    number of waiting requests is exposed as `queue_depth`. A limit of None
+    disables the corresponding bucket.
+    """
+    def __init__(self,
+                 requests_per_minute: float = None,
+                 tokens_per_minute: float = None,
+                 poll_interval: float = 0.05):
+        self.request_bucket = (TokenBucket(requests_per_minute)
+                               if requests_per_minute else None)
+        self.token_bucket = (TokenBucket(tokens_per_minute)
+                             if tokens_per_minute else None)
+        self.poll_interval = poll_interval
+        self.total_requests = 0
+        self.total_wait = 0.0
+
+        self._queue = deque()
+        self._condition = threading.Condition()
+
+    @property
+    def enabled(self) -> bool:
+        return self.request_bucket is not None or self.token_bucket is not None
+
+    @property
+    def queue_depth(self) -> int:
+        """Number of requests waiting for their turn."""
+        return len(self._queue)
+
+    def _try_acquire(self, ticket, tokens):
+        """
+        Must be called with the condition held.
+
+        Returns 0 if the request of `ticket` may go now, the seconds to wait
+        for the buckets if it is at the head of the queue, and None if it
+        has to wait for the requests before it.
+        """
+        if self._queue[0] is not ticket:
+            return None
+        wait = 0.0
+        if self.request_bucket is not None:
+            wait = max(wait, self.request_bucket.wait_time(1))
+        if self.token_bucket is not None:
+            wait = max(wait, self.token_bucket.wait_time(tokens))
+        if wait > 0:
+            return wait
+
+        if self.request_bucket is not None:
+            self.request_bucket.consume(1)
+        if self.token_bucket is not None:
+            self.token_bucket.consume(tokens)
+        self._queue.popleft()
+        self._condition.notify_all()
+        return 0.0
+
+    def _finish(self, start_time):
+        self.total_requests += 1
+        self.total_wait += time.monotonic() - start_time
+
+    def acquire(self, tokens: int = 0):
+        """Block until a request of `tokens` prompt tokens may be sent."""
+        if not self.enabled:
+            return
+        start_time = time.monotonic()
+        ticket = object()
+        with self._condition:
+            self._queue.append(ticket)
+            while True:
+                wait = self._try_acquire(ticket, tokens)
+                if wait == 0:
+                    break
+                self._condition.wait(timeout=wait)
+            self._finish(start_time)
+
+    async def aacquire(self, tokens: int = 0):
+        """ Asynchronous version of `acquire`. """
+        if not self.enabled:
+            return
+        start_time = time.monotonic()
+        ticket = object()
+        with self._condition:
+            self._queue.append(ticket)
+        try:
+            while True:
+                with self._condition:
+                    wait = self._try_acquire(ticket, tokens)
+                    if wait == 0:
+                        self._finish(start_time)
+                        return
+                await asyncio.sleep(
+                    self.poll_interval if wait is None else wait)
+        except asyncio.CancelledError:
+            with self._condition:
+                if ticket in self._queue:
+                    self._queue.remove(ticket)
+                    self._condition.notify_all()
+            raise
+
+    def settle(self, estimated_tokens: int, used_tokens: int):
+        """Correct the token bucket once the real usage is known."""
+        if self.token_bucket is None or used_tokens is None:
+            return
+        with self._condition:
+            self.token_bucket.refund(estimated_tokens - used_tokens)
+            self._condition.notify_all()
+
+    def stats(self) -> dict:
+        with self._condition:
+            return {
+                "queue_depth": len(self._queue),
+                "requests": self.total_requests,
+                "mean_wait": (self.total_wait / self.total_requests
+                              if self.total_requests else 0.0)
+            }
+
+
+class RateLimitCallbackHandler(BaseCallbackHandler):
+    """
+    Routes the LLM calls made by langchain (QA chains, summarization of the
+    memory) through a `RequestScheduler`.
+    """
+    def __init__(self, scheduler: RequestScheduler, model: str):
+        self.scheduler = scheduler
+        self.model = model
+        self._estimates = {}
+
+    def on_llm_start(self, serialized, prompts, *, run_id, **kwargs):
+        tokens = sum(
+            num_tokens_from_string(prompt, self.model) for prompt in prompts)
+        self._estimates[run_id] = tokens
+        self.scheduler.acquire(tokens)
+
+    def on_llm_end(self, response, *, run_id, **kwargs):
+        estimated = self._estimates.pop(run_id, 0)
+        usage = (response.llm_output or {}).get("token_usage", {})
+        if "total_tokens" in usage:
+            self.scheduler.settle(estimated, usage["total_tokens"])
+
+    def on_llm_error(self, error, *, run_id, **kwargs):
+        self._estimates.pop(run_id, None)
+
+
+_request_scheduler = None
+_request_scheduler_lock = threading.Lock()
+
+
+def get_request_scheduler() -> RequestScheduler:
+    """Return the process-wide request scheduler, configured in config.py."""
+    global _request_scheduler
+    with _request_scheduler_lock:
+        if _request_scheduler is None:
+            _request_scheduler = RequestScheduler(
+                requests_per_minute=LLM_REQUESTS_PER_MINUTE,
+                tokens_per_minute=LLM_TOKENS_PER_MINUTE)
+    return _request_scheduler
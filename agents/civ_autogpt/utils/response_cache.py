@@ -0,0 +1,123 @@
+import json
+import sqlite3
+import hashlib
+import threading
+from collections import OrderedDict
+
+from config import LLM_CACHE_ENABLED, LLM_CACHE_SIZE, LLM_CACHE_PATH
+
+
+class ResponseCache:
+    """
+    Content-addressed cache of LLM responses.
+
+    A response is keyed on the hash of the whole request, i.e. model,
+    deployment, messages and sampling parameters. The most recent responses
+    are kept in an in-memory LRU tier. If `path` is given, every response is
+    also written to a SQLite file, so that a rerun of a recorded game is
+    served from disk.
+    """
+    def __init__(self,
+                 max_size: int = 4096,
+                 path: str = None,
+                 enabled: bool = True):
+        self.max_size = max_size
+        self.path = path
+        self.enabled = enabled
+        self.hits = 0
+        self.misses = 0
+
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._db = None
+        if path is not None:
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute("CREATE TABLE IF NOT EXISTS responses "
+                             "(key TEXT PRIMARY KEY, response TEXT)")
+            self._db.commit()
+
+    @staticmethod
+    def make_key(**request) -> str:
+        """Hash the keyword arguments of an LLM request."""
+        payload = json.dumps(request,
+                             sort_keys=True,
+                             ensure_ascii=False,
+                             default=str)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key: str):
+        """Return the cached response of `key`, or None on a miss."""
+        if not self.enabled:
+            return None
+
+        with self._lock:
+            raw = self._entries.get(key)
+            if raw is not None:
+                self._entries.move_to_end(key)
+            elif self._db is not None:
+                row = self._db.execute(
+                    "SELECT response FROM responses WHERE key = ?",
+                    (key, )).fetchone()
+                if row is not None:
+                    raw = row[0]
+                    self._remember(key, raw)
+
+            if raw is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        # Every hit gets its own copy, callers are free to mutate it.
+        return json.loads(raw)
+
+    def put(self, key: str, response):
+        if not self.enabled:
+            return
+
+        raw = json.dumps(response, ensure_ascii=False)
+        with self._lock:
+            self._remember(key, raw)
+            if self._db is not None:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO responses VALUES (?, ?)",
+                    (key, raw))
+                self._db.commit()
+
+    def _remember(self, key: str, raw: str):
+        self._entries[key] = raw
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+                "size": len(self._entries)
+            }
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+            if self._db is not None:
+                self._db.execute("DELETE FROM responses")
+                self._db.commit()
+
+
+_response_cache = None
+_response_cache_lock = threading.Lock()
+
+
+def get_response_cache() -> ResponseCache:
+    """Return the process-wide response cache, configured in config.py."""
+    global _response_cache
+    with _response_cache_lock:
+        if _response_cache is None:
+            _response_cache = ResponseCache(max_size=LLM_CACHE_SIZE,
+                                            path=LLM_CACHE_PATH,
+                                            enabled=LLM_CACHE_ENABLED)
+    return _response_cache
@@ -0,0 +1,197 @@
+import time
+import random
+import asyncio
+import threading
+
+from civrealm.freeciv.utils.freeciv_logging import fc_logger
+
+from config import (RETRY_BASE_DELAY, RETRY_MAX_DELAY, RETRY_MAX_ATTEMPTS,
+                    RETRY_BUDGET_PER_TURN, CIRCUIT_FAILURE_THRESHOLD,
+                    CIRCUIT_RECOVERY_TIMEOUT)
+
+
+class CircuitOpenError(Exception):
+    """Raised when a call is refused because the circuit breaker is open."""
+
+
+class CircuitBreaker:
+    """
+    Stops calls to a failing endpoint.
+
+    After `failure_threshold` consecutive failures the breaker opens and
+    refuses calls. After `recovery_timeout` seconds it lets a single call
+    through on trial (half-open): a success closes it, a failure opens it
+    for another `recovery_timeout`. Other calls are refused until the trial
+    call is settled, or has taken longer than `recovery_timeout`.
+    """
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self,
+                 failure_threshold: int = 20,
+                 recovery_timeout: float = 60.0):
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probe_started_at = 0.0
+        self._lock = threading.Lock()
+
+    def allow_request(self) -> bool:
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            now = time.monotonic()
+            if self.state == self.OPEN:
+                if now - self.opened_at < self.recovery_timeout:
+                    return False
+                self.state = self.HALF_OPEN
+            elif now - self.probe_started_at < self.recovery_timeout:
+                # The trial call is still running.
+                return False
+            self.probe_started_at = now
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self.failures = 0
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if (self.state == self.HALF_OPEN
+                    or self.failures >= self.failure_threshold):
+                if self.state != self.OPEN:
+                    fc_logger.error(
+                        f'Circuit breaker opened after {self.failures} failures.'
+                    )
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+
+
+class RetryPolicy:
+    """
+    Retry policy shared by all workers.
+
+    Retries wait for a capped exponential backoff with full jitter, at most
+    `max_attempts` attempts are made per call, and all retries of one turn
+    draw from a budget of `retries_per_turn`. Calls are refused while the
+    circuit breaker is open.
+    """
+    def __init__(self,
+                 base_delay: float = 0.5,
+                 max_delay: float = 30.0,
+                 max_attempts: int = 6,
+                 retries_per_turn: int = 500,
+                 breaker: CircuitBreaker = None):
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_attempts = max_attempts
+        self.retries_per_turn = retries_per_turn
+        self.breaker = breaker if breaker is not None else CircuitBreaker()
+        self.retries_left = retries_per_turn
+        self._lock = threading.Lock()
+
+    def new_turn(self):
+        with self._lock:
+            self.retries_left = self.retries_per_turn
+
+    def backoff(self, attempt: int) -> float:
+        """Seconds to wait before retry number `attempt` (from 0)."""
+        return random.uniform(
+            0, min(self.max_delay, self.base_delay * 2**attempt))
+
+    def allow_request(self) -> bool:
+        return self.breaker.allow_request()
+
+    def record_success(self):
+        self.breaker.record_success()
+
+    def should_retry(self, attempt: int) -> bool:
+        """
+        Record the failure of the LLM endpoint at attempt number `attempt`
+        (from 0), and tell whether another attempt may be made.
+        """
+        self.breaker.record_failure()
+        return self.can_retry(attempt)
+
+    def can_retry(self, attempt: int) -> bool:
+        """
+        Tell whether another attempt may be made after attempt number
+        `attempt` (from 0) failed, without counting a failure of the
+        endpoint, e.g. when its reply could not be parsed.
+        """
+        if attempt + 1 >= self.max_attempts:
+            return False
+        with self._lock:
+            if self.retries_left <= 0:
+                fc_logger.error('Retry budget of this turn is exhausted.')
+                return False
+            self.retries_left -= 1
+        return self.breaker.allow_request()
+
+    def call(self, func, *args, on_retry=None, **kwargs):
+        """
+        Call `func` with retries. `on_retry`, if given, is called before each
+        retry. The last error is raised when no retry is left.
+        """
+        attempt = 0
+        while True:
+            if not self.allow_request():
+                raise CircuitOpenError(f'Circuit open, {func} not called.')
+            try:
+                result = func(*args, **kwargs)
+            except Exception as e:
+                fc_logger.error(f'Attempt {attempt} failed: {repr(e)}')
+                if not self.should_retry(attempt):
+                    raise
+                time.sleep(self.backoff(attempt))
+                attempt += 1
+                if on_retry is not None:
+                    on_retry()
+                continue
+            self.record_success()
+            return result
+
+    async def acall(self, func, *args, on_retry=None, **kwargs):
+        """ Asynchronous version of `call`, `func` is a coroutine function. """
+        attempt = 0
+        while True:
+            if not self.allow_request():
+                raise CircuitOpenError(f'Circuit open, {func} not called.')
+            try:
+                result = await func(*args, **kwargs)
+            except Exception as e:
+                fc_logger.error(f'Attempt {attempt} failed: {repr(e)}')
+                if not self.should_retry(attempt):
+                    raise
+                await asyncio.sleep(self.backoff(attempt))
+                attempt += 1
+                if on_retry is not None:
+                    on_retry()
+                continue
+            self.record_success()
+            return result
+
+
+_retry_policy = None
+_retry_policy_lock = threading.Lock()
+
+
+def get_retry_policy() -> RetryPolicy:
+    """Return the process-wide retry policy, configured in config.py."""
+    global _retry_policy
+    with _retry_policy_lock:
+        if _retry_policy is None:
+            _retry_policy = RetryPolicy(
+                base_delay=RETRY_BASE_DELAY,
+                max_delay=RETRY_MAX_DELAY,
+                max_attempts=RETRY_MAX_ATTEMPTS,
+                retries_per_turn=RETRY_BUDGET_PER_TURN,
+                breaker=CircuitBreaker(
+                    failure_threshold=CIRCUIT_FAILURE_THRESHOLD,
+                    recovery_timeout=CIRCUIT_RECOVERY_TIMEOUT))
+    return _retry_policy
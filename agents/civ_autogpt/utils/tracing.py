@@ -0,0 +1,174 @@
+import os
+import json
+import time
+import asyncio
+import functools
+import threading
+
+from config import TRACING_ENABLED
+
+
+class _NullSpan:
+    """Span of a disabled tracer, doing nothing."""
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+    def set(self, **args):
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class Span:
+    __slots__ = ('tracer', 'name', 'cat', 'args', 'start')
+
+    def __init__(self, tracer, name, cat, args):
+        self.tracer = tracer
+        self.name = name
+        self.cat = cat
+        self.args = args
+        self.start = 0
+
+    def __enter__(self):
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        end = time.perf_counter_ns()
+        if exc_type is not None:
+            self.args['error'] = exc_type.__name__
+        self.tracer.add_span(self.name, self.cat, self.start, end, self.args)
+        return False
+
+    def set(self, **args):
+        """Add arguments to the span, e.g. results known at its end."""
+        self.args.update(args)
+
+
+class Tracer:
+    """
+    Records nested spans of time and exports them in the Chrome trace event
+    format, which chrome://tracing and Perfetto open.
+
+    Spans are grouped into tracks by thread, and by asyncio task inside the
+    event loop, so that concurrent decisions get their own track. When the
+    tracer is disabled, `span` returns a shared no-op span.
+    """
+    def __init__(self, enabled: bool = False):
+        self.enabled = enabled
+        self.events = []
+        self.origin = time.perf_counter_ns()
+        self._tracks = {}
+        self._lock = threading.Lock()
+
+    def span(self, name: str, cat: str = 'agent', **args):
+        if not self.enabled:
+            return _NULL_SPAN
+        return Span(self, name, cat, args)
+
+    def _track(self):
+        try:
+            task = asyncio.current_task(asyncio.get_running_loop())
+        except RuntimeError:
+            task = None
+        if task is not None:
+            key, track_name = ('task', id(task)), task.get_name()
+        else:
+            thread = threading.current_thread()
+            key, track_name = ('thread', thread.ident), thread.name
+        track = self._tracks.get(key)
+        if track is None:
+            with self._lock:
+                track = self._tracks.setdefault(key, len(self._tracks) + 1)
+                self.events.append({
+                    'name': 'thread_name',
+                    'ph': 'M',
+                    'pid': os.getpid(),
+                    'tid': track,
+                    'args': {
+                        'name': track_name
+                    }
+                })
+        return track
+
+    def add_span(self, name, cat, start, end, args):
+        self.events.append({
+            'name': name,
+            'cat': cat,
+            'ph': 'X',
+            'ts': (start - self.origin) / 1000,
+            'dur': (end - start) / 1000,
+            'pid': os.getpid(),
+            'tid': self._track(),
+            'args': args
+        })
+
+    def clear(self):
+        with self._lock:
+            self.events = []
+            self._tracks = {}
+            self.origin = time.perf_counter_ns()
+
+    def export(self, path: str):
+        """Write the recorded spans to the trace file `path`."""
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self._lock:
+            events = list(self.events)
+        with open(path, 'w') as f:
+            json.dump({
+                'traceEvents': events,
+                'displayTimeUnit': 'ms'
+            },
+                      f,
+                      default=str)
+
+
+_tracer = None
+_tracer_lock = threading.Lock()
+
+
+def get_tracer() -> Tracer:
+    """Return the process-wide tracer, enabled by TRACING_ENABLED."""
+    global _tracer
+    if _tracer is None:
+        with _tracer_lock:
+            if _tracer is None:
+                _tracer = Tracer(enabled=TRACING_ENABLED)
+    return _tracer
+
+
+def traced(name: str = None, cat: str = 'agent'):
+    """Decorator recording a span for every call of a function or coroutine
+    function. When tracing is disabled, the function is called directly."""
+    def decorator(func):
+        span_name = name or func.__qualname__
+
+        if asyncio.iscoroutinefunction(func):
+
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                tracer = get_tracer()
+                if not tracer.enabled:
+                    return await func(*args, **kwargs)
+                with tracer.span(span_name, cat):
+                    return await func(*args, **kwargs)
+
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            tracer = get_tracer()
+            if not tracer.enabled:
+                return func(*args, **kwargs)
+            with tracer.span(span_name, cat):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
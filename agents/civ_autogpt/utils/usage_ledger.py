@@ -0,0 +1,153 @@
+import os
+import json
+import threading
+from collections import defaultdict
+
+from langchain.callbacks.base import BaseCallbackHandler
+from langchain.callbacks.openai_info import get_openai_token_cost_for_model
+
+FIELDS = ('requests', 'prompt_tokens', 'completion_tokens', 'retries',
+          'cache_hits')
+# Dimensions of the summary, as positions in the keys of the ledger.
+DIMENSIONS = {
+    'turn': 0,
+    'worker': 1,
+    'role': 2,
+    'command': 3,
+    'kind': 4,
+    'model': 5
+}
+
+
+def token_cost(model, prompt_tokens, completion_tokens):
+    """Cost in USD of the tokens, 0 for models of unknown price."""
+    try:
+        return (get_openai_token_cost_for_model(model, prompt_tokens) +
+                get_openai_token_cost_for_model(
+                    model, completion_tokens, is_completion=True))
+    except ValueError:
+        return 0.0
+
+
+class UsageLedger:
+    """
+    Token usage of the LLM, by turn, worker, role (advisor, controller...),
+    command, kind of call and model.
+
+    The kind of a call is 'chat' for the requests of workers, and
+    'summarization' and 'qa' for the calls that langchain makes for the
+    memory and the manual. Cache hits and retries are counted too.
+    """
+    def __init__(self):
+        self.turn = None
+        self._entries = defaultdict(lambda: dict.fromkeys(FIELDS, 0))
+        self._lock = threading.Lock()
+
+    def new_turn(self, turn):
+        self.turn = turn
+
+    def _add(self, worker, role, command, kind, model, **counts):
+        key = (self.turn, worker, role, command or '-', kind, model)
+        with self._lock:
+            entry = self._entries[key]
+            for field, count in counts.items():
+                entry[field] += count
+
+    def record(self,
+               worker,
+               role,
+               command,
+               kind,
+               model,
+               prompt_tokens=0,
+               completion_tokens=0):
+        self._add(worker,
+                  role,
+                  command,
+                  kind,
+                  model,
+                  requests=1,
+                  prompt_tokens=prompt_tokens,
+                  completion_tokens=completion_tokens)
+
+    def record_cache_hit(self, worker, role, command, kind, model):
+        self._add(worker, role, command, kind, model, cache_hits=1)
+
+    def record_retry(self, worker, role, command, kind, model):
+        self._add(worker, role, command, kind, model, retries=1)
+
+    def aggregate(self, dimension=None):
+        """
+        Sum the ledger over all dimensions but `dimension`, one of
+        DIMENSIONS. Returns a dict from the values of `dimension` to their
+        counts, or the grand total if `dimension` is None.
+        """
+        totals = defaultdict(lambda: dict.fromkeys(FIELDS + ('cost', ), 0))
+        with self._lock:
+            entries = list(self._entries.items())
+        for key, entry in entries:
+            group = key[DIMENSIONS[dimension]] if dimension else 'total'
+            total = totals[group]
+            for field in FIELDS:
+                total[field] += entry[field]
+            total['cost'] += token_cost(key[5], entry['prompt_tokens'],
+                                        entry['completion_tokens'])
+        if dimension is None:
+            return totals['total']
+        return {str(group): total for group, total in totals.items()}
+
+    def summary(self) -> dict:
+        summary = {'total': self.aggregate()}
+        for dimension in ('role', 'command', 'kind', 'turn', 'worker'):
+            summary[f'by_{dimension}'] = self.aggregate(dimension)
+        return summary
+
+    def export(self, path: str):
+        """Write the summary of the ledger to the JSON file `path`."""
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(path, 'w') as f:
+            json.dump(self.summary(), f, indent=1)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class UsageCallbackHandler(BaseCallbackHandler):
+    """
+    Records the usage of the LLM calls made by langchain for a worker,
+    e.g. summarization of the memory and QA chains.
+    """
+    def __init__(self, ledger, worker, role, kind, model, command=None):
+        self.ledger = ledger
+        self.worker = worker
+        self.role = role
+        self.kind = kind
+        self.model = model
+        self.command = command
+
+    def on_llm_end(self, response, **kwargs):
+        usage = (response.llm_output or {}).get('token_usage', {})
+        self.ledger.record(self.worker,
+                           self.role,
+                           self.command,
+                           self.kind,
+                           self.model,
+                           prompt_tokens=usage.get('prompt_tokens', 0),
+                           completion_tokens=usage.get('completion_tokens',
+                                                       0))
+
+
+_usage_ledger = None
+_usage_ledger_lock = threading.Lock()
+
+
+def get_usage_ledger() -> UsageLedger:
+    """Return the process-wide usage ledger."""
+    global _usage_ledger
+    with _usage_ledger_lock:
+        if _usage_ledger is None:
+            _usage_ledger = UsageLedger()
+    return _usage_ledger
@@ -0,0 +1,130 @@
+# Copyright (C) 2023  The CivRealm project
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Reuse of the decisions of actors whose situation did not change.
+
+The situation of an actor is fingerprinted from its type, observations,
+available actions and the advice of the advisor. When the LLM decides for
+an actor, the fingerprint is kept with the turn of the decision. In the
+next turns, an actor with the same fingerprint takes again the action it
+took last, as long as that action is still available and the decision is
+at most `max_age` turns old.
+"""
+
+import json
+import hashlib
+from collections import defaultdict
+
+from config import DECISION_REUSE_ENABLED, DECISION_REUSE_MAX_AGE
+
+
+class DecisionCache:
+    def __init__(self,
+                 max_age: int = DECISION_REUSE_MAX_AGE,
+                 enabled: bool = DECISION_REUSE_ENABLED):
+        self.max_age = max_age
+        self.enabled = enabled
+        # (ctrl_type, actor_id) -> (fingerprint, turn of the LLM decision)
+        self._decisions = {}
+        # Fingerprints of the actors left to the LLM in the current turn.
+        self._pending = {}
+        self.reused = defaultdict(int)
+        self.decided = defaultdict(int)
+
+    @staticmethod
+    def fingerprint(ctrl_type, actor_dict, available_actions,
+                    advice='') -> str:
+        payload = json.dumps(
+            [
+                ctrl_type, actor_dict['observations'],
+                sorted(available_actions), advice
+            ],
+            ensure_ascii=False,
+            default=str)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def lookup(self, key, fingerprint, turn, last_taken_action,
+               available_actions):
+        """
+        Return the action of actor `key` to reuse, or None if the LLM has to
+        decide. `last_taken_action` is the `[action name, turn]` of the
+        last action the actor took, if any.
+        """
+        if not self.enabled:
+            return None
+        self._pending[key] = fingerprint
+        decision = self._decisions.get(key)
+        if (decision is None or last_taken_action is None
+                or decision[0] != fingerprint
+                or turn - decision[1] > self.max_age):
+            return None
+        action_name, action_turn = last_taken_action
+        # The action must have been taken after the decision, in an earlier
+        # turn, and must still be possible.
+        if (not decision[1] <= action_turn < turn
+                or action_name not in available_actions):
+            return None
+        self.reused[turn] += 1
+        return action_name
+
+    def record(self, key, turn):
+        """The LLM decided for actor `key` in `turn`."""
+        if not self.enabled:
+            return
+        self.decided[turn] += 1
+        fingerprint = self._pending.pop(key, None)
+        if fingerprint is not None:
+            self._decisions[key] = (fingerprint, turn)
+
+    def forget(self, key):
+        self._decisions.pop(key, None)
+        self._pending.pop(key, None)
+
+    def stats(self, turn) -> dict:
+        reused, decided = self.reused[turn], self.decided[turn]
+        return {
+            'reused': reused,
+            'decided': decided,
+            'reuse_rate': reused / (reused + decided) if reused else 0.0
+        }
+
+
+def unit_test():
+    cache = DecisionCache(max_age=2)
+    actor = {'observations': {'minimap': {'current_tile': ['Grassland']}}}
+    actions = ['fortify', 'move North']
+    fingerprint = cache.fingerprint('unit', actor, actions, 'defend')
+    key = ('unit', 1)
+
+    assert cache.lookup(key, fingerprint, 1, None, actions) is None
+    cache.record(key, 1)
+    assert cache.lookup(key, fingerprint, 2, ['fortify', 1],
+                        actions) == 'fortify'
+    assert cache.lookup(key, fingerprint, 3, ['fortify', 2],
+                        actions) == 'fortify'
+    # Too old.
+    assert cache.lookup(key, fingerprint, 4, ['fortify', 3], actions) is None
+    cache.record(key, 4)
+    # Changed situation, or action no longer available.
+    assert cache.lookup(key, fingerprint + 'x', 5, ['fortify', 4],
+                        actions) is None
+    assert cache.lookup(key, fingerprint, 5, ['fortify', 4],
+                        ['move North']) is None
+    assert cache.stats(2) == {'reused': 1, 'decided': 0, 'reuse_rate': 1.0}
+
+
+if __name__ == '__main__':
+    unit_test()
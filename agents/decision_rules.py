@@ -0,0 +1,103 @@
+# Copyright (C) 2023  The CivRealm project
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Rules settling trivial decisions before they reach the LLM.
+
+A rule is called with `(ctrl_type, actor_id, actor_dict, available_actions)`
+and returns None when it does not apply. Otherwise it returns the decided
+action name, or an empty string to take no action at all. The rules of an
+agent are tried in order and the first one that applies decides.
+"""
+
+from abc import ABC, abstractmethod
+
+
+class DecisionRule(ABC):
+    name = 'rule'
+
+    @abstractmethod
+    def __call__(self, ctrl_type, actor_id, actor_dict, available_actions):
+        pass
+
+
+class NoActionRule(DecisionRule):
+    """Nothing to decide when no action is available."""
+    name = 'no_action'
+
+    def __call__(self, ctrl_type, actor_id, actor_dict, available_actions):
+        if not available_actions:
+            return ''
+        return None
+
+
+class SingleActionRule(DecisionRule):
+    """
+    A unit with a single available action takes it. Cities are left to
+    KeepProducingRule, since keeping their current production is always an
+    alternative that is not in their available actions.
+    """
+    name = 'single_action'
+
+    def __call__(self, ctrl_type, actor_id, actor_dict, available_actions):
+        if ctrl_type != 'city' and len(available_actions) == 1:
+            return available_actions[0]
+        return None
+
+
+class KeepProducingRule(DecisionRule):
+    """
+    A city keeps its current production when it cannot do anything else.
+    """
+    name = 'keep_producing'
+
+    def __call__(self, ctrl_type, actor_id, actor_dict, available_actions):
+        if ctrl_type != 'city':
+            return None
+        producing = actor_dict['observations'].get('producing')
+        if not producing:
+            return None
+        keep_action = 'produce ' + str(producing)
+        if any(action != keep_action for action in available_actions):
+            return None
+        return keep_action
+
+
+def default_decision_rules():
+    return [NoActionRule(), SingleActionRule(), KeepProducingRule()]
+
+
+def unit_test():
+    rules = default_decision_rules()
+
+    def decide(ctrl_type, available_actions, producing='Settlers'):
+        actor_dict = {'observations': {'producing': producing}}
+        for rule in rules:
+            action_name = rule(ctrl_type, 1, actor_dict, available_actions)
+            if action_name is not None:
+                return action_name
+        return None
+
+    assert decide('unit', ['fortify']) == 'fortify'
+    assert decide('unit', ['fortify', 'move North']) is None
+    # Switching production or keeping it is for the LLM to choose.
+    assert decide('city', ['produce Warriors']) is None
+    assert decide('city', ['buy']) is None
+    assert decide('city', ['produce Settlers']) == 'produce Settlers'
+    assert decide('city', []) == ''
+
+
+if __name__ == '__main__':
+    unit_test()
@@ -43,11 +43,15 @@ from typing import final
 from queue import Queue
 
 from civrealm.agents.base_agent import BaseAgent
+from civrealm.freeciv.utils.freeciv_logging import fc_logger
+from .civ_autogpt.utils import get_retry_policy, get_tracer, traced, get_usage_ledger
+from .decision_rules import default_decision_rules
+from .decision_cache import DecisionCache
 
 
 
 class LanguageAgent(BaseAgent):
-    def __init__(self, max_deconflict_depth: int = 1):
+    def __init__(self, max_deconflict_depth: int = 1, decision_rules=None):
         super().__init__()
         self.is_new_turn = False
         self.planned_actor_ids = []
@@ -63,6 +67,10 @@ class LanguageAgent(BaseAgent):
         self.current_deconflict_depth = 0
         self.last_taken_actions = {}
         self.conflict_action_list = []
+        self.decision_rules = (default_decision_rules()
+                               if decision_rules is None else decision_rules)
+        self.skipped_llm_calls = {}
+        self.decision_cache = DecisionCache()
 
     @abstractmethod
     def initialize_workers(self):
@@ -84,6 +92,47 @@ class LanguageAgent(BaseAgent):
     def make_decisions(self):
         pass
 
+    def apply_decision_rules(self, ctrl_type, actor_id, actor_dict,
+                             available_actions):
+        """
+        Try to settle the decision of an actor without the LLM.
+
+        Returns the decided action name, an empty string for no action, or
+        None when the LLM has to decide.
+        """
+        for rule in self.decision_rules:
+            action_name = rule(ctrl_type, actor_id, actor_dict,
+                               available_actions)
+            if action_name is not None:
+                fc_logger.debug(f'Rule {rule.name} decided {action_name!r} ' +
+                                f'for {ctrl_type} {actor_id}.')
+                self.skipped_llm_calls[self.turn] = (
+                    self.skipped_llm_calls.get(self.turn, 0) + 1)
+                return action_name
+        return None
+
+    def decision_advice(self):
+        """Advice given to all the actors, part of their fingerprints."""
+        return ''
+
+    def reuse_decision(self, ctrl_type, actor_id, actor_dict,
+                       available_actions):
+        """
+        Return the last action of an actor whose situation did not change
+        since the LLM decided for it, or None when the LLM has to decide.
+        """
+        key = (ctrl_type, actor_id)
+        fingerprint = self.decision_cache.fingerprint(ctrl_type, actor_dict,
+                                                      available_actions,
+                                                      self.decision_advice())
+        action_name = self.decision_cache.lookup(
+            key, fingerprint, self.turn, self.last_taken_actions.get(key),
+            available_actions)
+        if action_name is not None:
+            fc_logger.debug(f'Reused {action_name!r} for {ctrl_type} ' +
+                            f'{actor_id}, its situation did not change.')
+        return action_name
+
     def check_is_new_turn(self, info):
         if info['turn'] != self.turn:
             self.is_new_turn = True
@@ -127,6 +176,7 @@ class LanguageAgent(BaseAgent):
             for entity_id in death_entities[entity_type]:
                 self.remove_entity(entity_type, entity_id)
 
+    @traced('handle_new_turn')
     def handle_new_turn(self, observations, info):
         self.process_observations_and_info(observations, info)
         birth_entities, death_entities = self.get_birth_death_entities(info)
@@ -134,7 +184,8 @@ class LanguageAgent(BaseAgent):
         self.handle_dead_entities(death_entities)
 
         self.chosen_actions = Queue()
-        self.make_decisions()
+        with get_tracer().span('make_decisions', turn=self.turn):
+            self.make_decisions()
 
         self.is_new_turn = False
 
@@ -157,9 +208,15 @@ class LanguageAgent(BaseAgent):
 
     @final
     def act(self, observations, info):
+        with get_tracer().span('act', turn=info['turn']):
+            return self._act(observations, info)
+
+    def _act(self, observations, info):
         self.check_is_new_turn(info)
         if self.is_new_turn:
             self.current_deconflict_depth = 0
+            get_retry_policy().new_turn()
+            get_usage_ledger().new_turn(self.turn)
             self.handle_new_turn(observations, info)
 
         while self.current_deconflict_depth < self.max_deconflict_depth:
@@ -16,14 +16,21 @@
 import pickle
 import os
 import time
-import threading
+
+from civrealm.freeciv.utils.freeciv_logging import fc_logger
+
 from .baselang_agent import BaseLangAgent
-from .workers import MastabaWorker
+from .advisor_summary import AdvisorSummary
+from .workers import MastabaWorker, WorkerPool
+from .civ_autogpt.utils import traced, get_tracer
 from agents.redundants.improvement_consts import UNIT_TYPES, IMPR_TYPES
 from config import INDIVIDUAL_PROMPT_DEFAULT, PROMPT_SOLUTIONS
 
 
 class MastabaAgent(BaseLangAgent):
+    batch_instruction_prompt = "hierarchical_batch_instruction_prompt"
+    batch_task_prompt = "hierarchical_task_prompt"
+
     def __init__(
             self,
             use_entity_individual_prompt: bool = INDIVIDUAL_PROMPT_DEFAULT,
@@ -31,10 +38,12 @@ class MastabaAgent(BaseLangAgent):
         super().__init__(**kwargs)
         self.use_entity_individual_prompt = use_entity_individual_prompt
         self.general_advise = ""
+        self.advisor_summary = None
 
     def initialize_workers(self):
         self.strategy_maker = MastabaWorker(role="advisor")
         self.workers = {}
+        self.worker_pool = WorkerPool()
 
     def add_entity(self, entity_type, entity_id):
 
@@ -45,77 +54,28 @@ class MastabaAgent(BaseLangAgent):
             prompt_prefix = PROMPT_SOLUTIONS[name]
         else:
             prompt_prefix = PROMPT_SOLUTIONS['vanilla']
-        self.workers[(entity_type,
-                      entity_id)] = MastabaWorker(ctrl_type=entity_type,
-                                                  actor_id=entity_id,
-                                                  prompt_prefix=prompt_prefix)
+        self.workers[(entity_type, entity_id)] = self.worker_pool.acquire(
+            MastabaWorker,
+            ctrl_type=entity_type,
+            actor_id=entity_id,
+            prompt_prefix=prompt_prefix)
 
     def get_advisor_input_prompt(self, obs, info):
         """
         Generate input prompt for advisor.
         """
-        munit_num_self = 0  # millitary units
-        wunit_num_self = 0  # working units
-        unit_num_enemy = 0
-        city_num_self = 0
-        city_size_self = 0
-        city_num_other = 0
-        city_num_enemy = 0
-        units = {}
-        # add ['self_id'] to info['llm_info']
-
-        for key, val in obs['unit'].items():
-            if val['owner'] == info['my_player_id']:
-                unit_name = val['type_rule_name']
-                units[unit_name] = units.get(unit_name, 0) + 1
-                if val['type_attack_strength'] == 0:
-                    wunit_num_self += 1
-                else:
-                    munit_num_self += 1
-
-            if obs['dipl'][val['owner']]['diplomatic_state'] == 1:
-                unit_num_enemy += 1
-
-        for key, val in obs['city'].items():
-            if val['granary_size'] >= 0:
-                city_num_self += 1
-                city_size_self += val['size']
-                continue
-            if obs['map']['status'][val['x'], val['y']] <= 1:
-                # if a city is not in current view (but in war fog)
-                # it is not counted.
-                continue
-            if obs['dipl'][val['owner']]['diplomatic_state'] == 1:
-                city_num_enemy += 1
-                continue
-            city_num_other += 1
-
-        # handwritten conditions, change it later.
-        if (unit_num_enemy > munit_num_self / 5
-                and city_num_enemy < unit_num_enemy):
-            war_state = "We are under attack."
-        elif city_num_enemy >= 3 and unit_num_enemy < munit_num_self:
-            war_state = "We are attacking other players."
-        elif unit_num_enemy == 0 and city_num_enemy < 4:
-            war_state = "We are in peace."
-        else:
-            war_state = "We are roughly safe."
-
-        unit_spec_prompt = (
-            f"We have {wunit_num_self+munit_num_self} units: " +
-            ", ".join(map(lambda x: f"{x[1]} {x[0]}", units.items())))
-        return_prompt = " ".join([
-            unit_spec_prompt, f"and we can see {unit_num_enemy} enemy units.",
-            f"We have {city_num_self} cities of total size {city_size_self}.",
-            f"We can see {city_num_enemy} enemy cities, ",
-            f"and {city_num_other} other cities.", war_state
-        ])
-        return return_prompt
-
-    def get_obs_input_prompt(self, ctrl_type, actor_name, actor_dict,
-                             available_actions):
-        zoom_in_obs = actor_dict['observations']['minimap']
-        zoom_out_obs = actor_dict['observations']['upper_map']
+        self.advisor_summary = AdvisorSummary.from_observations(
+            obs, info['my_player_id'])
+        return self.advisor_summary.to_prompt()
+
+    def get_obs_input_prompt(self,
+                             ctrl_type,
+                             actor_name,
+                             actor_dict,
+                             available_actions,
+                             worker=None):
+        zoom_in_obs, zoom_out_obs = self.encode_observations(
+            actor_dict, ['minimap', 'upper_map'], worker)
         system_message = self.info['llm_info'].get("message", "")
         system_message = ("Game scenario message is: "
                           if system_message else "") + system_message
@@ -130,7 +90,7 @@ class MastabaAgent(BaseLangAgent):
                 ctrl_type=ctrl_type,
                 zoom_out_obs=zoom_out_obs,
                 zoom_in_obs=zoom_in_obs,
-                producint=producing,
+                producing=producing,
                 available_actions=available_actions,
                 general_advise=self.general_advise)
         elif ctrl_type == "unit":
@@ -143,6 +103,46 @@ class MastabaAgent(BaseLangAgent):
                 general_advise=self.general_advise)
         return prompt
 
+    def get_batch_actor_prompt(self, ctrl_type, actor_key, actor_dict,
+                               available_actions):
+        actor_name = actor_dict['name']
+        zoom_in_obs = self.obs_encoder.encode(
+            actor_dict['observations']['minimap'])
+        zoom_out_obs = self.obs_encoder.encode(
+            actor_dict['observations']['upper_map'])
+        prompt_handler = self.strategy_maker.prompt_handler
+
+        if ctrl_type == "city":
+            producing = actor_dict['observations'].get('producing', "NOTHING")
+            available_actions = available_actions + ['produce ' + producing]
+            prompt = prompt_handler.batch_city_obs(
+                actor_key=actor_key,
+                actor_name=actor_name,
+                ctrl_type=ctrl_type,
+                zoom_out_obs=zoom_out_obs,
+                zoom_in_obs=zoom_in_obs,
+                producing=producing,
+                available_actions=available_actions)
+        else:
+            prompt = prompt_handler.batch_unit_obs(
+                actor_key=actor_key,
+                actor_name=actor_name,
+                ctrl_type=ctrl_type,
+                zoom_out_obs=zoom_out_obs,
+                zoom_in_obs=zoom_in_obs,
+                available_actions=available_actions)
+        return prompt, available_actions
+
+    def get_batch_input_prompt(self, actor_prompts):
+        system_message = self.info['llm_info'].get("message", "")
+        system_message = ("Game scenario message is: "
+                          if system_message else "") + system_message
+        return system_message + self.strategy_maker.prompt_handler.batch_obs_action(
+            actor_num=len(actor_prompts),
+            actors="\n".join(actor_prompts),
+            general_advise=self.general_advise)
+
+    @traced('generate_general_advise')
     def generate_general_advise(self):
         """
         Generate general advise for all other workers.
@@ -164,31 +164,14 @@ class MastabaAgent(BaseLangAgent):
             ))
         return exec_action_name
 
+    def decision_advice(self):
+        return self.general_advise
+
     def make_decisions(self):
         if self.is_new_turn:
             self.general_advise = self.generate_general_advise()
 
-        threads = []
-        for ctrl_type in self.info['llm_info'].keys():
-            for actor_id, actor_dict in self.info['llm_info'][ctrl_type].items(
-            ):
-                if (self.last_taken_actions.get(
-                    (ctrl_type, actor_id), ["", -2])[1] == self.turn
-                        and ctrl_type != "unit"):
-                    print(
-                        f"{ctrl_type} {actor_id} tries a second move but rejected."
-                    )
-                    continue
-                thread = threading.Thread(target=self.make_single_decision,
-                                          args=(ctrl_type, actor_id,
-                                                actor_dict))
-                threads.append(thread)
-                thread.start()
-
-        for thread in threads:
-            thread.join()
-
-        # super().make_decisions()
+        super().make_decisions()
 
     def handle_conflict_actions(self, action):
         """
@@ -198,9 +181,31 @@ class MastabaAgent(BaseLangAgent):
         self.conflict_action_list += [action]
 
     def regenerate_conflict_actions(self, observations, info):
-        """Follow a similar logic of `make_decisions`."""
-
-        print("Regenerating_conflict_actions")
-        print(self.chosen_actions.qsize(), self.current_deconflict_depth)
-        # super().regenerate_conflict_actions(observations, info)
-        self.handle_new_turn(observations, info)
+        """
+        Decide again for the actors of `self.conflict_action_list` only,
+        with their current available actions and a note on the rejected
+        action.
+        """
+        self.process_observations_and_info(observations, info)
+        birth_entities, death_entities = self.get_birth_death_entities(info)
+        self.handle_new_entities(birth_entities)
+        self.handle_dead_entities(death_entities)
+
+        conflicts, self.conflict_action_list = self.conflict_action_list, []
+        targets = []
+        for ctrl_type, actor_id, action_name in conflicts:
+            actor_dict = info['llm_info'].get(ctrl_type, {}).get(actor_id)
+            key = (ctrl_type, actor_id)
+            if (actor_dict is None or key not in self.workers
+                    or key in self.rejected_actions):
+                continue
+            self.rejected_actions[key] = action_name
+            targets.append((ctrl_type, actor_id, actor_dict))
+        fc_logger.info(f'Regenerating the actions of {len(targets)} ' +
+                       'actors in conflict, depth ' +
+                       f'{self.current_deconflict_depth}.')
+        if targets:
+            with get_tracer().span('regenerate_conflict_actions',
+                                   actors=len(targets)):
+                self.run_async(self.amake_decisions(targets))
+        self.rejected_actions = {}
@@ -0,0 +1,198 @@
+# Copyright (C) 2023  The CivRealm project
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Encoders of the `minimap` and `upper_map` observations of an actor into
+the text of its prompt.
+
+An encoder has an `encode(observation)` method returning a string, and an
+`encode_delta(previous, observation)` method returning the changes since
+an observation sent before. The encoder of the agents is chosen by name
+with OBS_ENCODER, see `make_obs_encoder`.
+"""
+
+import os
+import re
+import string
+
+from config import OBS_ENCODER
+
+DIRECTIONS = re.compile(r"(north|south|east|west)_(\d+)")
+
+
+def grid_position(key):
+    """
+    Offsets (rows south, columns east) of a tile or block key of an
+    observation, e.g. (-2, 1) for 'tile_north_2_east_1' and (0, 0) for
+    'current_tile'. None if the key is not a position.
+    """
+    if key.startswith('current_'):
+        return 0, 0
+    row, col = 0, 0
+    offsets = DIRECTIONS.findall(key)
+    for direction, distance in offsets:
+        distance = int(distance)
+        if direction == 'north':
+            row -= distance
+        elif direction == 'south':
+            row += distance
+        elif direction == 'east':
+            col += distance
+        else:
+            col -= distance
+    if not offsets:
+        return None
+    return row, col
+
+
+def legend_codes():
+    """Codes of the legend: A, B, ..., Z, AA, AB, ..."""
+    letters = string.ascii_uppercase
+    for letter in letters:
+        yield letter
+    for first in letters:
+        for second in letters:
+            yield first + second
+
+
+class ObservationEncoder:
+    """Python repr of the observation, as the agents always did."""
+    name = 'repr'
+
+    def encode(self, observation) -> str:
+        return str(observation)
+
+    def encode_delta(self, previous, observation) -> str:
+        """
+        The tiles of `observation` whose features changed since `previous`,
+        encoded as an observation of their own, with tiles gone from view
+        left empty. None if the observations are not dicts of tiles.
+        """
+        if not isinstance(previous, dict) or not isinstance(
+                observation, dict):
+            return None
+        changes = {
+            key: features
+            for key, features in observation.items()
+            if previous.get(key) != features
+        }
+        changes.update(
+            {key: []
+             for key in previous if key not in observation})
+        if not changes:
+            return "unchanged since the last observation"
+        return ("changed since the last observation, other tiles are " +
+                "unchanged: " + self.encode(changes))
+
+
+class CompactGridEncoder(ObservationEncoder):
+    """
+    Legend of the features of the tiles (terrains, resources, units...)
+    coded by letters, followed by the tiles as a matrix, from the north row
+    to the south row and from west to east in a row. Cells are separated by
+    '|' and the features of a tile joined by '+'; empty tiles are left
+    empty.
+
+    Keys that are not positions are appended as `key: features`.
+    """
+    name = 'compact'
+
+    def encode(self, observation) -> str:
+        if not isinstance(observation, dict):
+            return str(observation)
+
+        cells = {}
+        extras = []
+        for key, features in observation.items():
+            position = grid_position(key)
+            if position is None:
+                extras.append((key, features))
+            else:
+                cells[position] = features
+        if not cells:
+            return str(observation)
+
+        codes = {}
+        new_codes = legend_codes()
+        encoded = {}
+        for position, features in cells.items():
+            for feature in features:
+                if feature not in codes:
+                    codes[feature] = next(new_codes)
+            encoded[position] = '+'.join(codes[feature]
+                                         for feature in features)
+
+        radius = max(max(abs(row), abs(col)) for row, col in cells)
+        side = 2 * radius + 1
+        rows = [
+            '|'.join(
+                encoded.get((row, col), '')
+                for col in range(-radius, radius + 1))
+            for row in range(-radius, radius + 1)
+        ]
+        lines = [
+            f"{side}x{side} grid centered on current, rows north to south, " +
+            "columns west to east, legend " +
+            ", ".join(f"{code}={feature}" for feature, code in codes.items())
+            + ":"
+        ] + rows
+        lines += [f"{key}: {features}" for key, features in extras]
+        return '\n'.join(lines)
+
+
+OBS_ENCODERS = {
+    encoder.name: encoder
+    for encoder in (ObservationEncoder, CompactGridEncoder)
+}
+
+
+def make_obs_encoder(name: str = None) -> ObservationEncoder:
+    """
+    Encoder called `name`, by default the one of the OBS_ENCODER
+    environment variable or config.
+    """
+    name = name or os.environ.get('OBS_ENCODER', OBS_ENCODER)
+    try:
+        return OBS_ENCODERS[name]()
+    except KeyError:
+        raise ValueError(f"Unknown observation encoder {name}, " +
+                         f"expected one of {list(OBS_ENCODERS)}.") from None
+
+
+def unit_test():
+    minimap = {
+        'current_tile': ['Grassland', '1 Settlers'],
+        'tile_north_1': ['Hills'],
+        'tile_south_1_east_1': ['Grassland', 'River'],
+        'tile_west_1': [],
+        'message': 'nothing'
+    }
+    assert CompactGridEncoder().encode(minimap) == '\n'.join([
+        "3x3 grid centered on current, rows north to south, columns west " +
+        "to east, legend A=Grassland, B=1 Settlers, C=Hills, D=River:",
+        "|C|", "|A+B|", "||A+D", "message: nothing"
+    ])
+    moved = dict(minimap, tile_north_1=['Hills', '1 Warriors'])
+    assert CompactGridEncoder().encode_delta(minimap, moved).endswith(
+        "3x3 grid centered on current, rows north to south, columns west " +
+        "to east, legend A=Hills, B=1 Warriors:\n|A+B|\n||\n||")
+    assert ObservationEncoder().encode_delta(minimap, dict(minimap)) == (
+        "unchanged since the last observation")
+    assert grid_position('block_north_1_west_1') == (-1, -1)
+    assert make_obs_encoder('repr').encode(minimap) == str(minimap)
+
+
+if __name__ == '__main__':
+    unit_test()
@@ -19,13 +19,18 @@ Base Prompt Handler @
 
 import os
 import re
-import copy
+import ast
 from civrealm.freeciv.utils.freeciv_logging import fc_logger
+from .prompt_registry import get_prompt_registry
 
-print(os.getcwd())
 PROMPT_ROOT_DIR = "./prompt_collections/"
 BASE_DIR = "base_prompts/"
 
+# `<% variable %>` and `<$ template(args) $>` slots of the templates.
+SEGMENT_PATTERN = re.compile(r"<%[ ]+(.*?)[ ]+%>|<\$[ ]+(.*?)[ ]+\$>")
+# Kinds of the segments of a compiled template.
+LITERAL, VARIABLE, SUBTEMPLATE, INVALID = range(4)
+
 
 class BasePromptHandler:
     """
@@ -34,20 +39,24 @@ class BasePromptHandler:
     Provides interface together with a basic implementation.
 
     The prompts can be in .txt format and can use `<% name %>` for certain
-    replacement of variables, provided the variables are given.
+    replacement of variables, provided the variables are given, and
+    `<$ name(key="value") $>` for other prompts of the same handler, called
+    with literal arguments. Templates are compiled once, when loaded, and
+    shared by the handlers of the same prompt prefix (see PromptRegistry).
 
-    [TODO] How to implement `if` and `for` in the setup? I think importing
-    python scripts could be a solution, but another processor must be written.
+    See SIGPromptHandler for templates with `if` and `for` statements.
     """
     CONF_FNAME = "__settings__.conf"
 
-    def __init__(self, prompt_prefix: str = BASE_DIR):
+    def __init__(self, prompt_prefix: str = BASE_DIR, _registry=None):
         """
         Initialize.
 
         Parameters
         ----------
         prompt_prefix: str, must be a folder in a relative form.
+        _registry: PromptRegistry sharing the templates, by default the
+            process-wide one. False to load the templates privately.
         """
         self.prompt_prefix = PROMPT_ROOT_DIR + self._ending_dir(prompt_prefix)
         if not os.path.exists(self.prompt_prefix):
@@ -58,12 +67,26 @@ class BasePromptHandler:
                     f"Prompt prefix dir `{prompt_prefix}` does not exist! " +
                     f"Use 'example' for {PROMPT_ROOT_DIR}example/," +
                     "or simply the full path.")
+        if _registry is not False:
+            collection = (_registry or get_prompt_registry()).get(
+                type(self), self.prompt_prefix)
+            self.templates = collection.templates
+            self.related_pclasses = collection.related_pclasses
+            return
         self.templates = {}
         self.related_pclasses = [self.prompt_prefix]
         self._solve_dependency()
         for prefix in reversed(self.related_pclasses):
             self._load_prompt_templates(prefix)
 
+    def __getattr__(self, name: str):
+        """Templates are attributes of the handler, e.g. `insist_json()`."""
+        templates = self.__dict__.get("templates")
+        if templates is not None and name in templates:
+            return templates[name]
+        raise AttributeError(
+            f"'{type(self).__name__}' has no template or attribute '{name}'")
+
     @staticmethod
     def _ending_dir(path: str):
         """Complete '/' to the end of a dir-path."""
@@ -101,54 +124,99 @@ class BasePromptHandler:
                     self.related_pclasses.append(path)
                     pclass.append(path)
 
+    def _compile_call(self, call: str, template_name: str) -> tuple:
+        """
+        Resolve the sub-template call `call`, e.g. `name(key="value")`, into
+        the name of the template and its arguments. The arguments must be
+        literals. Raises ValueError for any other expression.
+        """
+        tree = ast.parse(call.strip(), mode="eval").body
+        name = tree.id if isinstance(tree, ast.Name) else getattr(
+            getattr(tree, "func", None), "id", None)
+        if name is None:
+            raise ValueError(f"`{call}` is not a call of a template.")
+        if name == template_name:
+            raise ValueError("Self-quoted!")
+        if isinstance(tree, ast.Name):
+            return name, (), {}
+        args = tuple(ast.literal_eval(arg) for arg in tree.args)
+        kwargs = {
+            keyword.arg: ast.literal_eval(keyword.value)
+            for keyword in tree.keywords
+        }
+        if None in kwargs:
+            raise ValueError(f"`{call}` unpacks its arguments.")
+        return name, args, kwargs
+
+    def _compile(self, raw: str, template_name: str) -> list:
+        """
+        Compile `raw` into a list of segments, each (LITERAL, text),
+        (VARIABLE, key) or (SUBTEMPLATE, (name, args, kwargs)). A
+        sub-template that cannot be resolved is (INVALID, (call, error)),
+        reported when rendered.
+        """
+        segments = []
+        position = 0
+        for match in SEGMENT_PATTERN.finditer(raw):
+            if match.start() > position:
+                segments.append((LITERAL, raw[position:match.start()]))
+            position = match.end()
+            variable, call = match.group(1, 2)
+            if variable is not None:
+                segments.append((VARIABLE, variable))
+                continue
+            try:
+                segments.append(
+                    (SUBTEMPLATE, self._compile_call(call, template_name)))
+            except (ValueError, SyntaxError) as einfo:
+                segments.append((INVALID, (call, einfo)))
+        if position < len(raw):
+            segments.append((LITERAL, raw[position:]))
+        return segments
+
     def _txt_parser(self, raw: str, template_name: str) -> callable:
+        """Compile `raw` once and return its renderer."""
+        segments = self._compile(raw, template_name)
+        if all(kind == LITERAL for kind, _ in segments):
+            constant = "".join(value for _, value in segments)
+
+            def constant_parser(_raise_empty: bool = False, **kwargs) -> str:
+                return constant
+
+            return constant_parser
+
         def parser(_raise_empty: bool = False, **kwargs) -> str:
-            nonlocal raw, template_name, self
-            variables = set(re.findall("(<%[ ]+(.*?)[ ]+%>)", raw))
-            recursions = set(re.findall(r"(<\$[ ]+(.*?)[ ]+\$>)", raw))
-
-            out = copy.deepcopy(raw)
-            for pattern, key in variables:
-                try:
-                    out = out.replace(pattern, str(kwargs[key]))
-                    # I decide not to use `kwargs.get(key, "")` in order to
-                    # log the incidents when key is not provided in args.
-                except KeyError as einfo:
-                    fc_logger.error(f"Failed to provide key {key}" +
+            out = []
+            for kind, value in segments:
+                if kind == LITERAL:
+                    out.append(value)
+                elif kind == VARIABLE:
+                    try:
+                        out.append(str(kwargs[value]))
+                        # I decide not to use `kwargs.get(key, "")` in order
+                        # to log the incidents when key is not provided.
+                    except KeyError:
+                        fc_logger.error(f"Failed to provide key {value}" +
+                                        f" in generating {template_name}.")
+                        if _raise_empty:
+                            raise
+                elif kind == SUBTEMPLATE:
+                    name, args, call_kwargs = value
+                    try:
+                        out.append(getattr(self, name)(*args, **call_kwargs))
+                    except Exception as einfo:
+                        fc_logger.error(f"Failed to load submodule {name}" +
+                                        f" in generating {template_name}.")
+                        fc_logger.error(einfo)
+                        if _raise_empty:
+                            raise
+                else:
+                    fc_logger.error(f"Failed to load submodule {value[0]}" +
                                     f" in generating {template_name}.")
-                    fc_logger.error(einfo)
-                    print(f"Failed to provide key {key}" +
-                          f" in generating {template_name}.")
+                    fc_logger.error(value[1])
                     if _raise_empty:
-                        raise
-                    out = out.replace(pattern, "")
-            for pattern, key in recursions:
-                try:
-                    func_end = key.find("(")
-                    if func_end == -1:
-                        key = key + "()"
-                        func_end = -2
-                    if key[:func_end] == template_name:
-                        print("Should raise")
-                        raise Exception("Self-quoted!")
-                    # replace = eval(
-                    #     f"self.generate['{key[:func_end]}']({key[func_end:]})")
-                    # print(self.templates.keys())
-                    replace = eval("self." + key)
-
-                    print(replace)
-                    out = out.replace(pattern, replace)
-                except Exception as einfo:
-                    fc_logger.error(f"Failed to load submodule {key}" +
-                                    f" in generating {template_name}.")
-                    fc_logger.error(einfo)
-                    print(f"Failed to load submodule {key}" +
-                          f" in generating {template_name}.")
-                    print(einfo)
-                    if _raise_empty:
-                        raise
-                    out = out.replace(pattern, "")
-            return out
+                        raise value[1]
+            return "".join(out)
 
         return parser
 
@@ -158,7 +226,7 @@ class BasePromptHandler:
             files = list(os.walk(prefix))[0][2]
 
         except Exception as einfo:
-            print("Error in loading prompt files.", einfo)
+            fc_logger.error(f"Error in loading prompt files: {einfo}")
             raise einfo
 
         for fname in [
@@ -167,11 +235,11 @@ class BasePromptHandler:
         ]:
             with open(prefix + fname + ".txt", "r", encoding="utf-8") as filep:
                 raw = filep.read()
-            key = self._regularize(fname)
-            # self.templates[key] = self._txt_parser(raw, key)
             self.templates[fname] = self._txt_parser(raw, fname)
-            # This should provide a runtime-object-level method management.
-            setattr(self, key, self.templates[fname])
+            # Attribute-friendly alias, e.g. for `a.b.txt`.
+            key = self._regularize(fname)
+            if key != fname:
+                self.templates[key] = self.templates[fname]
 
     def generate(self,
                  _prompt_key: str,
@@ -189,13 +257,13 @@ class BasePromptHandler:
         out : The prompt piece.
         """
         try:
-            return self.templates[_prompt_key](**kwargs)
+            template = self.templates[_prompt_key]
         except KeyError as einfo:
             fc_logger.error(
                 f"Keyerror {_prompt_key}: No such template registered.")
             fc_logger.error(einfo)
-            print(f"Keyerror {_prompt_key}: No such template registered.")
             raise
+        return template(_raise_empty=_raise_empty, **kwargs)
 
     # def add_prompt_prefix()
     # Maybe not a good idea?
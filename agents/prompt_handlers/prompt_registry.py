@@ -0,0 +1,134 @@
+# Copyright (C) 2023  The CivRealm project
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Prompt Registry @ Civ-LLMs
+
+Loads every prompt collection once per process and shares its compiled
+templates between the prompt handlers.
+"""
+
+import os
+import time
+import threading
+from civrealm.freeciv.utils.freeciv_logging import fc_logger
+
+from config import PROMPT_RELOAD_INTERVAL
+
+
+class PromptCollection:
+    """The compiled templates of a prompt prefix and of its parents."""
+    def __init__(self, templates: dict, related_pclasses: list,
+                 signature: tuple):
+        self.templates = templates
+        self.related_pclasses = related_pclasses
+        self.signature = signature
+        self.checked_at = time.monotonic()
+
+
+def collection_signature(related_pclasses: list) -> tuple:
+    """The mtimes of the prompt directories and of their files."""
+    signature = []
+    for prefix in related_pclasses:
+        signature.append((prefix, os.stat(prefix).st_mtime_ns))
+        with os.scandir(prefix) as entries:
+            for entry in entries:
+                if entry.is_file():
+                    signature.append(
+                        (entry.path, entry.stat().st_mtime_ns))
+    return tuple(sorted(signature))
+
+
+class PromptRegistry:
+    """
+    Thread-safe registry of prompt collections, keyed by handler class and
+    prompt prefix.
+
+    A collection is loaded by a private handler of the class the first time
+    it is requested. Later requests get the same templates dict, and the
+    files are only checked again after `reload_interval` seconds. When
+    their mtimes changed, the collection is reloaded and its templates dict
+    updated in place, so that the existing handlers see the new templates.
+    """
+    def __init__(self, reload_interval: float = PROMPT_RELOAD_INTERVAL):
+        self.reload_interval = reload_interval
+        self.loads = 0
+        self._collections = {}
+        self._lock = threading.Lock()
+
+    def _load(self, handler_class, prompt_prefix: str) -> tuple:
+        loader = handler_class(prompt_prefix, _registry=False)
+        self.loads += 1
+        return loader, collection_signature(loader.related_pclasses)
+
+    def get(self, handler_class, prompt_prefix: str) -> PromptCollection:
+        """The collection of `prompt_prefix`, compiled by `handler_class`."""
+        key = (handler_class, os.path.abspath(prompt_prefix))
+        collection = self._collections.get(key)
+        if (collection is not None and time.monotonic() -
+                collection.checked_at < self.reload_interval):
+            return collection
+
+        with self._lock:
+            collection = self._collections.get(key)
+            if collection is None:
+                loader, signature = self._load(handler_class, prompt_prefix)
+                collection = PromptCollection(loader.templates,
+                                              loader.related_pclasses,
+                                              signature)
+                self._collections[key] = collection
+            elif (time.monotonic() - collection.checked_at >=
+                  self.reload_interval):
+                self._reload(collection, handler_class, prompt_prefix)
+        return collection
+
+    def _reload(self, collection, handler_class, prompt_prefix):
+        collection.checked_at = time.monotonic()
+        try:
+            if collection_signature(
+                    collection.related_pclasses) == collection.signature:
+                return
+            loader, signature = self._load(handler_class, prompt_prefix)
+        except Exception as einfo:
+            # e.g. a template being edited, keep the loaded one meanwhile.
+            fc_logger.error(f"Failed to reload prompts {prompt_prefix}.")
+            fc_logger.error(einfo)
+            return
+        templates = collection.templates
+        stale = set(templates) - set(loader.templates)
+        templates.update(loader.templates)
+        for name in stale:
+            del templates[name]
+        # Sub-templates of the new templates resolve in the shared dict.
+        loader.templates = templates
+        collection.related_pclasses[:] = loader.related_pclasses
+        collection.signature = signature
+        fc_logger.info(f"Reloaded prompts {prompt_prefix}.")
+
+    def clear(self):
+        with self._lock:
+            self._collections.clear()
+
+
+_prompt_registry = None
+_prompt_registry_lock = threading.Lock()
+
+
+def get_prompt_registry() -> PromptRegistry:
+    """Return the process-wide prompt registry."""
+    global _prompt_registry
+    with _prompt_registry_lock:
+        if _prompt_registry is None:
+            _prompt_registry = PromptRegistry()
+    return _prompt_registry
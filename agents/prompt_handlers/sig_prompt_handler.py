@@ -16,14 +16,58 @@
 Base Prompt Handler @ Civ-LLMs
 """
 
-import os
 import re
+import ast
+import operator
 from civrealm.freeciv.utils.freeciv_logging import fc_logger
-from .base_prompt_handler import BasePromptHandler
+from .base_prompt_handler import BasePromptHandler, PROMPT_ROOT_DIR
 
-print(os.getcwd())
-PROMPT_ROOT_DIR = "./prompt_collections/"
-BASE_DIR = "base_prompts/"
+# `<% variable %>`, `<$ segment $>` and `<& statement &>` tags.
+TAG_PATTERN = re.compile(R"<([%$&])[ ]+(.*?)[ ]+\1>")
+FOR_PATTERN = re.compile(R"for[ ]+[$%]?([A-Za-z_]\w*)[ ]+in[ ]+(.+)")
+# Sigils of the expressions and the `..` of ranges, outside of strings.
+SIGIL_PATTERN = re.compile(R"""("(?:\\.|[^"\\])*"|'(?:\\.|[^'\\])*')""" +
+                           R"|(?<!\.)\.\.(?!\.)|[%$](?=[A-Za-z_])")
+
+BINARY_OPERATORS = {
+    ast.Add: operator.add,
+    ast.Sub: operator.sub,
+    ast.Mult: operator.mul,
+    ast.Div: operator.truediv,
+    ast.FloorDiv: operator.floordiv,
+    ast.Mod: operator.mod
+}
+UNARY_OPERATORS = {
+    ast.Not: operator.not_,
+    ast.USub: operator.neg,
+    ast.UAdd: operator.pos
+}
+COMPARE_OPERATORS = {
+    ast.Eq: operator.eq,
+    ast.NotEq: operator.ne,
+    ast.Lt: operator.lt,
+    ast.LtE: operator.le,
+    ast.Gt: operator.gt,
+    ast.GtE: operator.ge,
+    ast.Is: operator.is_,
+    ast.IsNot: operator.is_not,
+    ast.In: lambda a, b: a in b,
+    ast.NotIn: lambda a, b: a not in b
+}
+# Functions callable in expressions; any other call is a prompt segment.
+SAFE_FUNCTIONS = {
+    'len': len,
+    'str': str,
+    'int': int,
+    'min': min,
+    'max': max,
+    'sorted': sorted,
+    'enumerate': enumerate
+}
+
+
+class TemplateSyntaxError(ValueError):
+    """A template of SIGPromptHandler cannot be parsed."""
 
 
 class SIGPromptHandler(BasePromptHandler):
@@ -32,14 +76,25 @@ class SIGPromptHandler(BasePromptHandler):
 
     `<% variable_name %>` for certain variable names
     `<$ prompt_segment_name $>` for prompt segments defined in the same dir.
-    `<& if expr() &>` for python-style if and `<& endif &>` strictly required
+    `<& if expr &>`, `<& elif expr &>`, `<& else &>` for python-style
+        conditions, `<& endif &>` strictly required
     `<& for $x in %A &>` if `A` exists, then iterate over A,
         or use [1,..,n] for numbers,
         or ["a",1,22,"bc"] for combination of numbers and strings
         or [%a,%b,%c] %a for variables, grouped
         or [$seg1(param), $seg2(param)] for other segments!
         ALL the above 4 formats could be used together
-        for loop should end with `<& endfor &>`
+        for loop should end with `<& endfor &>`, and `<% x %>` is the
+        current item inside of it
+
+    Expressions are python expressions of literals, variables (`%a` or `a`),
+    segments (`$seg(param)`), operators, comparisons, subscripts and the
+    functions of SAFE_FUNCTIONS. A `<& &>` tag alone on its line removes the
+    line from the prompt.
+
+    Templates are parsed once, when loaded, into a tree of closures, and
+    expressions are compiled into closures as well, so rendering does no
+    parsing at all.
     """
     def _txt_parser(self, raw: str, template_name: str) -> callable:
         """
@@ -47,135 +102,414 @@ class SIGPromptHandler(BasePromptHandler):
 
         For efficiency, try not to parse the raw for every prompt generation.
         """
+        if TAG_PATTERN.search(raw) is None:
 
-        full_list = []
-        full_list = re.split(R"(<(?P<symbol>[%$&]))[ ]+(.*?)[ ]+(?P=symbol)>",
-                             raw)
+            def constant_generator(_raise_empty: bool = False,
+                                   **kwargs) -> str:
+                return raw
+
+            return constant_generator
+
+        body = self._parse(raw, template_name)
 
         def generator(_raise_empty: bool = False, **kwargs) -> str:
-            nonlocal self, raw, template_name
-
-            cur_index = 0
-            out_list = []
-
-            # Decorator for do-something
-            def do_template(operation):
-                nonlocal cur_index, out_list
-
-                def inner(_raise_empty, key, kwargs):
-                    nonlocal out_list, flist
-                    try:
-                        operation(_raise_empty, key, kwargs)
-                        # I decide not to use `kwargs.get(key, "")` in order to
-                        # log the incidents when key is not provided in args.
-                    except KeyError as einfo:
-                        fc_logger.error(f"Failed to process {key}" +
-                                        f" in generating {template_name}.")
-                        fc_logger.error(einfo)
-                        print(f"Failed to process {key}" +
-                              f" in generating {template_name}.")
-                        if _raise_empty:
-                            raise
-
-                    return inner
-
-            # Decorator to detect is-something
-            def is_template(cap):
-                def inner(flist):
-                    if len(flist) <= 2:
-                        return False
+            out = []
+            for node in body:
+                node(kwargs, out, _raise_empty)
+            return "".join(out)
+
+        return generator
+
+    @staticmethod
+    def _tokenize(raw: str) -> list:
+        """
+        Split `raw` into ('text', text) and (symbol, content) tokens,
+        dropping the lines that only hold a `<& &>` tag.
+        """
+        tokens = []
+        position = 0
+        for match in TAG_PATTERN.finditer(raw):
+            start, end = match.span()
+            if match.group(1) == "&":
+                line_start = raw.rfind("\n", 0, start) + 1
+                line_end = raw.find("\n", end)
+                line_end = len(raw) if line_end == -1 else line_end + 1
+                if (line_start >= position
+                        and not raw[line_start:start].strip()
+                        and not raw[end:line_end].strip()):
+                    start, end = line_start, line_end
+            if start > position:
+                tokens.append(("text", raw[position:start]))
+            tokens.append(match.group(1, 2))
+            position = end
+        if position < len(raw):
+            tokens.append(("text", raw[position:]))
+        return tokens
+
+    def _parse(self, raw: str, template_name: str) -> list:
+        """Parse `raw` into the list of nodes of its body."""
+        root = []
+        # (statement, body being filled, if-node branches or None)
+        stack = [("root", root, None)]
+
+        def fail(message):
+            raise TemplateSyntaxError(f"{template_name}: {message}")
+
+        for symbol, content in self._tokenize(raw):
+            body = stack[-1][1]
+            if symbol == "text":
+                body.append(self._text_node(content))
+            elif symbol == "%":
+                body.append(self._var_node(content, template_name))
+            elif symbol == "$":
+                body.append(self._segment_node(content, template_name))
+            elif content.startswith("if "):
+                branches, else_body = [], []
+                branch_body = []
+                branches.append(
+                    (self._expression(content[3:], template_name),
+                     branch_body))
+                body.append(
+                    self._if_node(branches, else_body, content,
+                                  template_name))
+                stack.append(("if", branch_body, (branches, else_body)))
+            elif content.startswith("elif ") or content == "else":
+                statement, _, if_node = stack[-1]
+                if statement != "if":
+                    fail(f"`{content}` outside of an if.")
+                stack.pop()
+                branches, else_body = if_node
+                if content == "else":
+                    stack.append(("else", else_body, None))
+                    continue
+                branch_body = []
+                branches.append(
+                    (self._expression(content[5:], template_name),
+                     branch_body))
+                stack.append(("if", branch_body, if_node))
+            elif content == "endif":
+                if stack[-1][0] not in ("if", "else"):
+                    fail("`endif` without an if.")
+                stack.pop()
+            elif content.startswith("for "):
+                match = FOR_PATTERN.fullmatch(content)
+                if match is None:
+                    fail(f"`{content}` is not `for $x in iterable`.")
+                loop_body = []
+                body.append(
+                    self._for_node(
+                        match.group(1),
+                        self._expression(match.group(2), template_name),
+                        loop_body, content, template_name))
+                stack.append(("for", loop_body, None))
+            elif content == "endfor":
+                if stack[-1][0] != "for":
+                    fail("`endfor` without a for.")
+                stack.pop()
+            else:
+                fail(f"Unknown statement `{content}`.")
+        if len(stack) > 1:
+            fail(f"`{stack[-1][0]}` is not closed.")
+        return root
+
+    @staticmethod
+    def _text_node(text):
+        def node(scope, out, raise_empty):
+            out.append(text)
 
-                    return cap(flist)
-
-                return inner
-
-            @is_template
-            def is_var(flist):
-                return flist[0] == "<%" and flist[1] == "%"
-
-            @do_template
-            def do_var(_raise_empty, key, kwargs):
-                nonlocal out_list, cur_index
-                out_list += [str(kwargs[key])]
-                cur_index += 3
-
-            @is_template
-            def is_prompt(flist):
-                return flist[0] == "<$" and flist[1] == "$"
-
-            @is_template
-            def is_if(flist):
-                if flist[0] != "<&" or flist[1] != "&":
-                    return False
-                if flist[2] == "if" or flist[2][:3] == "if ":
-                    return True
-                return False
-
-            @is_template
-            def is_endif(flist):
-                if flist[0] != "<&" or flist[1] != "&":
-                    return False
-                if flist[2] == "endif":
-                    return True
-                return False
-
-            @is_template
-            def is_elif(flist):
-                if flist[0] != "<&" or flist[1] != "&":
-                    return False
-                if flist[4] == "elif" or flist[2][:5] == "elif ":
-                    return True
-                return False
-
-            @is_template
-            def is_else(flist):
-                if flist[0] != "<&" or flist[1] != "&":
-                    return False
-                if flist[2] == "if" or flist[2][:3] == "if ":
-                    return True
-                return False
-
-            @do_template
-            def do_if(_raise_empty, key, kwargs, else_stat=2):
-                """else_stat: 1 for else, 3 for if and 5 for else."""
-                nonlocal out_list, cur_index
+        return node
+
+    def _var_node(self, key, template_name):
+        if not key.isidentifier():
+            expression = self._expression(key, template_name)
+            return self._guarded(lambda scope: str(expression(scope)), key,
+                                 template_name)
+
+        def node(scope, out, raise_empty):
+            try:
+                out.append(str(scope[key]))
+                # I decide not to use `kwargs.get(key, "")` in order to
+                # log the incidents when key is not provided in args.
+            except KeyError:
+                fc_logger.error(f"Failed to provide key {key}" +
+                                f" in generating {template_name}.")
+                if raise_empty:
+                    raise
+
+        return node
+
+    def _segment_node(self, call, template_name):
+        try:
+            expression = self._expression(call, template_name, segment=True)
+        except TemplateSyntaxError as einfo:
+            # As in BasePromptHandler, e.g. self-quoted segments of the
+            # test prompts, reported when rendered.
+            def expression(scope, error=einfo):
+                raise error
+
+        return self._guarded(expression, call, template_name)
+
+    @staticmethod
+    def _guarded(expression, source, template_name):
+        """Node writing the value of `expression`, logging its errors."""
+        def node(scope, out, raise_empty):
+            try:
+                out.append(expression(scope))
+            except Exception as einfo:
+                fc_logger.error(f"Failed to process {source}" +
+                                f" in generating {template_name}.")
+                fc_logger.error(einfo)
+                if raise_empty:
+                    raise
+
+        return node
+
+    @staticmethod
+    def _run(body, scope, out, raise_empty):
+        for node in body:
+            node(scope, out, raise_empty)
+
+    def _if_node(self, branches, else_body, source, template_name):
+        run = self._run
+
+        def node(scope, out, raise_empty):
+            for condition, body in branches:
                 try:
-                    if else_stat == 1:
-                        pass
-                except:
-                    pass
-
-            @is_template
-            def is_for(flist):
-                return flist[0] == "<&" and flist[1] == "&" and flist[
-                    2][:4] == "for "
-
-            stack = []
-            while cur_index < len(full_list):
-                if is_if(full_list[cur_index:]):
-                    if do_if(_raise_empty, full_list[cur_index + 2], kwargs):
-                        stack += [(1, cur_index)]
-                    else:
-                        stack += [(0, cur_index)]
-                if is_endif(full_list[cur_index:]):
-                    stack.pop(-1)
-                cur_index += 1
-
-            # def dfs(**kwargs):
-            #     nonlocal out_list, flist
-
-            #     while not is_for(flist):
-
-            #         if is_var(flist):
-            #             do_var(_raise_empty, flist[2], kwargs)
-            #             continue
-            #         if is_if(flist):
-            #             do_if(_raise_empty, flist[2:], kwargs)
-            #         if is_prompt(flist):
-            #             pass
-            #     # return out_list
-
-            # dfs(**kwargs)
-            return "".join(out_list)
+                    value = condition(scope)
+                except Exception as einfo:
+                    fc_logger.error(f"Failed to process {source}" +
+                                    f" in generating {template_name}.")
+                    fc_logger.error(einfo)
+                    if raise_empty:
+                        raise
+                    value = False
+                if value:
+                    run(body, scope, out, raise_empty)
+                    return
+            run(else_body, scope, out, raise_empty)
 
-        return generator
+        return node
+
+    def _for_node(self, target, iterable, body, source, template_name):
+        run = self._run
+        missing = object()
+
+        def node(scope, out, raise_empty):
+            try:
+                items = iterable(scope)
+                iter(items)
+            except Exception as einfo:
+                fc_logger.error(f"Failed to process {source}" +
+                                f" in generating {template_name}.")
+                fc_logger.error(einfo)
+                if raise_empty:
+                    raise
+                return
+            shadowed = scope.get(target, missing)
+            try:
+                for item in items:
+                    scope[target] = item
+                    run(body, scope, out, raise_empty)
+            finally:
+                if shadowed is missing:
+                    scope.pop(target, None)
+                else:
+                    scope[target] = shadowed
+
+        return node
+
+    def _expression(self,
+                    source: str,
+                    template_name: str,
+                    segment: bool = False) -> callable:
+        """
+        Compile the expression `source` into a function of the scope. If
+        `segment`, `source` must be a call of a segment, sigil or not.
+        """
+        def replace(match):
+            if match.group(1) is not None:
+                return match.group(1)
+            return "..." if match.group(0) == ".." else ""
+
+        try:
+            tree = ast.parse(SIGIL_PATTERN.sub(replace, source.strip()),
+                             mode="eval").body
+            if segment:
+                if isinstance(tree, ast.Name):
+                    tree = ast.Call(func=tree, args=[], keywords=[])
+                if (not isinstance(tree, ast.Call)
+                        or not isinstance(tree.func, ast.Name)):
+                    raise ValueError("A segment must be called.")
+                if tree.func.id == template_name:
+                    raise ValueError("Self-quoted!")
+            return self._compile_node(tree)
+        except (SyntaxError, ValueError) as einfo:
+            raise TemplateSyntaxError(
+                f"{template_name}: `{source}`: {einfo}") from einfo
+
+    def _compile_node(self, tree) -> callable:
+        """Compile an expression node of the ast into a closure."""
+        compile_node = self._compile_node
+
+        if isinstance(tree, ast.Constant):
+            value = tree.value
+            return lambda scope: value
+
+        if isinstance(tree, ast.Name):
+            name = tree.id
+            return lambda scope: scope[name]
+
+        if isinstance(tree, (ast.List, ast.Tuple)):
+            return self._compile_sequence(tree)
+
+        if isinstance(tree, ast.BoolOp):
+            values = [compile_node(value) for value in tree.values]
+            if isinstance(tree.op, ast.And):
+
+                def all_of(scope):
+                    result = True
+                    for value in values:
+                        result = value(scope)
+                        if not result:
+                            return result
+                    return result
+
+                return all_of
+
+            def any_of(scope):
+                result = False
+                for value in values:
+                    result = value(scope)
+                    if result:
+                        return result
+                return result
+
+            return any_of
+
+        if isinstance(tree, ast.UnaryOp) and type(
+                tree.op) in UNARY_OPERATORS:
+            function = UNARY_OPERATORS[type(tree.op)]
+            operand = compile_node(tree.operand)
+            return lambda scope: function(operand(scope))
+
+        if isinstance(tree, ast.BinOp) and type(tree.op) in BINARY_OPERATORS:
+            function = BINARY_OPERATORS[type(tree.op)]
+            left, right = compile_node(tree.left), compile_node(tree.right)
+            return lambda scope: function(left(scope), right(scope))
+
+        if isinstance(tree, ast.Compare):
+            left = compile_node(tree.left)
+            comparisons = [(COMPARE_OPERATORS[type(op)], compile_node(right))
+                           for op, right in zip(tree.ops, tree.comparators)]
+
+            def compare(scope):
+                value = left(scope)
+                for function, right in comparisons:
+                    right_value = right(scope)
+                    if not function(value, right_value):
+                        return False
+                    value = right_value
+                return True
+
+            return compare
+
+        if isinstance(tree, ast.IfExp):
+            test = compile_node(tree.test)
+            body, orelse = compile_node(tree.body), compile_node(tree.orelse)
+            return lambda scope: body(scope) if test(scope) else orelse(scope)
+
+        if isinstance(tree, ast.Subscript):
+            value = compile_node(tree.value)
+            if isinstance(tree.slice, ast.Slice):
+                bounds = [
+                    compile_node(bound) if bound is not None else None
+                    for bound in (tree.slice.lower, tree.slice.upper,
+                                  tree.slice.step)
+                ]
+                return lambda scope: value(scope)[slice(*(
+                    bound(scope) if bound is not None else None
+                    for bound in bounds))]
+            index = compile_node(tree.slice)
+            return lambda scope: value(scope)[index(scope)]
+
+        if isinstance(tree, ast.Call) and isinstance(tree.func, ast.Name):
+            args = [compile_node(arg) for arg in tree.args]
+            if any(keyword.arg is None for keyword in tree.keywords):
+                raise ValueError("Unpacking of arguments is not supported.")
+            kwargs = [(keyword.arg, compile_node(keyword.value))
+                      for keyword in tree.keywords]
+            name = tree.func.id
+            function = SAFE_FUNCTIONS.get(name)
+
+            def call(scope):
+                segment = function or getattr(self, name)
+                return segment(*[arg(scope) for arg in args],
+                               **{key: value(scope)
+                                  for key, value in kwargs})
+
+            return call
+
+        raise ValueError(f"Unsupported expression `{ast.unparse(tree)}`.")
+
+    def _compile_sequence(self, tree) -> callable:
+        """
+        Compile a list or tuple, in which `...` (`..` in templates) between
+        two integers stands for the integers in between.
+        """
+        items = [
+            None if isinstance(item, ast.Constant) and item.value is ...
+            else self._compile_node(item) for item in tree.elts
+        ]
+        if items and (items[0] is None or items[-1] is None):
+            raise ValueError("A range needs both of its bounds.")
+        if None not in items:
+            return lambda scope: [item(scope) for item in items]
+
+        def sequence(scope):
+            out = []
+            expand = False
+            for item in items:
+                if item is None:
+                    expand = True
+                    continue
+                value = item(scope)
+                if expand:
+                    out.extend(range(out[-1] + 1, value))
+                    expand = False
+                out.append(value)
+            return out
+
+        return sequence
+
+
+def unit_test():
+    """The unit test."""
+    phandler = SIGPromptHandler(PROMPT_ROOT_DIR + "civ_prompts/")
+    render = phandler._txt_parser(
+        "Tiles:\n"
+        "<& for $tile in %tiles &>\n"
+        "- <% tile %><& if tile == %home &> (home)<& endif &>\n"
+        "<& endfor &>\n"
+        "<& if len(%advice) > 0 &>\n"
+        "Advice: <% advice %>\n"
+        "<& elif %turn > 1 &>\n"
+        "No advice this turn.\n"
+        "<& else &>\n"
+        "First turn.\n"
+        "<& endif &>\n"
+        "<& for $n in [1,..,3, %extra, 'x'] &><% n %> <& endfor &>\n"
+        "<$ insist_various_actions(action=%action) $>", "unit_test")
+    out = render(tiles=["ocean", "grassland"],
+                 home="grassland",
+                 advice="",
+                 turn=2,
+                 extra=7,
+                 action="goto")
+    assert out == ("Tiles:\n- ocean\n- grassland (home)\n" +
+                   "No advice this turn.\n1 2 3 7 x \n" +
+                   phandler.insist_various_actions(action="goto")), out
+    return out
+
+
+if __name__ == '__main__':
+    print(unit_test())
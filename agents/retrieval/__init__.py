@@ -0,0 +1,4 @@
+from .retrieval_service import RetrievalService, get_retrieval_service
+from .hashing_embeddings import HashingEmbeddings
+from .local_vector_store import LocalVectorStore, load_documents
+from .answer_cache import AnswerCache, get_answer_cache
@@ -0,0 +1,212 @@
+# Copyright (C) 2023  The CivRealm project
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import re
+import time
+import sqlite3
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from config import (ANSWER_CACHE_ENABLED, ANSWER_CACHE_SIZE, ANSWER_CACHE_TTL,
+                    ANSWER_CACHE_SIMILARITY, ANSWER_CACHE_PATH)
+
+PUNCTUATION_PATTERN = re.compile(r"[^\w\s]")
+
+
+def normalize_query(query: str) -> str:
+    """Lowercase `query` and drop its punctuation and extra spaces."""
+    return " ".join(PUNCTUATION_PATTERN.sub(" ", query.lower()).split())
+
+
+class AnswerCache:
+    """
+    Answers of the manual to the queries of the workers.
+
+    A query is looked up by its normalized text first. On a miss, and if
+    an embedding function is given, the cached query with the most similar
+    embedding is used when their cosine similarity reaches `similarity`.
+    The least recently used answers beyond `max_size` are evicted, and
+    answers older than `ttl` seconds expire. If `path` is given, the
+    answers are also kept in a SQLite file and loaded by the next game.
+    """
+    def __init__(self,
+                 max_size: int = 1024,
+                 ttl: float = None,
+                 similarity: float = 0.95,
+                 path: str = None,
+                 enabled: bool = True):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.similarity = similarity
+        self.path = path
+        self.enabled = enabled
+        self.exact_hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+
+        # normalized query -> (answer, unit vector or None, creation time)
+        self._entries = OrderedDict()
+        self._matrix = None
+        self._matrix_keys = []
+        self._lock = threading.Lock()
+        self._db = None
+        if path is not None:
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute("CREATE TABLE IF NOT EXISTS answers "
+                             "(query TEXT PRIMARY KEY, answer TEXT, "
+                             "vector BLOB, created REAL)")
+            self._db.commit()
+            self._load()
+
+    def _load(self):
+        rows = self._db.execute(
+            "SELECT query, answer, vector, created FROM answers "
+            "ORDER BY created DESC LIMIT ?", (self.max_size, )).fetchall()
+        for query, answer, vector, created in reversed(rows):
+            if vector is not None:
+                vector = np.frombuffer(vector, dtype=np.float32)
+            self._entries[query] = (answer, vector, created)
+        self._matrix = None
+
+    def _expired(self, created: float) -> bool:
+        return self.ttl is not None and time.time() - created > self.ttl
+
+    @staticmethod
+    def _unit(vector) -> np.ndarray:
+        vector = np.asarray(vector, dtype=np.float32)
+        return vector / max(float(np.linalg.norm(vector)), 1e-12)
+
+    def _closest(self, vector: np.ndarray):
+        """The key of the most similar cached query, or None."""
+        if self._matrix is None:
+            self._matrix_keys = [
+                key for key, (_, cached, _) in self._entries.items()
+                if cached is not None and cached.shape == vector.shape
+            ]
+            self._matrix = (np.stack([
+                self._entries[key][1] for key in self._matrix_keys
+            ]) if self._matrix_keys else np.zeros((0, vector.shape[0]),
+                                                  dtype=np.float32))
+        if not self._matrix_keys:
+            return None
+        scores = self._matrix @ vector
+        best = int(np.argmax(scores))
+        if scores[best] < self.similarity:
+            return None
+        return self._matrix_keys[best]
+
+    def _hit(self, key: str):
+        answer, _, created = self._entries[key]
+        if self._expired(created):
+            self._forget(key)
+            return None
+        self._entries.move_to_end(key)
+        return answer
+
+    def lookup(self, query: str, embed=None) -> tuple:
+        """
+        The cached answer to `query`, or None, and the embedding of the
+        query if `embed` was called to compute it.
+        """
+        if not self.enabled:
+            return None, None
+        key = normalize_query(query)
+        with self._lock:
+            if key in self._entries:
+                answer = self._hit(key)
+                if answer is not None:
+                    self.exact_hits += 1
+                    return answer, None
+        if embed is None:
+            with self._lock:
+                self.misses += 1
+            return None, None
+
+        vector = embed(query)
+        unit = self._unit(vector)
+        with self._lock:
+            closest = self._closest(unit)
+            answer = self._hit(closest) if closest is not None else None
+            if answer is not None:
+                self.semantic_hits += 1
+            else:
+                self.misses += 1
+        return answer, vector
+
+    def put(self, query: str, answer: str, vector=None):
+        if not self.enabled:
+            return
+        key = normalize_query(query)
+        unit = self._unit(vector) if vector is not None else None
+        created = time.time()
+        with self._lock:
+            self._entries[key] = (answer, unit, created)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._forget(next(iter(self._entries)))
+            self._matrix = None
+            if self._db is not None:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO answers VALUES (?, ?, ?, ?)",
+                    (key, answer,
+                     unit.tobytes() if unit is not None else None, created))
+                self._db.commit()
+
+    def _forget(self, key: str):
+        del self._entries[key]
+        self._matrix = None
+        if self._db is not None:
+            self._db.execute("DELETE FROM answers WHERE query = ?", (key, ))
+            self._db.commit()
+
+    def stats(self) -> dict:
+        with self._lock:
+            hits = self.exact_hits + self.semantic_hits
+            total = hits + self.misses
+            return {
+                "exact_hits": self.exact_hits,
+                "semantic_hits": self.semantic_hits,
+                "misses": self.misses,
+                "hit_rate": hits / total if total else 0.0,
+                "size": len(self._entries)
+            }
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._matrix = None
+            self.exact_hits = self.semantic_hits = self.misses = 0
+            if self._db is not None:
+                self._db.execute("DELETE FROM answers")
+                self._db.commit()
+
+
+_answer_cache = None
+_answer_cache_lock = threading.Lock()
+
+
+def get_answer_cache() -> AnswerCache:
+    """Return the process-wide answer cache, configured in config.py."""
+    global _answer_cache
+    with _answer_cache_lock:
+        if _answer_cache is None:
+            _answer_cache = AnswerCache(max_size=ANSWER_CACHE_SIZE,
+                                        ttl=ANSWER_CACHE_TTL,
+                                        similarity=ANSWER_CACHE_SIMILARITY,
+                                        path=ANSWER_CACHE_PATH,
+                                        enabled=ANSWER_CACHE_ENABLED)
+    return _answer_cache
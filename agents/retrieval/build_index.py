@@ -0,0 +1,77 @@
+# Copyright (C) 2023  The CivRealm project
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Build the local vector store of the manual, for VECTOR_STORE = "local".
+
+Usage, from the root of the repository:
+
+    python -m agents.retrieval.build_index --docs manual/
+    python -m agents.retrieval.build_index --docs manual/ rules.txt \
+        --embedding backend --index-name civrealm-mastaba
+
+The .txt and .md files of --docs are split into documents, embedded, and
+saved with their memory-mapped embedding matrix in
+LOCAL_INDEX_DIR/<index name>. The "hashing" embeddings need no network;
+"backend" uses the embedding model of the LLM backend, which then also
+embeds the queries.
+"""
+
+import os
+import time
+import argparse
+
+from config import LOCAL_INDEX_DIR, HASHING_EMBEDDING_DIM
+from .hashing_embeddings import HashingEmbeddings
+from .local_vector_store import LocalVectorStore, load_documents
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--docs',
+                        nargs='+',
+                        required=True,
+                        help='files or directories of the manual')
+    parser.add_argument('--index-name', default='civrealm-mastaba')
+    parser.add_argument('--out',
+                        help='output directory (default: ' +
+                        f'{LOCAL_INDEX_DIR}/<index name>)')
+    parser.add_argument('--embedding',
+                        choices=['hashing', 'backend'],
+                        default='hashing')
+    parser.add_argument('--dim', type=int, default=HASHING_EMBEDDING_DIM)
+    parser.add_argument('--chunk-size',
+                        type=int,
+                        default=1000,
+                        help='characters per document')
+    args = parser.parse_args()
+
+    documents = load_documents(args.docs, chunk_size=args.chunk_size)
+    if not documents:
+        parser.error(f'No .txt or .md document in {args.docs}.')
+    if args.embedding == 'hashing':
+        embedding = HashingEmbeddings(args.dim)
+    else:
+        from agents.backends import get_backend
+        embedding = get_backend().embedding_model()
+
+    out = args.out or os.path.join(LOCAL_INDEX_DIR, args.index_name)
+    start_time = time.perf_counter()
+    LocalVectorStore.build(documents, embedding, out, args.embedding)
+    print(f'{len(documents)} documents embedded in ' +
+          f'{time.perf_counter() - start_time:.2f} s, saved to {out}.')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,166 @@
+# Copyright (C) 2023  The CivRealm project
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import json
+
+import numpy as np
+from langchain.schema import Document
+
+from civrealm.freeciv.utils.freeciv_logging import fc_logger
+
+from .hashing_embeddings import HashingEmbeddings
+
+EMBEDDINGS_FNAME = "embeddings.npy"
+DOCUMENTS_FNAME = "documents.jsonl"
+META_FNAME = "meta.json"
+
+
+def load_documents(paths, chunk_size: int = 1000) -> list:
+    """
+    Split the .txt and .md files of `paths`, files or directories, into
+    documents of at most about `chunk_size` characters, on blank lines.
+    """
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, fnames in sorted(os.walk(path)):
+                files += [
+                    os.path.join(root, fname) for fname in sorted(fnames)
+                    if fname.endswith((".txt", ".md"))
+                ]
+        else:
+            files.append(path)
+
+    documents = []
+    for fname in files:
+        with open(fname, "r", encoding="utf-8") as filep:
+            paragraphs = [
+                paragraph.strip() for paragraph in filep.read().split("\n\n")
+                if paragraph.strip()
+            ]
+        chunk = ""
+        for paragraph in paragraphs + [None]:
+            if chunk and (paragraph is None
+                          or len(chunk) + len(paragraph) > chunk_size):
+                documents.append(
+                    Document(page_content=chunk,
+                             metadata={
+                                 "source": fname,
+                                 "chunk": len(documents)
+                             }))
+                chunk = ""
+            if paragraph is not None:
+                chunk = chunk + "\n\n" + paragraph if chunk else paragraph
+    return documents
+
+
+def embed_matrix(embedding, texts, batch_size: int = 256) -> np.ndarray:
+    """The normalized float32 embeddings of `texts`."""
+    rows = []
+    for start in range(0, len(texts), batch_size):
+        batch = texts[start:start + batch_size]
+        if isinstance(embedding, HashingEmbeddings):
+            rows.append(embedding.embed_array(batch))
+        else:
+            rows.append(
+                np.asarray(embedding.embed_documents(batch),
+                           dtype=np.float32))
+    matrix = np.concatenate(rows)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    return matrix / np.maximum(norms, 1e-12)
+
+
+class LocalVectorStore:
+    """
+    Vector store of the documents saved in `path` by `build`, searched
+    by cosine similarity with numpy over a memory-mapped embedding matrix.
+
+    It has the search methods of the langchain vector stores used by the
+    workers, so it replaces the Pinecone index. `embedding` must be the
+    embeddings the store was built with.
+    """
+    def __init__(self, path: str, embedding=None):
+        with open(os.path.join(path, META_FNAME), "r") as filep:
+            self.meta = json.load(filep)
+        self.embedding = embedding or HashingEmbeddings(self.meta["dim"])
+        self.matrix = np.load(os.path.join(path, EMBEDDINGS_FNAME),
+                              mmap_mode="r")
+        with open(os.path.join(path, DOCUMENTS_FNAME), "r",
+                  encoding="utf-8") as filep:
+            self.documents = [
+                Document(**json.loads(line)) for line in filep if line.strip()
+            ]
+        if self.matrix.shape[0] != len(self.documents):
+            raise ValueError(f"{path} has {self.matrix.shape[0]} " +
+                             f"embeddings for {len(self.documents)} documents.")
+
+    @classmethod
+    def build(cls, documents, embedding, path: str, embedding_name: str):
+        """Embed `documents` and save them with their matrix in `path`."""
+        os.makedirs(path, exist_ok=True)
+        matrix = embed_matrix(embedding,
+                              [document.page_content for document in documents])
+        np.save(os.path.join(path, EMBEDDINGS_FNAME), matrix)
+        with open(os.path.join(path, DOCUMENTS_FNAME), "w",
+                  encoding="utf-8") as filep:
+            for document in documents:
+                filep.write(
+                    json.dumps(
+                        {
+                            "page_content": document.page_content,
+                            "metadata": document.metadata
+                        },
+                        ensure_ascii=False) + "\n")
+        with open(os.path.join(path, META_FNAME), "w") as filep:
+            json.dump(
+                {
+                    "embedding": embedding_name,
+                    "dim": int(matrix.shape[1]),
+                    "documents": len(documents)
+                }, filep)
+        fc_logger.info(f"Saved {len(documents)} documents to {path}.")
+
+    def similarity_search_by_vector_with_score(self, embedding, k=4,
+                                               **kwargs):
+        vector = np.asarray(embedding, dtype=np.float32)
+        if vector.shape[0] != self.matrix.shape[1]:
+            raise ValueError(f"Query of dimension {vector.shape[0]} for " +
+                             f"an index of dimension {self.matrix.shape[1]}.")
+        scores = self.matrix @ vector
+        k = min(k, len(scores))
+        if k <= 0:
+            return []
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(self.documents[i], float(scores[i])) for i in top]
+
+    def similarity_search_by_vector(self, embedding, k=4, **kwargs):
+        return [
+            document for document, _ in
+            self.similarity_search_by_vector_with_score(embedding, k)
+        ]
+
+    def query_vector(self, query):
+        if isinstance(self.embedding, HashingEmbeddings):
+            return self.embedding.embed_array([query])[0]
+        return self.embedding.embed_query(query)
+
+    def similarity_search_with_score(self, query, k=4, **kwargs):
+        return self.similarity_search_by_vector_with_score(
+            self.query_vector(query), k)
+
+    def similarity_search(self, query, k=4, **kwargs):
+        return self.similarity_search_by_vector(self.query_vector(query), k)
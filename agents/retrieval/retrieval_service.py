@@ -0,0 +1,255 @@
+# Copyright (C) 2023  The CivRealm project
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import time
+import queue
+import threading
+from collections import deque
+from concurrent.futures import Future
+
+from civrealm.freeciv.utils.freeciv_logging import fc_logger
+
+from config import (RETRIEVAL_BATCH_WINDOW, RETRIEVAL_MAX_BATCH,
+                    RETRIEVAL_STATS_WINDOW, VECTOR_STORE, LOCAL_INDEX_DIR)
+from ..civ_autogpt.utils import get_tracer
+from .local_vector_store import LocalVectorStore
+
+LATENCY_FIELDS = ('wait', 'embedding', 'search', 'total')
+
+
+def percentile(samples, q):
+    samples = sorted(samples)
+    if not samples:
+        return 0.0
+    return samples[min(len(samples) - 1, int(q / 100 * len(samples)))]
+
+
+class RetrievalService:
+    """
+    One vector index handle and one embedding client for all the workers.
+
+    Queries are embedded by a background thread. It waits up to
+    `batch_window` seconds for other queries, then embeds at most
+    `max_batch` of them with one call of the embedding client. Each caller
+    then searches the index with its own query vector. The service is a
+    drop-in replacement of the index for the workers, with
+    `similarity_search` and `similarity_search_with_score`.
+
+    With `batched` False, e.g. for local embeddings, queries are embedded
+    in the calling thread.
+
+    The latency of the last `stats_window` queries is kept, split into the
+    wait for the batch, the embedding and the search.
+    """
+    def __init__(self,
+                 index,
+                 embedding,
+                 batch_window: float = RETRIEVAL_BATCH_WINDOW,
+                 max_batch: int = RETRIEVAL_MAX_BATCH,
+                 stats_window: int = RETRIEVAL_STATS_WINDOW,
+                 batched: bool = True):
+        self.index = index
+        self.embedding = embedding
+        self.batched = batched
+        self.batch_window = batch_window
+        self.max_batch = max_batch
+        self.queries = 0
+        self.batches = 0
+        self.embedded = 0
+
+        self._requests = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+        self._latencies = {
+            field: deque(maxlen=stats_window)
+            for field in LATENCY_FIELDS
+        }
+
+    def _ensure_thread(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._embed_loop,
+                                                name='retrieval-embedding',
+                                                daemon=True)
+                self._thread.start()
+
+    def _next_batch(self) -> list:
+        batch = [self._requests.get()]
+        deadline = time.perf_counter() + self.batch_window
+        while len(batch) < self.max_batch:
+            timeout = deadline - time.perf_counter()
+            try:
+                batch.append(
+                    self._requests.get(timeout=timeout) if timeout > 0 else
+                    self._requests.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _embed_loop(self):
+        while True:
+            batch = self._next_batch()
+            start_time = time.perf_counter()
+            try:
+                with get_tracer().span('retrieval.embed_batch',
+                                       cat='retrieval',
+                                       size=len(batch)):
+                    vectors = self.embedding.embed_documents(
+                        [query for query, _, _ in batch])
+            except Exception as e:
+                fc_logger.error(f'Embedding of {len(batch)} queries ' +
+                                f'failed: {repr(e)}')
+                for _, future, _ in batch:
+                    future.set_exception(e)
+                continue
+            end_time = time.perf_counter()
+            with self._lock:
+                self.batches += 1
+                self.embedded += len(batch)
+            for (_, future, submitted), vector in zip(batch, vectors):
+                future.set_result(
+                    (vector, start_time - submitted, end_time - start_time))
+
+    def embed_query(self, query: str) -> tuple:
+        """The embedding of `query`, the wait for its batch and the time of
+        the embedding call."""
+        if not self.batched:
+            start_time = time.perf_counter()
+            vector = self.embedding.embed_query(query)
+            return vector, 0.0, time.perf_counter() - start_time
+        future = Future()
+        self._ensure_thread()
+        self._requests.put((query, future, time.perf_counter()))
+        return future.result()
+
+    def _search(self, query, k, score, embedded=None):
+        vector, wait, embedding = embedded or self.embed_query(query)
+        search_start = time.perf_counter()
+        # The Pinecone store of langchain only searches by vector with the
+        # scores.
+        docs = self.index.similarity_search_by_vector_with_score(vector, k=k)
+        if not score:
+            docs = [doc for doc, _ in docs]
+        end_time = time.perf_counter()
+        with self._lock:
+            self.queries += 1
+            for field, latency in zip(
+                    LATENCY_FIELDS,
+                (wait, embedding, end_time - search_start,
+                 wait + embedding + end_time - search_start)):
+                self._latencies[field].append(latency)
+        return docs
+
+    def similarity_search(self,
+                          query: str,
+                          k: int = 4,
+                          embedded: tuple = None,
+                          **kwargs):
+        """Documents of the index closest to `query`. `embedded`, if given,
+        is the result of `embed_query` for it."""
+        return self._search(query, k, score=False, embedded=embedded)
+
+    def similarity_search_with_score(self,
+                                     query: str,
+                                     k: int = 4,
+                                     embedded: tuple = None,
+                                     **kwargs):
+        return self._search(query, k, score=True, embedded=embedded)
+
+    def stats(self) -> dict:
+        """Number of queries and batches, and latency percentiles in ms."""
+        with self._lock:
+            stats = {
+                'queries': self.queries,
+                'batches': self.batches,
+                'mean_batch_size':
+                (self.embedded / self.batches if self.batches else 0.0)
+            }
+            for field, samples in self._latencies.items():
+                stats[f'{field}_p50_ms'] = percentile(samples, 50) * 1000
+                stats[f'{field}_p95_ms'] = percentile(samples, 95) * 1000
+        return stats
+
+
+_retrieval_services = {}
+_retrieval_services_lock = threading.Lock()
+
+
+def create_retrieval_service(backend, index_name: str) -> RetrievalService:
+    """
+    The retrieval service of `index_name`: the index of `backend`, or with
+    VECTOR_STORE "local", the local store of LOCAL_INDEX_DIR/`index_name`
+    built by `python -m agents.retrieval.build_index`.
+    """
+    if os.environ.get('VECTOR_STORE', VECTOR_STORE) == 'local':
+        index = LocalVectorStore(os.path.join(LOCAL_INDEX_DIR, index_name))
+        if index.meta['embedding'] == 'hashing':
+            return RetrievalService(index, index.embedding, batched=False)
+        index.embedding = backend.embedding_model()
+        return RetrievalService(index, index.embedding)
+    embedding = backend.embedding_model()
+    return RetrievalService(backend.vector_index(index_name, embedding),
+                            embedding)
+
+
+def get_retrieval_service(backend, index_name: str) -> RetrievalService:
+    """Return the process-wide retrieval service of `index_name`, with the
+    index and the embedding client of `backend`."""
+    key = (backend.name, index_name)
+    with _retrieval_services_lock:
+        if key not in _retrieval_services:
+            _retrieval_services[key] = create_retrieval_service(
+                backend, index_name)
+    return _retrieval_services[key]
+
+
+def unit_test():
+    from langchain.docstore.document import Document
+    from langchain.vectorstores import VectorStore
+    from .hashing_embeddings import HashingEmbeddings
+
+    class PineconeLikeIndex(VectorStore):
+        """Searches by vector with scores only, as langchain's Pinecone."""
+        def __init__(self, texts):
+            self.docs = [Document(page_content=text) for text in texts]
+
+        def add_texts(self, texts, metadatas=None, **kwargs):
+            raise NotImplementedError
+
+        def similarity_search(self, query, k=4, **kwargs):
+            raise NotImplementedError
+
+        def similarity_search_by_vector_with_score(self, embedding, k=4):
+            return [(doc, 1.0 - rank / len(self.docs))
+                    for rank, doc in enumerate(self.docs[:k])]
+
+        @classmethod
+        def from_texts(cls, texts, embedding, metadatas=None, **kwargs):
+            return cls(texts)
+
+    service = RetrievalService(
+        PineconeLikeIndex(['Settlers build cities.', 'Workers build roads.']),
+        HashingEmbeddings(),
+        batched=False)
+    docs = service.similarity_search('settlers', k=1)
+    assert [doc.page_content for doc in docs] == ['Settlers build cities.']
+    docs = service.similarity_search_with_score('settlers', k=2)
+    assert [score for _, score in docs] == [1.0, 0.5]
+    assert service.stats()['queries'] == 2
+
+
+if __name__ == '__main__':
+    unit_test()
@@ -1,2 +1,4 @@
 from .gpt_worker import AzureGPTWorker
 from .mastaba_worker import MastabaWorker
+from .batch_worker import BatchWorker
+from .worker_pool import WorkerPool
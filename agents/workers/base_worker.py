@@ -15,6 +15,7 @@
 
 import time
 import random
+import asyncio
 from abc import ABC, abstractmethod
 from typing import Callable
 
@@ -23,24 +24,40 @@ from langchain.memory import ConversationSummaryBufferMemory
 from langchain.vectorstores import Pinecone
 
 from civrealm.freeciv.utils.freeciv_logging import fc_logger
-from ..civ_autogpt.utils import num_tokens_from_messages, extract_json, TOKEN_LIMIT_TABLE
+from ..civ_autogpt.utils import Dialogue, extract_json, TOKEN_LIMIT_TABLE, CircuitOpenError, get_retry_policy, get_tracer, traced, get_usage_ledger
+from ..retrieval import RetrievalService, get_answer_cache
 
 
 class BaseWorker(ABC):
+    role = "controller"
+
     def __init__(self, model: str, ctrl_type:str="null", actor_id:int=-1):
         self.model = model
-        self.dialogue = []
+        self.dialogue = Dialogue(model)
         self.taken_actions_list = []
         self.message = ''
-
-        self.chain: BaseCombineDocumentsChain = None
-        self.memory: ConversationSummaryBufferMemory = None
-        self.index: Pinecone = None
+        # Observations of the actor last sent in the dialogue, the next
+        # ones may be sent as changes from them.
+        self.last_observation = None
+        # Observations of the prompt being decided on, not yet sent, and
+        # (prompt, same prompt with the observations in full) when the
+        # prompt holds changes only.
+        self.pending_observation = None
+        self.full_prompt = None
+        # Whether the last action chosen was a fallback, not the LLM's.
+        self.fell_back = False
+
+        # Created on first use by init_llm and init_index, see below.
+        self._chain: BaseCombineDocumentsChain = None
+        self._memory: ConversationSummaryBufferMemory = None
+        self._index: Pinecone = None
+        self.chain_callbacks = None
         self.name = f"{ctrl_type} {actor_id}"
+        self.retry_policy = get_retry_policy()
+        self.usage_ledger = get_usage_ledger()
+        self.answer_cache = get_answer_cache()
 
         self.init_prompts()
-        self.init_llm()
-        self.init_index()
 
         self.command_handlers = {}
         self.register_all_commands()
@@ -51,15 +68,63 @@ class BaseWorker(ABC):
 
     @abstractmethod
     def init_llm(self):
-        """ self.chain and self.memory should be initialized here
+        """ self.chain and self.memory should be initialized here, and
+        self.chain_callbacks if the chain is shared with other workers.
+        It is called on first use of either of them.
         """
         pass
 
     @abstractmethod
     def init_index(self):
-        # self.index should be initialized here
+        # self.index should be initialized here, on first use
         pass
 
+    @property
+    def chain(self) -> BaseCombineDocumentsChain:
+        if self._chain is None:
+            self.init_llm()
+        return self._chain
+
+    @chain.setter
+    def chain(self, chain):
+        self._chain = chain
+
+    @property
+    def memory(self) -> ConversationSummaryBufferMemory:
+        if self._memory is None:
+            self.init_llm()
+        return self._memory
+
+    @memory.setter
+    def memory(self, memory):
+        self._memory = memory
+
+    @property
+    def index(self) -> Pinecone:
+        if self._index is None:
+            self.init_index()
+        return self._index
+
+    @index.setter
+    def index(self, index):
+        self._index = index
+
+    def reset(self, ctrl_type: str = "null", actor_id: int = -1):
+        """
+        Reuse the worker for another actor: forget the dialogue and the
+        memory of the previous one, but keep the clients.
+        """
+        self.name = f"{ctrl_type} {actor_id}"
+        self.dialogue = Dialogue(self.model)
+        self.taken_actions_list = []
+        self.message = ''
+        self.last_observation = None
+        self.pending_observation = None
+        self.full_prompt = None
+        if self._memory is not None:
+            self._memory.clear()
+        self.init_prompts()
+
     @abstractmethod
     def register_all_commands(self):
         pass
@@ -74,6 +139,15 @@ class BaseWorker(ABC):
         """
         pass
 
+    async def agenerate_command(self, prompt: str):
+        """ Asynchronous version of `generate_command`.
+
+        By default the blocking `generate_command` runs in a thread of the
+        event loop's executor. Workers with a native async client should
+        override it.
+        """
+        return await asyncio.to_thread(self.generate_command, prompt)
+
     @abstractmethod
     def process_command(self, response: dict, input_prompt: str,
                         avail_action_list: list):
@@ -110,60 +184,173 @@ class BaseWorker(ABC):
         self.taken_actions_list = []
         return True
 
-    def choose_action(self,
-                      input_prompt,
-                      avail_action_list,
-                      interact_timeout=60):
+    def fallback_action(self, avail_action_list):
+        """Action chosen without the LLM, when it cannot give one in time."""
+        exec_action_name = random.choice(
+            avail_action_list) if avail_action_list else None
+        self.fell_back = True
+        fc_logger.debug(f'Fallback, randomly choose: {exec_action_name}')
+        print('Fallback, randomly choose:', exec_action_name)
+        return exec_action_name
+
+    def _choose_action_steps(self, input_prompt, avail_action_list,
+                             interact_timeout):
+        """
+        The loop shared by `choose_action` and `achoose_action`, as a
+        generator of the calls they make. It yields `('generate', args)`,
+        `('process', args)` and `('sleep', args)`, is sent the results of
+        the calls or thrown their errors, and returns the action name.
+        """
         exec_action_name = None
+        self.fell_back = False
         prompt_addition = ''
         start_time = time.time()
+        attempt = 0
         while exec_action_name is None:
-            if time.time() - start_time < interact_timeout:
-                try:
-                    response = self.generate_command(input_prompt +
-                                                     prompt_addition)
-
-                    exec_action_name, prompt_addition = self.process_command(
+            if (time.time() - start_time >= interact_timeout
+                    or not self.retry_policy.allow_request()):
+                exec_action_name = self.fallback_action(avail_action_list)
+                break
+            generated = False
+            try:
+                with get_tracer().span('choose_action_attempt',
+                                       worker=self.name,
+                                       attempt=attempt):
+                    response = yield 'generate', (input_prompt +
+                                                  prompt_addition, )
+                    generated = True
+                    self.retry_policy.record_success()
+
+                    exec_action_name, prompt_addition = yield 'process', (
                         response, input_prompt, avail_action_list)
                     self.dialogue += [response['choices'][0]['message']]
 
-                except Exception as e:
-                    fc_logger.error(f'Error when choosing action: {str(e)}')
-                    fc_logger.error(f'input_prompt: {input_prompt}')
-                    fc_logger.error(f'dialogue: {str(self.dialogue)}')
-                    fc_logger.error('Retying...')
-                    continue
-            else:
-                exec_action_name = random.choice(avail_action_list)
-                fc_logger.debug('Timeout, randomly choose:', exec_action_name)
-                print('Timeout, randomly choose:', exec_action_name)
-                break
+            except Exception as e:
+                fc_logger.error(f'Error when choosing action: {str(e)}')
+                fc_logger.error(f'input_prompt: {input_prompt}')
+                fc_logger.error(f'dialogue: {str(self.dialogue)}')
+                # Only errors of the LLM request count as failures of the
+                # endpoint. Replies that cannot be parsed or handled, e.g.
+                # malformed json, are retried without them.
+                if generated:
+                    can_retry = self.retry_policy.can_retry(attempt)
+                else:
+                    can_retry = self.retry_policy.should_retry(attempt)
+                if isinstance(e, CircuitOpenError) or not can_retry:
+                    exec_action_name = self.fallback_action(
+                        avail_action_list)
+                    break
+                fc_logger.error('Retying...')
+                self.usage_ledger.record_retry(self.name, self.role, None,
+                                               'chat', self.model)
+                with get_tracer().span('retry_backoff', worker=self.name):
+                    yield 'sleep', (self.retry_policy.backoff(attempt), )
+                attempt += 1
         return exec_action_name
 
+    def choose_action(self,
+                      input_prompt,
+                      avail_action_list,
+                      interact_timeout=60):
+        calls = {
+            'generate': self.generate_command,
+            'process': self.process_command,
+            'sleep': time.sleep
+        }
+        steps = self._choose_action_steps(input_prompt, avail_action_list,
+                                          interact_timeout)
+        result, error = None, None
+        while True:
+            try:
+                if error is None:
+                    call, args = steps.send(result)
+                else:
+                    call, args = steps.throw(error)
+            except StopIteration as stop:
+                return stop.value
+            try:
+                result, error = calls[call](*args), None
+            except Exception as e:
+                result, error = None, e
+
+    async def achoose_action(self,
+                             input_prompt,
+                             avail_action_list,
+                             interact_timeout=60):
+        """ Asynchronous version of `choose_action`. """
+        async def process(*args):
+            # Command handlers may query the index, keep them off the event
+            # loop.
+            return await asyncio.to_thread(self.process_command, *args)
+
+        calls = {
+            'generate': self.agenerate_command,
+            'process': process,
+            'sleep': asyncio.sleep
+        }
+        steps = self._choose_action_steps(input_prompt, avail_action_list,
+                                          interact_timeout)
+        result, error = None, None
+        while True:
+            try:
+                if error is None:
+                    call, args = steps.send(result)
+                else:
+                    call, args = steps.throw(error)
+            except StopIteration as stop:
+                return stop.value
+            try:
+                result, error = await calls[call](*args), None
+            except Exception as e:
+                result, error = None, e
+
     # ==============================================================
     # ====================== Index Maintanence =====================
     # ==============================================================
-    def get_similiar_docs(self, query, k=2, score=False):
+    def get_similiar_docs(self, query, k=2, score=False, embedded=None):
+        # The retrieval service can reuse the embedding of the query.
+        kwargs = {'embedded': embedded} if embedded is not None else {}
         if score:
-            similar_docs = self.index.similarity_search_with_score(query, k=k)
+            similar_docs = self.index.similarity_search_with_score(
+                query, k=k, **kwargs)
         else:
-            similar_docs = self.index.similarity_search(query, k=k)
+            similar_docs = self.index.similarity_search(query, k=k, **kwargs)
         return similar_docs
 
+    @traced('get_answer_from_index', cat='retrieval')
     def get_answer_from_index(self, query):
-        similar_docs = self.get_similiar_docs(query)
-        while True:
-            try:
-                fc_logger.debug(f'Querying with similar_docs: {similar_docs}')
-                fc_logger.debug(f'Querying with query: {query}')
-                answer = self.chain.run(input_documents=similar_docs,
-                                        question=query)
-                fc_logger.debug(f'Answer: {answer}')
-                break
-            except Exception as e:
-                fc_logger.error('Error in get_answer_from_index')
-                fc_logger.error(repr(e))
-                print(e)
+        embedded = None
+
+        def embed(query):
+            nonlocal embedded
+            embedded = self.index.embed_query(query)
+            return embedded[0]
+
+        answer, _ = self.answer_cache.lookup(
+            query,
+            embed if isinstance(self.index, RetrievalService) else None)
+        if answer is not None:
+            fc_logger.debug(f'Cached answer of {query}: {answer}')
+            self.usage_ledger.record_cache_hit(self.name, self.role,
+                                               'manualAndHistorySearch', 'qa',
+                                               self.model)
+            return answer
+
+        with get_tracer().span('similarity_search', cat='retrieval'):
+            similar_docs = self.get_similiar_docs(query, embedded=embedded)
+        fc_logger.debug(f'Querying with similar_docs: {similar_docs}')
+        fc_logger.debug(f'Querying with query: {query}')
+        answer = self.retry_policy.call(
+            self.chain.run,
+            input_documents=similar_docs,
+            question=query,
+            callbacks=self.chain_callbacks,
+            on_retry=lambda: self.usage_ledger.record_retry(
+                self.name, self.role, 'manualAndHistorySearch', 'qa', self.
+                model))
+        fc_logger.debug(f'Answer: {answer}')
+        self.answer_cache.put(query, answer,
+                              embedded[0] if embedded is not None else None)
         return answer
 
     # ==============================================================
@@ -171,7 +358,7 @@ class BaseWorker(ABC):
     # ==============================================================
     def load_saved_dialogue(self, load_path):
         with open(load_path, "r") as f:
-            self.dialogue = eval(f.read())
+            self.dialogue = Dialogue(self.model, eval(f.read()))
 
     def save_dialogue_to_file(self, save_path):
         with open(save_path, "w", encoding='utf-8') as f:
@@ -190,6 +377,11 @@ class BaseWorker(ABC):
         while len(self.dialogue) > keep_num:
             self.dialogue.pop(-1)
 
+    def observation_sent(self):
+        """The prompt being decided on was added to the dialogue."""
+        if self.pending_observation is not None:
+            self.last_observation = self.pending_observation
+
     def restrict_dialogue(self):
         limit = TOKEN_LIMIT_TABLE[self.model]
         """
@@ -197,15 +389,27 @@ class BaseWorker(ABC):
         If token length exceeds the limit, we will remove the oldest messages.
         """
         # TODO: validate that the messages removed are obs and actions
-        while num_tokens_from_messages(self.dialogue, self.model) >= limit:
+        while self.dialogue.num_tokens >= limit:
             temp_message = None
             if self.dialogue[-1]['role'] == 'user':
                 temp_message = self.dialogue[-1]
             self.remove_temp_messages_from_dialogue(keep_num=2)
 
+            with get_tracer().span('memory.load_memory_variables',
+                                   cat='memory'):
+                history = self.memory.load_memory_variables({})['history']
             self.add_user_message_to_dialogue(
-                'The former chat history can be summarized as: \n' +
-                self.memory.load_memory_variables({})['history'])
+                'The former chat history can be summarized as: \n' + history)
+            # The observations sent before are summarized away, send the
+            # next ones in full.
+            self.last_observation = None
 
             if temp_message is not None:
+                # The changes it holds are from observations summarized
+                # away, send it in full.
+                if self.full_prompt is not None:
+                    prompt, full_prompt = self.full_prompt
+                    temp_message = dict(temp_message,
+                                        content=temp_message['content'].replace(
+                                            prompt, full_prompt, 1))
                 self.dialogue.append(temp_message)
@@ -0,0 +1,163 @@
+# Copyright (C) 2023  The CivRealm project
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from civrealm.freeciv.utils.freeciv_logging import fc_logger
+
+from ..civ_autogpt.utils import num_tokens_from_message, num_tokens_from_string, TOKEN_LIMIT_TABLE
+from .gpt_worker import AzureGPTWorker
+
+
+class BatchWorker(AzureGPTWorker):
+    """
+    This worker decides for many entities with a single LLM request.
+
+    Its dialogue only holds the instruction and the task prompts, which are
+    shared by every batch. A batch is sent as one user message after them and
+    is not kept in the dialogue, so that batches are independent and can be
+    queried concurrently.
+
+    The instruction and task prompts are the templates named
+    `instruction_prompt` and `task_prompt`, chosen by the agent to match the
+    prompts of its batches.
+    """
+    role = "batch"
+
+    def __init__(self,
+                 max_batch_size: int = 20,
+                 completion_tokens: int = 256,
+                 completion_tokens_per_actor: int = 32,
+                 instruction_prompt: str = "batch_instruction_prompt",
+                 task_prompt: str = "batch_task_prompt",
+                 **kwargs):
+        self.instruction_prompt = instruction_prompt
+        self.task_prompt = task_prompt
+        self.max_batch_size = max_batch_size
+        self.completion_tokens = completion_tokens
+        self.completion_tokens_per_actor = completion_tokens_per_actor
+        super().__init__(**kwargs)
+
+    def _load_instruction_prompt(self):
+        instruction_prompt = getattr(self.prompt_handler,
+                                     self.instruction_prompt)()
+        self.add_user_message_to_dialogue(instruction_prompt)
+
+    def _load_task_prompt(self):
+        task_prompt = getattr(self.prompt_handler, self.task_prompt)()
+        self.add_user_message_to_dialogue(task_prompt)
+
+    def register_all_commands(self):
+        self.register_command('batchDecision',
+                              self.handle_command_batch_decision)
+
+    def handle_command_batch_decision(self, command_input, obs_input_prompt,
+                                      current_avail_actions):
+        """
+        `current_avail_actions` maps each actor key of the batch to its
+        available actions. Returns the valid decisions as a dict from actor
+        key to action name.
+        """
+        decisions = {}
+        for decision in command_input['decisions']:
+            actor_key = str(decision.get('actor', ''))
+            if actor_key not in current_avail_actions:
+                fc_logger.error(f'Unknown actor "{actor_key}" in batch.')
+                continue
+            lower_avail_actions = {
+                x.lower(): x
+                for x in current_avail_actions[actor_key]
+            }
+            action = str(decision.get('action', '')).lower()
+            if action not in lower_avail_actions:
+                fc_logger.error(
+                    f'Chosen action "{action}" of {actor_key} not in the ' +
+                    f'available action list {current_avail_actions[actor_key]}.'
+                )
+                continue
+            decisions[actor_key] = lower_avail_actions[action]
+        return decisions, ''
+
+    def plan_batches(self, actor_prompts, header_prompt=""):
+        """
+        Split actors into batches that fit the token limit of the model.
+
+        Parameters
+        ----------
+        actor_prompts: list of str, the observation prompt of every actor.
+        header_prompt: str, the part of the batch prompt shared by actors.
+
+        Returns
+        -------
+        batches: list of lists of indices into `actor_prompts`.
+        """
+        header_message = {
+            'role': 'user',
+            'content': header_prompt + self.prompt_handler.insist_json()
+        }
+        budget = (TOKEN_LIMIT_TABLE[self.model] - self.dialogue.num_tokens -
+                  num_tokens_from_message(header_message, self.model) -
+                  self.completion_tokens)
+
+        batches = []
+        current, current_tokens = [], 0
+        for index, prompt in enumerate(actor_prompts):
+            tokens = (num_tokens_from_string(prompt, self.model) +
+                      self.completion_tokens_per_actor)
+            if current and (current_tokens + tokens > budget
+                            or len(current) >= self.max_batch_size):
+                batches.append(current)
+                current, current_tokens = [], 0
+            current.append(index)
+            current_tokens += tokens
+        if current:
+            batches.append(current)
+        return batches
+
+    def batch_messages(self, batch_prompt):
+        return self.dialogue + [{
+            'role':
+            'user',
+            'content':
+            batch_prompt + self.prompt_handler.insist_json()
+        }]
+
+    def choose_batch_actions(self, batch_prompt, avail_actions_dict):
+        """
+        Query the LLM once for all actors of `avail_actions_dict`, which maps
+        actor keys to their available actions.
+
+        Returns a dict from actor keys to chosen actions. Actors without a
+        valid decision are left out.
+        """
+        try:
+            response = self.query_llm(
+                messages=self.batch_messages(batch_prompt))
+            decisions, _ = self.process_command(response, batch_prompt,
+                                                avail_actions_dict)
+        except Exception as e:
+            fc_logger.error(f'Error when choosing batch actions: {str(e)}')
+            return {}
+        return decisions or {}
+
+    async def achoose_batch_actions(self, batch_prompt, avail_actions_dict):
+        """ Asynchronous version of `choose_batch_actions`. """
+        try:
+            response = await self.aquery_llm(
+                messages=self.batch_messages(batch_prompt))
+            decisions, _ = self.process_command(response, batch_prompt,
+                                                avail_actions_dict)
+        except Exception as e:
+            fc_logger.error(f'Error when choosing batch actions: {str(e)}')
+            return {}
+        return decisions or {}
@@ -13,28 +13,20 @@
 # You should have received a copy of the GNU General Public License along
 # with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import os
 import random
 import json
-import time
+import asyncio
 
-import openai
-import pinecone
-
-from langchain.chat_models import ChatOpenAI, AzureChatOpenAI
 from langchain.chains import ConversationChain
 from langchain.memory import ConversationSummaryBufferMemory
 
-from langchain.document_loaders import DirectoryLoader
-from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain.embeddings.openai import OpenAIEmbeddings
-from langchain.vectorstores import Pinecone
-from langchain.llms import OpenAI, AzureOpenAI
-from langchain.chains.question_answering import load_qa_chain
-
 from civrealm.freeciv.utils.freeciv_logging import fc_logger
 from agents.prompt_handlers.base_prompt_handler import BasePromptHandler
 
+from config import LLM_STREAM_RESPONSES
+from ..backends import LLMBackend, get_backend
+from ..retrieval import get_retrieval_service
+from ..civ_autogpt.utils import Dialogue, num_tokens_from_messages, num_tokens_from_string, get_response_cache, get_request_scheduler, RateLimitCallbackHandler, JsonStreamParser, get_tracer, traced, UsageCallbackHandler
 from .base_worker import BaseWorker
 
 
@@ -45,9 +37,16 @@ class AzureGPTWorker(BaseWorker):
     def __init__(self,
                  model: str = 'gpt-35-turbo-16k',
                  prompt_prefix: str = "civ_prompts",
+                 stream: bool = LLM_STREAM_RESPONSES,
+                 backend: LLMBackend = None,
                  **kwargs):
-        assert os.environ['OPENAI_API_TYPE'] == 'azure'
+        self.backend = backend if backend is not None else get_backend()
+        self.deployment_name = self.backend.deployment_name
+        self.usage_handlers = []
         self.prompt_prefix = prompt_prefix
+        self.stream = stream
+        self.response_cache = get_response_cache()
+        self.scheduler = get_request_scheduler()
         super().__init__(model, **kwargs)
 
     def init_prompts(self):
@@ -57,31 +56,33 @@ class AzureGPTWorker(BaseWorker):
         self._load_task_prompt()
 
     def init_llm(self):
-        openai.api_type = os.environ["OPENAI_API_TYPE"]
-        openai.api_version = os.environ["OPENAI_API_VERSION"]
-        openai.api_base = os.environ["OPENAI_API_BASE"]
-        openai.api_key = os.environ["OPENAI_API_KEY"]
-
-        self.deployment_name = os.environ['DEPLOYMENT_NAME']
-        llm = AzureChatOpenAI(openai_api_base=openai.api_base,
-                              openai_api_version=openai.api_version,
-                              openai_api_key=openai.api_key,
-                              openai_api_type=openai.api_type,
-                              deployment_name=self.deployment_name,
-                              temperature=0.7)
-        self.chain = load_qa_chain(AzureOpenAI(
-            deployment_name=self.deployment_name, model_name=self.model),
-                                   chain_type="stuff")
+        # Summarization and QA calls of langchain share the request quota,
+        # and their usage is recorded.
+        rate_limit = RateLimitCallbackHandler(self.scheduler, self.model)
+        self.usage_handlers = [
+            UsageCallbackHandler(self.usage_ledger, self.name, self.role,
+                                 'summarization', self.model),
+            UsageCallbackHandler(self.usage_ledger,
+                                 self.name,
+                                 self.role,
+                                 'qa',
+                                 self.model,
+                                 command='manualAndHistorySearch')
+        ]
+        llm = self.backend.chat_model(
+            callbacks=[rate_limit, self.usage_handlers[0]], temperature=0.7)
+        self.chain = self.backend.shared_qa_chain(self.model)
+        self.chain_callbacks = [rate_limit, self.usage_handlers[1]]
         self.memory = ConversationSummaryBufferMemory(llm=llm,
                                                       max_token_limit=500)
 
     def init_index(self):
-        pinecone.init(api_key=os.environ["MY_PINECONE_API_KEY"],
-                      environment=os.environ["MY_PINECONE_ENV"])
-        # print(os.environ)
-        self.index = Pinecone.from_existing_index(
-            index_name='civrealm-mastaba',
-            embedding=OpenAIEmbeddings(model="text-embedding-ada-002"))
+        self.index = get_retrieval_service(self.backend, 'civrealm-mastaba')
+
+    def reset(self, ctrl_type: str = "null", actor_id: int = -1):
+        super().reset(ctrl_type, actor_id)
+        for handler in self.usage_handlers:
+            handler.worker = self.name
 
     def _load_instruction_prompt(self):
         instruction_prompt = self.prompt_handler.instruction_prompt()
@@ -112,7 +113,7 @@ class AzureGPTWorker(BaseWorker):
             answer += self.prompt_handler.finish_look_for()
 
         self.add_user_message_to_dialogue(answer)
-        self.memory.save_context({'assistant': query}, {'user': answer})
+        self.save_memory({'assistant': query}, {'user': answer})
         self.taken_actions_list.append('look_up')
         return None, ''
 
@@ -152,22 +153,199 @@ class AzureGPTWorker(BaseWorker):
 
         return exec_action, ''
 
-    def query_llm(self, stop=None, temperature=0.7, top_p=0.95):
+    def llm_request(self, messages=None):
+        """
+        Keyword arguments of the chat request for `messages`, which are the
+        current dialogue by default.
+        """
+        return dict(deployment_id=self.deployment_name,
+                    model=self.model,
+                    messages=self.dialogue if messages is None else messages)
+
+    def count_prompt_tokens(self, messages):
+        if isinstance(messages, Dialogue):
+            return messages.num_tokens
+        return num_tokens_from_messages(messages, self.model)
+
+    @staticmethod
+    def streamed_response(parser, finish_reason):
+        """A chat completion holding the text read by `parser`."""
+        return {
+            'choices': [{
+                'index': 0,
+                'finish_reason': finish_reason,
+                'message': {
+                    'role': 'assistant',
+                    'content': parser.text
+                }
+            }]
+        }
+
+    @staticmethod
+    def chunk_content(chunk):
+        choices = chunk.get('choices') or [{}]
+        return choices[0].get('delta', {}).get('content')
+
+    def stream_llm(self, request):
+        """
+        Stream the completion of `request`, and stop reading it as soon as
+        the command json is complete.
+        """
+        parser = JsonStreamParser()
+        stream = self.backend.chat_completion(request,
+                                              stream=True,
+                                              request_timeout=10)
+        finish_reason = 'stop'
+        try:
+            for chunk in stream:
+                if parser.feed(self.chunk_content(chunk)):
+                    finish_reason = 'command_complete'
+                    break
+        finally:
+            stream.close()
+        return self.streamed_response(parser, finish_reason)
+
+    async def astream_llm(self, request):
+        """ Asynchronous version of `stream_llm`. """
+        parser = JsonStreamParser()
+        stream = await self.backend.achat_completion(request,
+                                                     stream=True,
+                                                     request_timeout=10)
+        finish_reason = 'stop'
+        try:
+            async for chunk in stream:
+                if parser.feed(self.chunk_content(chunk)):
+                    finish_reason = 'command_complete'
+                    break
+        finally:
+            await stream.aclose()
+        return self.streamed_response(parser, finish_reason)
+
+    def response_usage(self, prompt_tokens, response):
+        """Prompt and completion tokens of a response."""
+        usage = response.get('usage')
+        if usage:
+            return (usage.get('prompt_tokens', prompt_tokens),
+                    usage.get('completion_tokens', 0))
+        # Streamed completions carry no usage.
+        content = response['choices'][0]['message']['content']
+        return prompt_tokens, num_tokens_from_string(content, self.model)
+
+    def response_command(self, response):
+        try:
+            return self.parse_response(response)['command']['name']
+        except Exception:
+            return None
+
+    def settle_usage(self, prompt_tokens, response):
+        """Settle the rate limiter and record the usage of a response."""
+        used_prompt_tokens, completion_tokens = self.response_usage(
+            prompt_tokens, response)
+        self.scheduler.settle(prompt_tokens,
+                              used_prompt_tokens + completion_tokens)
+        self.usage_ledger.record(self.name,
+                                 self.role,
+                                 self.response_command(response),
+                                 'chat',
+                                 self.model,
+                                 prompt_tokens=used_prompt_tokens,
+                                 completion_tokens=completion_tokens)
+
+    @traced('memory.save_context', cat='memory')
+    def save_memory(self, inputs, outputs):
+        """Save an exchange to the memory, which may summarize it with the
+        LLM."""
+        self.memory.save_context(inputs, outputs)
+
+    @traced('query_llm', cat='llm')
+    def query_llm(self,
+                  stop=None,
+                  temperature=0.7,
+                  top_p=0.95,
+                  use_cache=True,
+                  messages=None,
+                  stream=None):
         fc_logger.debug(f'Querying with dialogue: {self.dialogue}')
-        assert openai.api_type == 'azure'
+        stream = self.stream if stream is None else stream
 
-        return openai.ChatCompletion.create(deployment_id=self.deployment_name,
-                                            model=self.model,
-                                            messages=self.dialogue,
-                                            request_timeout=10)
+        request = self.llm_request(messages)
+        cache_key = self.response_cache.make_key(**request)
+        response = self.response_cache.get(cache_key) if use_cache else None
+        if response is None:
+            prompt_tokens = self.count_prompt_tokens(request['messages'])
+            with get_tracer().span('rate_limit_wait', cat='llm'):
+                self.scheduler.acquire(prompt_tokens)
+            with get_tracer().span('chat_completion',
+                                   cat='llm',
+                                   prompt_tokens=prompt_tokens,
+                                   stream=stream):
+                if stream:
+                    response = self.stream_llm(request)
+                else:
+                    response = self.backend.chat_completion(
+                        request, request_timeout=10)
+            self.settle_usage(prompt_tokens, response)
+            self.response_cache.put(cache_key, response)
+        else:
+            self.usage_ledger.record_cache_hit(self.name, self.role,
+                                               self.response_command(response),
+                                               'chat', self.model)
+        return response
+
+    @traced('query_llm', cat='llm')
+    async def aquery_llm(self,
+                         stop=None,
+                         temperature=0.7,
+                         top_p=0.95,
+                         use_cache=True,
+                         messages=None,
+                         stream=None):
+        fc_logger.debug(f'Querying with dialogue: {self.dialogue}')
+        stream = self.stream if stream is None else stream
+
+        request = self.llm_request(messages)
+        cache_key = self.response_cache.make_key(**request)
+        response = self.response_cache.get(cache_key) if use_cache else None
+        if response is None:
+            prompt_tokens = self.count_prompt_tokens(request['messages'])
+            with get_tracer().span('rate_limit_wait', cat='llm'):
+                await self.scheduler.aacquire(prompt_tokens)
+            with get_tracer().span('chat_completion',
+                                   cat='llm',
+                                   prompt_tokens=prompt_tokens,
+                                   stream=stream):
+                if stream:
+                    response = await self.astream_llm(request)
+                else:
+                    response = await self.backend.achat_completion(
+                        request, request_timeout=10)
+            self.settle_usage(prompt_tokens, response)
+            self.response_cache.put(cache_key, response)
+        else:
+            self.usage_ledger.record_cache_hit(self.name, self.role,
+                                               self.response_command(response),
+                                               'chat', self.model)
+        return response
 
     def generate_command(self, prompt: str):
         self.add_user_message_to_dialogue(prompt +
                                           self.prompt_handler.insist_json())
         self.restrict_dialogue()
+        self.observation_sent()
         response = self.query_llm()
-        self.memory.save_context({'user': prompt},
-                                 {'assistant': str(response)})
+        self.save_memory({'user': prompt}, {'assistant': str(response)})
+        return response
+
+    async def agenerate_command(self, prompt: str):
+        self.add_user_message_to_dialogue(prompt +
+                                          self.prompt_handler.insist_json())
+        # Summarizing the dialogue and saving the memory may call the LLM
+        # through langchain, which only offers blocking calls here.
+        await asyncio.to_thread(self.restrict_dialogue)
+        self.observation_sent()
+        response = await self.aquery_llm()
+        await asyncio.to_thread(self.save_memory, {'user': prompt},
+                                {'assistant': str(response)})
         return response
 
     def parse_response(self, response):
@@ -0,0 +1,73 @@
+# Copyright (C) 2023  The CivRealm project
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import weakref
+from collections import defaultdict
+
+from civrealm.freeciv.utils.freeciv_logging import fc_logger
+
+from config import WORKER_POOL_SIZE
+
+
+class WorkerPool:
+    """
+    Workers of dead entities, reset and reused for the entities born later.
+
+    Workers are pooled by class and constructor arguments, e.g. the prompt
+    prefix, so that a recycled worker is the same as a new one. At most
+    `max_idle` workers are kept idle for each of them.
+    """
+    def __init__(self, max_idle: int = WORKER_POOL_SIZE):
+        self.max_idle = max_idle
+        self.created = 0
+        self.recycled = 0
+        self._idle = defaultdict(list)
+        self._keys = weakref.WeakKeyDictionary()
+
+    @staticmethod
+    def pool_key(worker_class, kwargs) -> tuple:
+        return (worker_class, tuple(sorted(kwargs.items())))
+
+    def acquire(self, worker_class, ctrl_type, actor_id, **kwargs):
+        """A worker of `worker_class` for the actor, recycled if possible."""
+        key = self.pool_key(worker_class, kwargs)
+        idle = self._idle[key]
+        if idle:
+            worker = idle.pop()
+            worker.reset(ctrl_type=ctrl_type, actor_id=actor_id)
+            self.recycled += 1
+        else:
+            worker = worker_class(ctrl_type=ctrl_type,
+                                  actor_id=actor_id,
+                                  **kwargs)
+            self.created += 1
+        self._keys[worker] = key
+        return worker
+
+    def release(self, worker):
+        """Keep the worker of a dead entity for later."""
+        key = self._keys.get(worker)
+        if key is None:
+            fc_logger.debug(f'Worker {worker.name} is not from the pool.')
+            return
+        if len(self._idle[key]) < self.max_idle:
+            self._idle[key].append(worker)
+
+    def stats(self) -> dict:
+        return {
+            'created': self.created,
+            'recycled': self.recycled,
+            'idle': sum(len(idle) for idle in self._idle.values())
+        }
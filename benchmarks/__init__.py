@@ -0,0 +1,10 @@
+import sys
+
+# civrealm parses sys.argv when it is first imported, and would take the
+# options of the benchmarks, e.g. `--help`, as its own. Import it with the
+# options hidden, so that each benchmark parses them alone.
+_argv, sys.argv = sys.argv, sys.argv[:1]
+try:
+    import civrealm.configs
+finally:
+    sys.argv = _argv
@@ -0,0 +1,100 @@
+# Copyright (C) 2023  The CivRealm project
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Prompt tokens of the observations of every actor of recorded fixtures, with
+each observation encoder of agents.obs_encoders.
+
+Usage, from the root of the repository:
+
+    python -m benchmarks.obs_encoding
+    python -m benchmarks.obs_encoding --fixture observations_info.txt \
+        --model gpt-35-turbo-16k --baseline repr
+
+Tokens are counted with num_tokens_from_messages on a user message holding
+the zoomed-out and zoomed-in observations, as in the prompts of the agents.
+"""
+
+import argparse
+import importlib
+
+from agents.obs_encoders import OBS_ENCODERS, make_obs_encoder
+from benchmarks.turn_latency import ensure_tokenizer, load_fixture
+
+token_counting = importlib.import_module(
+    'agents.civ_autogpt.utils.num_tokens_from_messages')
+
+
+def observation_tokens(encoder, observations, model):
+    content = (
+        f"The zoomed-out observation is " +
+        f"{encoder.encode(observations.get('upper_map', {}))}.\n" +
+        f"The zoomed-in observation is " +
+        f"{encoder.encode(observations.get('minimap', {}))}.")
+    return token_counting.num_tokens_from_messages([{
+        'role': 'user',
+        'content': content
+    }], model)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--fixture',
+                        action='append',
+                        help='pickled {"observations", "info"} of a turn, ' +
+                        'may be repeated (default: observations_info.txt)')
+    parser.add_argument('--model', default='gpt-35-turbo-16k')
+    parser.add_argument('--baseline', default='repr', choices=OBS_ENCODERS)
+    args = parser.parse_args()
+
+    ensure_tokenizer(args.model)
+    encoders = {name: make_obs_encoder(name) for name in OBS_ENCODERS}
+
+    print(f"{'actor':<24}" + "".join(f"{name:>10}" for name in encoders) +
+          "".join(f"{name + ' %':>12}" for name in encoders
+                  if name != args.baseline))
+    totals = dict.fromkeys(encoders, 0)
+    num_actors = 0
+    for fixture_path in args.fixture or ['observations_info.txt']:
+        _, info = load_fixture(fixture_path)
+        for ctrl_type in ('unit', 'city'):
+            for actor_dict in info['llm_info'].get(ctrl_type, {}).values():
+                tokens = {
+                    name: observation_tokens(encoder,
+                                             actor_dict['observations'],
+                                             args.model)
+                    for name, encoder in encoders.items()
+                }
+                for name, count in tokens.items():
+                    totals[name] += count
+                num_actors += 1
+                print(format_row(actor_dict['name'], tokens, args.baseline))
+    if num_actors:
+        print(
+            format_row(
+                'mean per actor',
+                {name: total / num_actors
+                 for name, total in totals.items()}, args.baseline))
+
+
+def format_row(actor, tokens, baseline):
+    """Token counts of an actor, and savings over the baseline encoder."""
+    return (f"{actor:<24}" +
+            "".join(f"{count:>10.0f}" for count in tokens.values()) +
+            "".join(f"{100 * (1 - count / tokens[baseline]):>11.1f}%"
+                    for name, count in tokens.items() if name != baseline))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,159 @@
+# Copyright (C) 2023  The CivRealm project
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Render time of the prompt templates, compiled at load time by
+BasePromptHandler and SIGPromptHandler, against the legacy parser, which
+scanned and replaced the raw template on every call.
+
+Usage, from the root of the repository:
+
+    python -m benchmarks.prompt_render
+    python -m benchmarks.prompt_render --prompts civ_prompts --number 20000
+
+Every template of the prompt directory is rendered with placeholder values
+for its variables. The outputs of the parsers are checked to be equal.
+"""
+
+import os
+import re
+import copy
+import timeit
+import argparse
+import contextlib
+
+from civrealm.freeciv.utils.freeciv_logging import fc_logger
+
+from agents.prompt_handlers.base_prompt_handler import (BasePromptHandler,
+                                                        SEGMENT_PATTERN)
+from agents.prompt_handlers.sig_prompt_handler import SIGPromptHandler
+
+
+def legacy_txt_parser(self, raw: str, template_name: str) -> callable:
+    """The parser of BasePromptHandler before templates were compiled."""
+    def parser(_raise_empty: bool = False, **kwargs) -> str:
+        nonlocal raw, template_name, self
+        variables = set(re.findall("(<%[ ]+(.*?)[ ]+%>)", raw))
+        recursions = set(re.findall(r"(<\$[ ]+(.*?)[ ]+\$>)", raw))
+
+        out = copy.deepcopy(raw)
+        for pattern, key in variables:
+            try:
+                out = out.replace(pattern, str(kwargs[key]))
+            except KeyError as einfo:
+                fc_logger.error(f"Failed to provide key {key}" +
+                                f" in generating {template_name}.")
+                fc_logger.error(einfo)
+                print(f"Failed to provide key {key}" +
+                      f" in generating {template_name}.")
+                if _raise_empty:
+                    raise
+                out = out.replace(pattern, "")
+        for pattern, key in recursions:
+            try:
+                func_end = key.find("(")
+                if func_end == -1:
+                    key = key + "()"
+                    func_end = -2
+                if key[:func_end] == template_name:
+                    print("Should raise")
+                    raise Exception("Self-quoted!")
+                replace = eval("self." + key)
+
+                print(replace)
+                out = out.replace(pattern, replace)
+            except Exception as einfo:
+                fc_logger.error(f"Failed to load submodule {key}" +
+                                f" in generating {template_name}.")
+                fc_logger.error(einfo)
+                print(f"Failed to load submodule {key}" +
+                      f" in generating {template_name}.")
+                print(einfo)
+                if _raise_empty:
+                    raise
+                out = out.replace(pattern, "")
+        return out
+
+    return parser
+
+
+class LegacyPromptHandler(BasePromptHandler):
+    _txt_parser = legacy_txt_parser
+
+
+def template_variables(prefix):
+    """Placeholder values for the variables of the templates of `prefix`."""
+    variables = {}
+    for fname in os.listdir(prefix):
+        if not fname.endswith(".txt") or "#" in fname:
+            continue
+        with open(prefix + fname, "r", encoding="utf-8") as filep:
+            raw = filep.read()
+        variables[fname[:-4]] = {
+            key: f"<value of {key}>"
+            for key, _ in SEGMENT_PATTERN.findall(raw) if key
+        }
+    return variables
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--prompts', default='civ_prompts')
+    parser.add_argument('--number',
+                        type=int,
+                        default=10000,
+                        help='renders of every template')
+    args = parser.parse_args()
+
+    handlers = {
+        'legacy': LegacyPromptHandler(args.prompts),
+        'base': BasePromptHandler(args.prompts),
+        'sig': SIGPromptHandler(args.prompts)
+    }
+    variables = {}
+    for prefix in reversed(handlers['base'].related_pclasses):
+        variables.update(template_variables(prefix))
+
+    print(f"{'template':<36}" +
+          "".join(f"{name + ' us':>11}" for name in handlers) +
+          f"{'base x':>9}{'sig x':>9}")
+    totals = dict.fromkeys(handlers, 0.0)
+    # The legacy parser prints sub-templates and errors.
+    with open(os.devnull, 'w') as devnull:
+        for template in sorted(handlers['base'].templates):
+            kwargs = variables.get(template, {})
+            times = {}
+            with contextlib.redirect_stdout(devnull):
+                expected = handlers['legacy'].generate(template, **kwargs)
+                for name, handler in handlers.items():
+                    if handler.generate(template, **kwargs) != expected:
+                        raise AssertionError(
+                            f'{template} renders differently with {name}.')
+                    times[name] = timeit.timeit(
+                        lambda: handler.generate(template, **kwargs),
+                        number=args.number)
+                    totals[name] += times[name]
+            print(format_row(template, times, args.number))
+    print(format_row('all templates', totals, args.number))
+
+
+def format_row(template, times, number):
+    return (f"{template:<36}" +
+            "".join(f"{time / number * 1e6:>11.2f}"
+                    for time in times.values()) +
+            f"{times['legacy'] / times['base']:>8.1f}x" +
+            f"{times['legacy'] / times['sig']:>8.1f}x")
+
+if __name__ == '__main__':
+    main()
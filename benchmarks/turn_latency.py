@@ -0,0 +1,275 @@
+# Copyright (C) 2023  The CivRealm project
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Latency of the stages of an agent turn, measured on recorded
+`observations`/`info` fixtures with the mock LLM backend, so that it runs
+without the network.
+
+Usage, from the root of the repository:
+
+    python -m benchmarks.turn_latency
+    python -m benchmarks.turn_latency --agent baselang --entities 5 20 50 \
+        --fixture observations_info.txt --json turn_latency.json
+
+The actors of a fixture are cloned to reach the requested entity counts.
+p50 and p95 are reported in milliseconds for every stage and entity count.
+"""
+
+import os
+import sys
+import copy
+import json
+import time
+import pickle
+import argparse
+import importlib
+import contextlib
+from collections import defaultdict
+
+os.environ['LLM_BACKEND'] = 'mock'
+
+from agents.backends import MockBackend, set_backend
+from agents.civ_autogpt.utils import TOKEN_LIMIT_TABLE
+
+token_counting = importlib.import_module(
+    'agents.civ_autogpt.utils.num_tokens_from_messages')
+
+STAGES = [
+    'get_birth_death_entities', 'add_entity', 'get_advisor_input_prompt',
+    'get_obs_input_prompt', 'token_counting', 'restrict_dialogue',
+    'parse_response', 'act_queue_draining'
+]
+
+
+def ensure_tokenizer(model):
+    """
+    Use an approximate tokenizer if the tiktoken encoding cannot be loaded,
+    e.g. with no network and no tiktoken cache.
+    """
+    try:
+        token_counting.get_encoding(model)
+    except Exception as e:
+
+        class WordEncoding:
+            def encode(self, text, **kwargs):
+                return text.split()
+
+        print(f'tiktoken encoding unavailable ({type(e).__name__}), ' +
+              'counting words instead.',
+              file=sys.stderr)
+        token_counting.get_encoding = lambda model: WordEncoding()
+
+
+def load_fixture(path):
+    with open(path, 'rb') as f:
+        fixture = pickle.load(f)
+    observations, info = fixture['observations'], fixture['info']
+    if 'my_player_id' not in info:
+        # Added by the LLM wrapper of civrealm at each step.
+        info['my_player_id'] = next(iter(
+            observations['unit'].values()))['owner']
+    return observations, info
+
+
+def scale_fixture(observations, info, num_entities):
+    """Clone the actors of a fixture until it has `num_entities` of them."""
+    observations = copy.copy(observations)
+    info = copy.deepcopy(info)
+    llm_info = info['llm_info']
+    actors = [(ctrl_type, actor_id) for ctrl_type in ('unit', 'city')
+              for actor_id in llm_info.get(ctrl_type, {})]
+    if not actors:
+        raise ValueError('The fixture has no actor to clone.')
+
+    observations['unit'] = dict(observations['unit'])
+    next_id = max(
+        max(observations['unit']),
+        max(actor_id for _, actor_id in actors)) + 1
+    while len(actors) > num_entities:
+        ctrl_type, actor_id = actors.pop()
+        del llm_info[ctrl_type][actor_id]
+    index = 0
+    while len(actors) < num_entities:
+        ctrl_type, actor_id = actors[index]
+        actor_dict = copy.deepcopy(llm_info[ctrl_type][actor_id])
+        actor_dict['name'] = f"{actor_dict['name'].split(' ')[0]} {next_id}"
+        llm_info[ctrl_type][next_id] = actor_dict
+        if ctrl_type == 'unit' and actor_id in observations['unit']:
+            observations['unit'][next_id] = observations['unit'][actor_id]
+        actors.append((ctrl_type, next_id))
+        next_id += 1
+        index += 1
+    return observations, info
+
+
+def percentile(samples, q):
+    samples = sorted(samples)
+    index = min(len(samples) - 1, max(0, round(q / 100 * len(samples)) - 1))
+    return samples[index]
+
+
+class TurnBenchmark:
+    def __init__(self, agent_name, backend):
+        self.agent_name = agent_name
+        self.backend = backend
+        self.samples = defaultdict(list)
+
+    def make_agent(self):
+        from agents import BaseLangAgent, MastabaAgent
+        if self.agent_name == 'mastaba':
+            return MastabaAgent()
+        return BaseLangAgent()
+
+    def timed(self, stage, num_entities, func, *args, **kwargs):
+        start_time = time.perf_counter()
+        result = func(*args, **kwargs)
+        self.samples[(stage, num_entities)].append(time.perf_counter() -
+                                                   start_time)
+        return result
+
+    def run_turn(self, observations, info):
+        num_entities = sum(len(info['llm_info'].get(ctrl_type, {}))
+                           for ctrl_type in ('unit', 'city'))
+        agent = self.make_agent()
+        agent.process_observations_and_info(observations, info)
+
+        birth_entities, _ = self.timed('get_birth_death_entities',
+                                       num_entities,
+                                       agent.get_birth_death_entities, info)
+        for entity_type, entity_ids in birth_entities.items():
+            for entity_id in entity_ids:
+                self.timed('add_entity', num_entities, agent.add_entity,
+                           entity_type, entity_id)
+
+        if hasattr(agent, 'get_advisor_input_prompt'):
+            self.timed('get_advisor_input_prompt', num_entities,
+                       agent.get_advisor_input_prompt, observations, info)
+
+        chosen_actions = []
+        for (ctrl_type, actor_id), worker in agent.workers.items():
+            actor_dict = copy.deepcopy(info['llm_info'][ctrl_type][actor_id])
+            available_actions = agent.get_available_actions(actor_dict)
+            prompt = self.timed('get_obs_input_prompt', num_entities,
+                                agent.get_obs_input_prompt, ctrl_type,
+                                actor_dict['name'], actor_dict,
+                                available_actions)
+
+            def count_tokens():
+                worker.add_user_message_to_dialogue(
+                    prompt + worker.prompt_handler.insist_json())
+                return worker.dialogue.num_tokens
+
+            self.timed('token_counting', num_entities, count_tokens)
+
+            request = worker.llm_request()
+            response = self.backend.respond(request)
+            exec_action_name, _ = self.timed('parse_response', num_entities,
+                                             worker.process_command, response,
+                                             prompt, available_actions)
+            if exec_action_name:
+                chosen_actions.append((ctrl_type, actor_id, exec_action_name))
+
+            # Fill the dialogue past the token limit of the model.
+            while worker.dialogue.num_tokens < TOKEN_LIMIT_TABLE[
+                    worker.model]:
+                worker.add_user_message_to_dialogue(prompt)
+                worker.dialogue.append(response['choices'][0]['message'])
+            self.timed('restrict_dialogue', num_entities,
+                       worker.restrict_dialogue)
+
+        # Drain the queue of chosen actions, as in a turn of the game.
+        agent.turn = info['turn']
+        agent.current_deconflict_depth = 0
+        for action in chosen_actions:
+            agent.chosen_actions.put(action)
+        for _ in chosen_actions:
+            self.timed('act_queue_draining', num_entities, agent.act,
+                       observations, info)
+
+    def report(self):
+        rows = []
+        for stage in STAGES:
+            for (sample_stage, num_entities), samples in sorted(
+                    self.samples.items(), key=lambda x: x[0][1]):
+                if sample_stage != stage:
+                    continue
+                rows.append({
+                    'stage': stage,
+                    'entities': num_entities,
+                    'samples': len(samples),
+                    'p50_ms': percentile(samples, 50) * 1000,
+                    'p95_ms': percentile(samples, 95) * 1000
+                })
+        return rows
+
+
+def format_report(rows):
+    lines = [
+        f"{'stage':<26}{'entities':>9}{'samples':>9}{'p50 ms':>11}{'p95 ms':>11}"
+    ]
+    for row in rows:
+        lines.append(f"{row['stage']:<26}{row['entities']:>9}" +
+                     f"{row['samples']:>9}{row['p50_ms']:>11.3f}" +
+                     f"{row['p95_ms']:>11.3f}")
+    return '\n'.join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--fixture',
+                        action='append',
+                        help='pickled {"observations", "info"} of a turn, ' +
+                        'may be repeated (default: observations_info.txt)')
+    parser.add_argument('--agent',
+                        choices=['mastaba', 'baselang'],
+                        default='mastaba')
+    parser.add_argument('--entities',
+                        type=int,
+                        nargs='+',
+                        default=[5, 20, 50],
+                        help='entity counts to measure')
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', help='also write the results to this file')
+    args = parser.parse_args()
+
+    backend = MockBackend(latency=('constant', 0.0), seed=args.seed)
+    set_backend(backend)
+    ensure_tokenizer('gpt-35-turbo-16k')
+
+    results = {}
+    for fixture_path in args.fixture or ['observations_info.txt']:
+        observations, info = load_fixture(fixture_path)
+        benchmark = TurnBenchmark(args.agent, backend)
+        # Agents and prompt handlers print a lot, keep the report readable.
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(
+                devnull):
+            for num_entities in args.entities:
+                scaled_observations, scaled_info = scale_fixture(
+                    observations, info, num_entities)
+                for _ in range(args.repeats):
+                    benchmark.run_turn(scaled_observations, scaled_info)
+        rows = benchmark.report()
+        results[fixture_path] = rows
+        print(f'Fixture {fixture_path}, agent {args.agent}:')
+        print(format_report(rows))
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -2,6 +2,123 @@
 
 INDIVIDUAL_PROMPT_DEFAULT = True
 
+# Maximum number of LLM decisions in flight at the same time in one turn.
+LLM_CONCURRENCY_LIMIT = 16
+
+# Decide for many entities with one LLM request. Batches are sized by the
+# token limit of the model, and capped by BATCH_MAX_SIZE.
+BATCH_DECISIONS_DEFAULT = False
+BATCH_MAX_SIZE = 20
+
+# Cache of LLM responses keyed on the full request. Off by default, since
+# the workers sample at temperature 0.7 and a cached response would replace
+# a fresh sample. Enable it to replay a recorded game, or with deterministic
+# sampling. Set a path to keep the responses in a SQLite file between runs,
+# e.g. "llm_cache.sqlite".
+LLM_CACHE_ENABLED = False
+LLM_CACHE_SIZE = 4096
+LLM_CACHE_PATH = None
+
+# Timeouts in seconds of requests to the local LLM server at LOCAL_LLM_URL.
+LOCAL_LLM_CONNECT_TIMEOUT = 3.05
+LOCAL_LLM_READ_TIMEOUT = 120
+
+# Backend of the workers: "azure", or "mock" to run without the network.
+# The LLM_BACKEND environment variable takes precedence.
+LLM_BACKEND = "azure"
+# Append the chat completions of the backend to this JSONL file, to replay
+# them with the mock backend later.
+LLM_RECORD_PATH = None
+# Mock backend: latency distribution in seconds, as ("constant", t),
+# ("uniform", a, b), ("normal", mu, sigma) or ("lognormal", mu, sigma),
+# probability of an error, and recorded completions to replay.
+MOCK_LLM_LATENCY = ("lognormal", -0.5, 0.5)
+MOCK_LLM_ERROR_RATE = 0.0
+MOCK_LLM_REPLAY_PATH = None
+MOCK_LLM_SEED = None
+
+# Stream LLM replies and stop reading them once the command json is complete.
+LLM_STREAM_RESPONSES = False
+
+# Record spans of the agent pipeline, exported per game to TRACE_DIR as
+# Chrome trace files (open them in chrome://tracing or ui.perfetto.dev).
+TRACING_ENABLED = False
+TRACE_DIR = "traces"
+
+# Directory of the per-game summaries of LLM token usage and cost.
+USAGE_DIR = "usage"
+
+# Quota of the LLM deployment shared by all workers, e.g. 300 requests and
+# 120000 tokens per minute. None means no limit.
+LLM_REQUESTS_PER_MINUTE = None
+LLM_TOKENS_PER_MINUTE = None
+
+# Retries of failed LLM requests: capped exponential backoff with jitter,
+# at most RETRY_MAX_ATTEMPTS attempts per call and RETRY_BUDGET_PER_TURN
+# retries per turn in total. After CIRCUIT_FAILURE_THRESHOLD consecutive
+# failures, requests are refused for CIRCUIT_RECOVERY_TIMEOUT seconds and
+# workers fall back to a random action.
+RETRY_BASE_DELAY = 0.5
+RETRY_MAX_DELAY = 30.0
+RETRY_MAX_ATTEMPTS = 6
+RETRY_BUDGET_PER_TURN = 500
+CIRCUIT_FAILURE_THRESHOLD = 20
+CIRCUIT_RECOVERY_TIMEOUT = 60.0
+
+# Queries on the manual from all the workers are embedded together: the
+# embedding thread waits up to RETRIEVAL_BATCH_WINDOW seconds for at most
+# RETRIEVAL_MAX_BATCH queries. Latency stats cover the last
+# RETRIEVAL_STATS_WINDOW queries.
+RETRIEVAL_BATCH_WINDOW = 0.005
+RETRIEVAL_MAX_BATCH = 16
+RETRIEVAL_STATS_WINDOW = 1000
+
+# Index of the manual: "remote" for the index of the LLM backend (Pinecone
+# for azure), or "local" for the memory-mapped store in
+# LOCAL_INDEX_DIR/<index name>, built with
+# `python -m agents.retrieval.build_index`. The VECTOR_STORE environment
+# variable takes precedence.
+VECTOR_STORE = "remote"
+LOCAL_INDEX_DIR = "local_index"
+# Dimension of the offline hashing embeddings of the local store.
+HASHING_EMBEDDING_DIM = 256
+
+# Cache of the answers of the manual to manualAndHistorySearch queries,
+# shared by the workers. A query hits on its normalized text, or on a cached
+# query whose embedding has at least ANSWER_CACHE_SIMILARITY cosine
+# similarity. Answers expire after ANSWER_CACHE_TTL seconds (None: never).
+# Set a path to keep them in a SQLite file between games.
+ANSWER_CACHE_ENABLED = True
+ANSWER_CACHE_SIZE = 1024
+ANSWER_CACHE_TTL = 3600.0
+ANSWER_CACHE_SIMILARITY = 0.95
+ANSWER_CACHE_PATH = None
+
+# Encoding of the minimap and upper_map observations in the prompts:
+# "repr" for the Python dicts, or "compact" for a legend of the features
+# coded by letters and a matrix of the tiles, using fewer tokens. The
+# OBS_ENCODER environment variable takes precedence.
+OBS_ENCODER = "repr"
+# Send the observations of an actor to its worker as the changes since the
+# ones sent last, when shorter. They are sent in full again after the
+# dialogue of the worker is summarized.
+OBS_DELTA_ENCODING = True
+
+# Actors whose observations, available actions and advice from the advisor
+# are the same as when the LLM last decided for them take their last action
+# again, for at most DECISION_REUSE_MAX_AGE turns after that decision.
+DECISION_REUSE_ENABLED = True
+DECISION_REUSE_MAX_AGE = 3
+
+# Idle workers of dead entities kept for reuse, per worker class and
+# prompt prefix.
+WORKER_POOL_SIZE = 32
+
+# Prompt collections are loaded once per process and shared by the prompt
+# handlers. Check the mtimes of their files at most once per this many
+# seconds, and reload a collection whose files changed.
+PROMPT_RELOAD_INTERVAL = 2.0
+
 PROMPT_SOLUTIONS_DICT = {
     "vanilla": "civ_prompts",
     "Settlers": "test_prompts_01_settlers",
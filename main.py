@@ -13,6 +13,8 @@
 # You should have received a copy of the GNU General Public License along
 # with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import os
+import time
 import pickle
 import warnings
 import gymnasium
@@ -23,6 +25,8 @@ from civrealm.configs import fc_args
 from civrealm.envs.freeciv_wrapper.llm_wrapper import LLMWrapper
 from agents.utils import print_step, print_action, print_current
 from agents import utils
+from agents.civ_autogpt.utils import get_tracer, get_usage_ledger
+from config import TRACE_DIR, USAGE_DIR
 
 # FIXME: This is a hack to suppress the warning about the gymnasium spaces. Currently Gymnasium does not support hierarchical actions.
 warnings.filterwarnings('ignore',
@@ -42,13 +46,18 @@ def main():
 
     observations, info = env.reset()
 
+    game_time = time.strftime('%Y.%m.%d_%H:%M:%S')
+    tracer = get_tracer()
+    trace_path = os.path.join(TRACE_DIR, f"trace_{game_time}.json")
+    usage_path = os.path.join(USAGE_DIR, f"usage_{game_time}.json")
     done = False
     step = 0
     while not done:
         try:
             action = agent.act(observations, info)
-            observations, reward, terminated, truncated, info = env.step(
-                action)
+            with tracer.span('env.step', cat='env', step=step):
+                observations, reward, terminated, truncated, info = env.step(
+                    action)
             done = terminated or truncated
 
             step += 1
@@ -57,8 +66,16 @@ def main():
                        f'Truncated: {truncated}')
         except Exception as e:
             fc_logger.error(repr(e))
+            if tracer.enabled:
+                tracer.export(trace_path)
+            get_usage_ledger().export(usage_path)
             raise e
     env.close()
+    if tracer.enabled:
+        tracer.export(trace_path)
+        print('Trace saved to', trace_path)
+    get_usage_ledger().export(usage_path)
+    print('LLM usage:', get_usage_ledger().aggregate())
     '''
     players, tags, turns, evaluations = env.evaluate_game()
     '''